@@ -0,0 +1,72 @@
+import numpy as np
+from nms_network import model as nms_net
+from tools import batch_utils
+
+PADDED_BOX = [0, 0, 1, 1]
+
+
+def softmax(logits):
+    exp_logits = np.exp(logits)
+    return exp_logits / np.sum(exp_logits, axis=1, keepdims=True)
+
+
+def get_model_inputs(frame_data, one_class):
+    """Get detection scores and gt labels in the format expected by the model
+
+    gt labels are None for frames without ground truth
+    """
+    gt_labels = frame_data.get(nms_net.GT_LABELS)
+    if one_class:
+        dt_probs_ini = frame_data[nms_net.DT_SCORES]
+    elif nms_net.DT_SCORES_ORIGINAL in frame_data:
+        # probabilities and labels without background class are precomputed in frames cache
+        dt_probs_ini = frame_data[nms_net.DT_SCORES_ORIGINAL][:, 1:]
+        gt_labels = frame_data.get(nms_net.GT_LABELS_NO_BG)
+    else:
+        dt_probs_ini = softmax(frame_data[nms_net.DT_SCORES])[:, 1:]
+        if gt_labels is not None:
+            gt_labels = gt_labels - 1
+    return dt_probs_ini, gt_labels
+
+
+def get_feed_dict(nms_model, frames_data, one_class, keep_prob=1.0):
+    """Construct feed dict for a list of frames
+
+    Batched model gets frames padded to the same number of boxes and stacked,
+    padded gt boxes are labelled -1 (matching no class). Single frame is expected otherwise.
+    Ground truth is fed only if the model has gt inputs (i.e. not in inference mode).
+    """
+    frames_inputs = [get_model_inputs(frame_data, one_class) for frame_data in frames_data]
+    feed_gt = nms_model.gt_coords is not None
+
+    if not nms_model.is_batched:
+        dt_probs_ini, gt_labels = frames_inputs[0]
+        frame_data = frames_data[0]
+        feed_dict = {nms_model.dt_coords: frame_data[nms_net.DT_COORDS],
+                     nms_model.dt_features: frame_data[nms_net.DT_FEATURES],
+                     nms_model.dt_probs_ini: dt_probs_ini,
+                     nms_model.keep_prob: keep_prob}
+        if feed_gt:
+            feed_dict[nms_model.gt_coords] = frame_data[nms_net.GT_COORDS]
+            feed_dict[nms_model.gt_labels] = gt_labels
+        return feed_dict
+
+    # padded boxes are [0, 0, 1, 1] (as in KITTI get_frame_data_fixed), zero boxes would give 0/0 IoU
+    dt_coords, dt_mask = batch_utils.pad_and_stack([frame_data[nms_net.DT_COORDS] for frame_data in frames_data],
+                                                   pad_value=PADDED_BOX)
+    dt_features, _ = batch_utils.pad_and_stack([frame_data[nms_net.DT_FEATURES] for frame_data in frames_data])
+    dt_probs_ini, _ = batch_utils.pad_and_stack([inputs[0] for inputs in frames_inputs])
+
+    feed_dict = {nms_model.dt_coords: dt_coords,
+                 nms_model.dt_features: dt_features,
+                 nms_model.dt_probs_ini: dt_probs_ini,
+                 nms_model.dt_mask: dt_mask,
+                 nms_model.keep_prob: keep_prob}
+
+    if feed_gt:
+        feed_dict[nms_model.gt_coords], _ = batch_utils.pad_and_stack(
+            [frame_data[nms_net.GT_COORDS] for frame_data in frames_data])
+        feed_dict[nms_model.gt_labels], _ = batch_utils.pad_and_stack(
+            [inputs[1] for inputs in frames_inputs], pad_value=-1)
+
+    return feed_dict
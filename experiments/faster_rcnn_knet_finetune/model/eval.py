@@ -5,12 +5,7 @@ import numpy as np
 import os
 from nms_network import model as nms_net
 from tools import nms, metrics
-
-
-def softmax(logits):
-    n_classes = logits.shape[1]
-    return np.exp(logits) / np.tile(np.sum(np.exp(logits),
-                                           axis=1).reshape(-1, 1), [1, n_classes])
+from data import get_feed_dict, softmax
 
 
 def eval_model(sess, nnms_model, frames_data,
@@ -37,39 +32,42 @@ def eval_model(sess, nnms_model, frames_data,
 
         frame_data = frames_data[fid]
 
-        if one_class:
-            dt_probs_ini = frame_data[nms_net.DT_SCORES]
-            gt_labels = frame_data[nms_net.GT_LABELS]
-        else:
-            dt_probs_ini = softmax(frame_data[nms_net.DT_SCORES])[:, 1:]
-            gt_labels = frame_data[nms_net.GT_LABELS] - 1
+        feed_dict = get_feed_dict(nnms_model, [frame_data], one_class=one_class, keep_prob=1.0)
+
+        fetches = [nnms_model.class_scores, nnms_model.sigmoid, nnms_model.iou_feature]
+        if nnms_model.mode == 'train':
+            # losses are not part of inference graph
+            fetches += [nnms_model.loss, nnms_model.final_loss]
 
-        feed_dict = {nnms_model.dt_coords: frame_data[nms_net.DT_COORDS],
-                     nnms_model.dt_features: frame_data[nms_net.DT_FEATURES],
-                     nnms_model.dt_probs_ini: dt_probs_ini,
-                     nnms_model.gt_coords: frame_data[nms_net.GT_COORDS],
-                     nnms_model.gt_labels: gt_labels,
-                     nnms_model.keep_prob: 1.0}
+        outputs = sess.run(fetches, feed_dict=feed_dict)
+        inference_filtered, filter_inference, dt_dt_iou = outputs[0:3]
 
-        inference_filtered, filter_inference, loss_opt, loss_final, dt_dt_iou = sess.run(
-            [nnms_model.class_scores, nnms_model.sigmoid,
-             nnms_model.loss, nnms_model.final_loss, nnms_model.iou_feature],
-            feed_dict=feed_dict)
+        if nnms_model.mode == 'train':
+            losses_opt.append(outputs[3])
+            losses_final.append(outputs[4])
+
+        if nnms_model.is_batched:
+            # frame was fed as a mini-batch of size one
+            inference_filtered, filter_inference, dt_dt_iou = \
+                inference_filtered[0], filter_inference[0], dt_dt_iou[0]
+
+        # iou_feature has trailing channel dimension
+        dt_dt_iou = dt_dt_iou[:, :, 0]
 
         nms_inference = 1 - filter_inference
-        nms_labels_np = nms.nms_all_classes(dt_dt_iou, softmax(frame_data[nms_net.DT_SCORES])[:, 1:],
+        nms_labels_np = nms.nms_all_classes(dt_dt_iou, frame_data[nms_net.DT_SCORES_ORIGINAL][:, 1:],
                                             iou_thr=nms_thres)
         nms_labels_np = nms_labels_np.astype('int')
 
+        # class probabilities are precomputed in frames cache
+        inference_orig_all_classes = frame_data[nms_net.DT_SCORES_ORIGINAL]
+
         if one_class:
-            # expecting probability for class being already softmaxed
-            inference_orig_all_classes = frame_data[nms_net.DT_SCORES_ORIGINAL]
             # inference_original = inference_orig_all_classes[:, class_ix].reshape(-1, 1)
             inference_new_all_classes = np.copy(inference_orig_all_classes)
             inference_new_all_classes[:, class_ix] = np.squeeze(filter_inference, axis=1)
         else:
             import ipdb; ipdb.set_trace()
-            inference_orig_all_classes = softmax(frame_data[nms_net.DT_SCORES])
             inference_new_all_classes = np.copy(inference_orig_all_classes)
             inference_new_all_classes[:, 1:] = nms_labels_np
             # inference_original = inference_orig_all_classes
@@ -80,15 +78,16 @@ def eval_model(sess, nnms_model, frames_data,
         eval_data[fid]['inference_orig'] = inference_orig_all_classes
         eval_data[fid]['inference_new'] = inference_new_all_classes
 
-        losses_opt.append(loss_opt)
-        losses_final.append(loss_final)
-
     if full_eval:
         eval_data_file = os.path.join(
             out_dir, 'eval_data_step' + str(global_step) + '.pkl')
         joblib.dump(eval_data, eval_data_file)
         # import ipdb; ipdb.set_trace()
 
+    if len(losses_opt) == 0:
+        # model in inference mode, no losses were computed
+        return None, None
+
     mean_loss_opt = np.mean(losses_opt)
     mean_loss_fin = np.mean(losses_final)
 
@@ -170,7 +169,11 @@ def print_debug_info(nnms_model, sess, frame_data, outdir, fid):
             '_labels_per_patch.png'))
 
     # fRCNN detections
-    plt.imshow(softmax(inference_orig)[:, 1:])
+    if nms_net.DT_SCORES_ORIGINAL in frame_data:
+        # same probabilities as fed to the model, precomputed in frames cache
+        plt.imshow(frame_data[nms_net.DT_SCORES_ORIGINAL][:, 1:])
+    else:
+        plt.imshow(softmax(inference_orig)[:, 1:])
     plt.title('Original fRCNN inference')
     plt.ylabel('detections')
     plt.xlabel('class scores')
@@ -0,0 +1,412 @@
+"""Sharded on-disk cache of per-frame Faster R-CNN data (IoU, labels, etc)
+
+Rows of raw dt_coords / dt_scores / dt_features / gt_coords arrays are grouped
+by frame id with one stable argsort, frames are split into shards of shard_size
+frames and shards are computed by a pool of worker processes:
+
+    build_frames_cache(data_dir, cache_dir, n_bboxes, use_short_features)
+
+Every shard is a directory with one .npy file per field, frames of the shard
+are concatenated along the first axis, with per-frame offsets. LazyFramesData
+memory-maps the files and reads frames on access, keeping recently used
+frames in memory within a memory budget:
+
+    frames_data = LazyFramesData(cache_dir, max_cache_bytes=2 * 1024 ** 3)
+    frame_data = frames_data[fid]
+
+Building is incremental: frames already present in the cache are skipped,
+new frames of raw data are written into new shards.
+"""
+
+import collections
+import logging
+import multiprocessing
+import os
+
+import joblib
+import numpy as np
+import yaml
+
+from nms_network import model as nms_net
+from tools import bbox_utils
+from data import softmax
+
+CACHE_INFO_FILE = 'cache_info.yml'
+# caches of other versions have different set of fields and have to be rebuilt
+CACHE_VERSION = 2
+
+TOTAL_NUMBER_OF_CLASSES = 21
+
+# fields with one row per detection, per gt and per dt-gt pair
+DT_FIELDS = [nms_net.DT_COORDS, nms_net.DT_FEATURES, nms_net.DT_SCORES, nms_net.DT_SCORES_ORIGINAL]
+GT_FIELDS = [nms_net.GT_COORDS, nms_net.GT_LABELS, nms_net.GT_LABELS_NO_BG]
+IOU_FIELD = nms_net.DT_GT_IOU
+# fields with exactly n_bboxes rows per frame
+LABEL_FIELDS = [nms_net.DT_LABELS, nms_net.DT_LABELS_BASIC]
+
+# raw data of the worker process, see _init_worker
+_raw_data = None
+
+
+def load_raw_data(data_dir, use_short_features=False, mmap_mode='r'):
+    """Load raw detection and gt arrays (memory-mapped if saved uncompressed)
+    """
+    if use_short_features:
+        dt_features_path = os.path.join(data_dir, 'dt_features_short.pkl')
+    else:
+        dt_features_path = os.path.join(data_dir, 'dt_features_full.pkl')
+
+    data = {}
+    data[nms_net.DT_COORDS] = joblib.load(os.path.join(data_dir, 'dt_coords.pkl'), mmap_mode=mmap_mode)
+    data[nms_net.DT_SCORES] = joblib.load(os.path.join(data_dir, 'dt_scores.pkl'), mmap_mode=mmap_mode)
+    data[nms_net.DT_FEATURES] = joblib.load(dt_features_path, mmap_mode=mmap_mode)
+    data[nms_net.GT_COORDS] = joblib.load(os.path.join(data_dir, 'gt_coords.pkl'), mmap_mode=mmap_mode)
+    return data
+
+
+def frame_data_from_rows(dt_coords, dt_features, dt_scores, gt_coords, n_bboxes):
+    """Compute frame data from raw rows of a single frame
+
+    Parameters
+    ----------
+    dt_coords - rows [frame_id, x_min, y_min, width, height] of frame detections (at most n_bboxes)
+    dt_features - features of the same detections
+    dt_scores - class scores of the same detections
+    gt_coords - rows [frame_id, x_min, y_min, width, height, class_id] of frame ground truth
+    n_bboxes - number of detections per frame, labels are padded to it
+
+    Returns
+    -------
+    frame data dict, besides raw data it has class probabilities (softmax of scores)
+    and gt labels shifted to exclude background class, as the model takes them
+    """
+    frame_data = {}
+    frame_data[nms_net.DT_COORDS] = dt_coords[:, 1:]
+    frame_data[nms_net.DT_FEATURES] = dt_features
+    frame_data[nms_net.DT_SCORES] = dt_scores
+    frame_data[nms_net.DT_SCORES_ORIGINAL] = softmax(dt_scores)
+    frame_data[nms_net.GT_COORDS] = gt_coords[:, 1:5]
+    frame_data[nms_net.GT_LABELS] = gt_coords[:, 5]
+    frame_data[nms_net.GT_LABELS_NO_BG] = gt_coords[:, 5] - 1
+    frame_data[nms_net.DT_GT_IOU] = bbox_utils.compute_sets_iou(
+        frame_data[nms_net.DT_COORDS], frame_data[nms_net.GT_COORDS])
+    frame_data[nms_net.DT_LABELS] = np.zeros([n_bboxes, TOTAL_NUMBER_OF_CLASSES])
+    frame_data[nms_net.DT_LABELS_BASIC] = np.zeros([n_bboxes, TOTAL_NUMBER_OF_CLASSES])
+    n_dt = frame_data[nms_net.DT_GT_IOU].shape[0]
+    frame_data[nms_net.DT_LABELS][0:n_dt] = bbox_utils.compute_best_iou_all_classes(
+        frame_data[nms_net.DT_GT_IOU], frame_data[nms_net.GT_LABELS], TOTAL_NUMBER_OF_CLASSES)
+    for class_id in range(0, TOTAL_NUMBER_OF_CLASSES):
+        class_gt_boxes = frame_data[nms_net.GT_LABELS] == class_id
+        class_dt_gt = frame_data[nms_net.DT_GT_IOU][:, class_gt_boxes]
+        if class_dt_gt.shape[1] != 0:
+            # frames with less than n_bboxes detections have padded label rows
+            frame_data[nms_net.DT_LABELS_BASIC][0:n_dt, class_id][
+                np.max(class_dt_gt, axis=1) > 0.5] = 1
+    return frame_data
+
+
+def group_rows_by_frame(frame_col, fids, max_rows=None):
+    """Find rows of every frame with one stable argsort of the frame id column
+
+    Parameters
+    ----------
+    frame_col - frame id of every row
+    fids - frame ids to find rows for
+    max_rows - if not None, only first max_rows rows of every frame are taken
+
+    Returns
+    -------
+    order - row indices sorted by frame id, rows of a frame keep their original order
+    starts, ends - rows of fids[i] are order[starts[i]:ends[i]]
+    """
+    order = np.argsort(frame_col, kind='mergesort')
+    sorted_col = frame_col[order]
+    starts = np.searchsorted(sorted_col, fids, side='left')
+    ends = np.searchsorted(sorted_col, fids, side='right')
+    if max_rows is not None:
+        ends = np.minimum(ends, starts + max_rows)
+    return order, starts, ends
+
+
+def _init_worker(data_dir, use_short_features):
+    global _raw_data
+    _raw_data = load_raw_data(data_dir, use_short_features=use_short_features)
+
+
+def _shard_file(shard_dir, name):
+    return os.path.join(shard_dir, name + '.npy')
+
+
+def _offsets(counts):
+    return np.hstack([0, np.cumsum(counts)]).astype(np.int64)
+
+
+def _build_shard(task):
+    """Compute frames of one shard and save them, runs in worker process
+    """
+    shard_dir, fids, dt_bounds, gt_bounds, dt_order, gt_order, n_bboxes = task
+
+    dt_fields = {nms_net.DT_COORDS: _raw_data[nms_net.DT_COORDS][dt_order],
+                 nms_net.DT_FEATURES: _raw_data[nms_net.DT_FEATURES][dt_order],
+                 nms_net.DT_SCORES: _raw_data[nms_net.DT_SCORES][dt_order]}
+    gt_coords = _raw_data[nms_net.GT_COORDS][gt_order]
+
+    shard_fields = {name: [] for name in DT_FIELDS + GT_FIELDS + LABEL_FIELDS + [IOU_FIELD]}
+
+    for frame_ix in range(0, len(fids)):
+        dt_start, dt_end = dt_bounds[frame_ix], dt_bounds[frame_ix + 1]
+        gt_start, gt_end = gt_bounds[frame_ix], gt_bounds[frame_ix + 1]
+        frame_data = frame_data_from_rows(dt_fields[nms_net.DT_COORDS][dt_start:dt_end],
+                                          dt_fields[nms_net.DT_FEATURES][dt_start:dt_end],
+                                          dt_fields[nms_net.DT_SCORES][dt_start:dt_end],
+                                          gt_coords[gt_start:gt_end],
+                                          n_bboxes)
+        for name in shard_fields:
+            shard_fields[name].append(frame_data[name])
+
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    for name in shard_fields:
+        if name == IOU_FIELD:
+            shard_array = np.hstack([arr.reshape(-1) for arr in shard_fields[name]])
+        else:
+            shard_array = np.concatenate(shard_fields[name])
+        np.save(_shard_file(shard_dir, name), shard_array)
+
+    n_dt = np.diff(dt_bounds)
+    n_gt = np.diff(gt_bounds)
+    np.save(_shard_file(shard_dir, 'frame_ids'), fids)
+    np.save(_shard_file(shard_dir, 'dt_offsets'), _offsets(n_dt))
+    np.save(_shard_file(shard_dir, 'gt_offsets'), _offsets(n_gt))
+    np.save(_shard_file(shard_dir, 'iou_offsets'), _offsets(n_dt * n_gt))
+
+    return shard_dir, len(fids)
+
+
+def _read_cache_info(cache_dir):
+    cache_info_path = os.path.join(cache_dir, CACHE_INFO_FILE)
+    if not os.path.exists(cache_info_path):
+        return None
+    with open(cache_info_path, 'r') as f:
+        return yaml.load(f)
+
+
+def _check_cache_version(cache_dir, cache_info):
+    if cache_info.get('version', 1) != CACHE_VERSION:
+        raise ValueError('cache %s was built by older version of frames_cache, '
+                         'delete it to rebuild' % cache_dir)
+
+
+def cache_exists(cache_dir):
+    return _read_cache_info(cache_dir) is not None
+
+
+def _cached_frame_ids(cache_dir, shards):
+    if len(shards) == 0:
+        return np.zeros(0, dtype=int)
+    return np.hstack([np.load(_shard_file(os.path.join(cache_dir, shard), 'frame_ids')) for shard in shards])
+
+
+def build_frames_cache(data_dir,
+                       cache_dir,
+                       n_bboxes,
+                       use_short_features=False,
+                       shard_size=500,
+                       n_workers=None):
+    """Compute frame data for all frames of raw data not yet in the cache
+
+    Parameters
+    ----------
+    data_dir - directory with raw dt_coords.pkl, dt_scores.pkl, dt_features_*.pkl, gt_coords.pkl
+    cache_dir - cache directory, created if doesn't exist
+    n_bboxes - maximum number of detections per frame
+    use_short_features - use dt_features_short.pkl instead of dt_features_full.pkl
+    shard_size - number of frames per shard
+    n_workers - number of worker processes, all cpus if None
+
+    Returns
+    -------
+    number of frames added to the cache
+    """
+    cache_info = _read_cache_info(cache_dir)
+    if cache_info is None:
+        cache_info = {'n_bboxes': n_bboxes, 'use_short_features': use_short_features, 'shards': [],
+                      'version': CACHE_VERSION}
+    else:
+        _check_cache_version(cache_dir, cache_info)
+    if (cache_info['n_bboxes'], cache_info['use_short_features']) != (n_bboxes, use_short_features):
+        raise ValueError('cache %s was built with n_bboxes=%d, use_short_features=%s' %
+                         (cache_dir, cache_info['n_bboxes'], str(cache_info['use_short_features'])))
+
+    data = load_raw_data(data_dir, use_short_features=use_short_features)
+    dt_frame_col = np.asarray(data[nms_net.DT_COORDS][:, 0]).astype(int)
+    gt_frame_col = np.asarray(data[nms_net.GT_COORDS][:, 0]).astype(int)
+
+    all_fids = np.unique(np.hstack([dt_frame_col, gt_frame_col]))
+    new_fids = np.setdiff1d(all_fids, _cached_frame_ids(cache_dir, cache_info['shards']))
+
+    if len(new_fids) == 0:
+        logging.info('all %d frames are already cached' % len(all_fids))
+        return 0
+
+    logging.info('computing frame data for %d new frames' % len(new_fids))
+
+    dt_order, dt_starts, dt_ends = group_rows_by_frame(dt_frame_col, new_fids, max_rows=n_bboxes)
+    gt_order, gt_starts, gt_ends = group_rows_by_frame(gt_frame_col, new_fids)
+
+    tasks = []
+    first_shard_ix = len(cache_info['shards'])
+    for task_ix, shard_start in enumerate(range(0, len(new_fids), shard_size)):
+        shard_end = min(shard_start + shard_size, len(new_fids))
+        shard_dt_rows = [dt_order[dt_starts[i]:dt_ends[i]] for i in range(shard_start, shard_end)]
+        shard_gt_rows = [gt_order[gt_starts[i]:gt_ends[i]] for i in range(shard_start, shard_end)]
+        tasks.append((os.path.join(cache_dir, 'shard_%05d' % (first_shard_ix + task_ix)),
+                      new_fids[shard_start:shard_end],
+                      _offsets([len(rows) for rows in shard_dt_rows]),
+                      _offsets([len(rows) for rows in shard_gt_rows]),
+                      np.hstack(shard_dt_rows).astype(int),
+                      np.hstack(shard_gt_rows).astype(int),
+                      n_bboxes))
+
+    # workers load raw data themselves (memory-mapped), only row indices are sent to them
+    del data
+    pool = multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(data_dir, use_short_features))
+    try:
+        n_done = 0
+        for shard_dir, n_shard_frames in pool.imap(_build_shard, tasks):
+            n_done += n_shard_frames
+            # shards are registered as soon as they are written, interrupted build keeps finished shards
+            cache_info['shards'].append(os.path.basename(shard_dir))
+            with open(os.path.join(cache_dir, CACHE_INFO_FILE), 'w') as f:
+                yaml.dump(cache_info, f, default_flow_style=False)
+            logging.info('%d / %d frames cached' % (n_done, len(new_fids)))
+    finally:
+        pool.terminate()
+
+    return len(new_fids)
+
+
+def _frame_bytes(frame_data):
+    return sum([arr.nbytes for arr in frame_data.values()])
+
+
+class LazyFramesData:
+
+    def __init__(self, cache_dir, transform=None, max_cache_bytes=2 * 1024 ** 3, mmap_mode='r'):
+        """Dict-like read-only container of cached frames, frames are read from disk on access
+
+        Accessed frames are copied into memory, passed through transform and kept
+        in LRU cache until their total size exceeds max_cache_bytes.
+
+        Parameters
+        ----------
+        cache_dir - directory produced by build_frames_cache
+        transform - function frame_data -> frame_data applied to every frame when it's read
+        max_cache_bytes - memory budget for frames kept in memory
+        mmap_mode - mode shard files are memory-mapped with
+        """
+        cache_info = _read_cache_info(cache_dir)
+        if cache_info is None:
+            raise ValueError('no frames data cache in %s' % cache_dir)
+        _check_cache_version(cache_dir, cache_info)
+
+        self.n_bboxes = cache_info['n_bboxes']
+        self.transform = transform
+        self.max_cache_bytes = max_cache_bytes
+
+        self.shards = []
+        self.frame_location = {}
+
+        for shard_ix, shard in enumerate(cache_info['shards']):
+            shard_dir = os.path.join(cache_dir, shard)
+            shard_data = {name: np.load(_shard_file(shard_dir, name), mmap_mode=mmap_mode)
+                          for name in DT_FIELDS + GT_FIELDS + LABEL_FIELDS + [IOU_FIELD]}
+            for offsets_name in ['dt_offsets', 'gt_offsets', 'iou_offsets']:
+                shard_data[offsets_name] = np.load(_shard_file(shard_dir, offsets_name))
+            self.shards.append(shard_data)
+            for frame_ix, fid in enumerate(np.load(_shard_file(shard_dir, 'frame_ids'))):
+                self.frame_location[int(fid)] = (shard_ix, frame_ix)
+
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+
+    def __len__(self):
+        return len(self.frame_location)
+
+    def __contains__(self, fid):
+        return fid in self.frame_location
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return sorted(self.frame_location.keys())
+
+    def read_field(self, fid, name):
+        """Single field of frame as stored in cache (view of the shard, transform is not applied)
+        """
+        shard_ix, frame_ix = self.frame_location[fid]
+        shard_data = self.shards[shard_ix]
+        dt_start, dt_end = shard_data['dt_offsets'][frame_ix:frame_ix + 2]
+        gt_start, gt_end = shard_data['gt_offsets'][frame_ix:frame_ix + 2]
+        if name in DT_FIELDS:
+            return shard_data[name][dt_start:dt_end]
+        elif name in GT_FIELDS:
+            return shard_data[name][gt_start:gt_end]
+        elif name in LABEL_FIELDS:
+            return shard_data[name][frame_ix * self.n_bboxes:(frame_ix + 1) * self.n_bboxes]
+        else:
+            iou_start, iou_end = shard_data['iou_offsets'][frame_ix:frame_ix + 2]
+            return shard_data[name][iou_start:iou_end].reshape(dt_end - dt_start, gt_end - gt_start)
+
+    def __getitem__(self, fid):
+        if fid in self._cache:
+            frame_data = self._cache.pop(fid)
+            self._cache[fid] = frame_data
+            return frame_data
+
+        if fid not in self.frame_location:
+            raise KeyError(fid)
+
+        frame_data = {name: np.array(self.read_field(fid, name))
+                      for name in DT_FIELDS + GT_FIELDS + LABEL_FIELDS + [IOU_FIELD]}
+        if self.transform is not None:
+            frame_data = self.transform(frame_data)
+
+        self._cache[fid] = frame_data
+        self._cache_bytes += _frame_bytes(frame_data)
+        # least recently used frames are dropped, the requested one is always kept
+        while self._cache_bytes > self.max_cache_bytes and len(self._cache) > 1:
+            _, dropped_frame_data = self._cache.popitem(last=False)
+            self._cache_bytes -= _frame_bytes(dropped_frame_data)
+
+        return frame_data
+
+
+class FramesSelection:
+
+    def __init__(self, frames):
+        """Dict-like container of frames taken from other containers, renumbered from 0
+
+        Parameters
+        ----------
+        frames - list of pairs (frames_data, fid), frame i of selection is frames_data[fid]
+        """
+        self.frames = frames
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, fid):
+        return 0 <= fid < len(self.frames)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return range(0, len(self.frames))
+
+    def __getitem__(self, fid):
+        frames_data, source_fid = self.frames[fid]
+        return frames_data[source_fid]
@@ -16,8 +16,9 @@ from functools import partial
 from timeit import default_timer as timer
 
 import eval
+import data
+import frames_cache
 import gflags
-import joblib
 import ntpath
 import numpy as np
 import os
@@ -26,12 +27,12 @@ import tensorflow as tf
 import yaml
 from google.apputils import app
 from nms_network import model as nms_net
-from tools import bbox_utils
 from tools import experiment_config as expconf
 
 gflags.DEFINE_string('data_dir', None, 'directory containing train data')
 gflags.DEFINE_string('log_dir', None, 'directory to save logs and trained models')
 gflags.DEFINE_string('config_path', None, 'config with main model params')
+gflags.DEFINE_bool('update_frames_cache', False, 'add frames of raw data missing in frames data cache')
 
 FLAGS = gflags.FLAGS
 
@@ -52,100 +53,57 @@ CLASSES = ['__background__', # always index 0
            'sheep', 'sofa', 'train', 'tvmonitor']
 
 
-def get_frame_data(fid, data, n_bboxes):
-    frame_data = {}
-    fid_dt_ix = data[nms_net.DT_COORDS][:, 0] == fid
-    frame_data[nms_net.DT_COORDS] = data[nms_net.DT_COORDS][fid_dt_ix, 1:][0:n_bboxes]
-    frame_data[nms_net.DT_FEATURES] = data[nms_net.DT_FEATURES][fid_dt_ix][0:n_bboxes]
-    frame_data[nms_net.DT_SCORES] = data[nms_net.DT_SCORES][fid_dt_ix][0:n_bboxes]
-    fid_gt_ix = data[nms_net.GT_COORDS][:, 0] == fid
-    frame_data[nms_net.GT_COORDS] = data[nms_net.GT_COORDS][fid_gt_ix, 1:5]
-    frame_data[nms_net.GT_LABELS] = data[nms_net.GT_COORDS][fid_gt_ix, 5]
-    frame_data[nms_net.DT_GT_IOU] = bbox_utils.compute_sets_iou(
-        frame_data[nms_net.DT_COORDS], frame_data[nms_net.GT_COORDS])
-    # frame_data[nnms.DT_DT_IOU] = bbox_utils.compute_sets_iou(frame_data[nnms.DT_COORDS], frame_data[nnms.DT_COORDS])
-    frame_data[nms_net.DT_LABELS] = np.zeros([n_bboxes, TOTAL_NUMBER_OF_CLASSES])
-    frame_data[nms_net.DT_LABELS_BASIC] = np.zeros([n_bboxes, TOTAL_NUMBER_OF_CLASSES])
-    for class_id in range(0, TOTAL_NUMBER_OF_CLASSES):
-        class_gt_boxes = frame_data[nms_net.GT_LABELS] == class_id
-        class_dt_gt = frame_data[nms_net.DT_GT_IOU][:, class_gt_boxes]
-        if class_dt_gt.shape[1] != 0:
-            frame_data[nms_net.DT_LABELS][:, class_id] = np.max(
-                bbox_utils.compute_best_iou(class_dt_gt), axis=1)
-            frame_data[nms_net.DT_LABELS_BASIC][:, class_id][
-                np.max(class_dt_gt, axis=1) > 0.5] = 1
-    # logging.info('finished processing frame %d' % fid)
-    return frame_data
-
-
-def softmax(logits):
-    n_classes = logits.shape[1]
-    return np.exp(logits) / np.tile(np.sum(np.exp(logits),
-                                           axis=1).reshape(-1, 1), [1, n_classes])
-
-def generate_frame_probs(frames_data):
-    gt_cnt = np.zeros([1, len(frames_data)])
-    for fid, data in frames_data.iteritems():
-        gt_cnt[0, fid] = len(frames_data[fid][nms_net.GT_LABELS])
-    frame_probs = softmax(gt_cnt)
-    return frame_probs
-
-def split_by_frames(data, n_bboxes):
-    unique_fids = np.unique(np.hstack([data[nms_net.DT_COORDS][:, 0], data[nms_net.GT_COORDS][:, 0]])).astype(int)
-    get_frame_data_partial = partial(get_frame_data, data=data, n_bboxes=n_bboxes)
-    frames_data_train = dict(
-        zip(unique_fids, map(get_frame_data_partial, unique_fids)))
-    return frames_data_train
-
-
-def preprocess_data(data_dir, n_bboxes, use_short_features=False):
-    if use_short_features:
-        dt_features_path = os.path.join(data_dir, 'dt_features_short.pkl')
-    else :
-        dt_features_path = os.path.join(data_dir, 'dt_features_full.pkl')
-
-    data = {}
-
-    data[nms_net.DT_COORDS] = joblib.load(os.path.join(data_dir, 'dt_coords.pkl'))
-    data[nms_net.DT_SCORES] = joblib.load(os.path.join(data_dir, 'dt_scores.pkl'))
-    data[nms_net.DT_FEATURES] = joblib.load(os.path.join(data_dir, dt_features_path))
-    data[nms_net.GT_COORDS] = joblib.load(os.path.join(data_dir, 'gt_coords.pkl'))
-    logging.info('finished loading data')
-    frames_data_train = split_by_frames(data, n_bboxes)
-
-    return frames_data_train
-
-
 def select_one_class(frame_data, class_id):
     selected_ix = np.where(frame_data[nms_net.GT_LABELS] == class_id)[0]
     frame_data[nms_net.GT_LABELS] = np.zeros(len(selected_ix))
     frame_data[nms_net.GT_COORDS] = frame_data[nms_net.GT_COORDS][selected_ix]
     frame_data[nms_net.DT_GT_IOU] = frame_data[nms_net.DT_GT_IOU][:, selected_ix]
-    frame_data[nms_net.DT_SCORES_ORIGINAL] = softmax(frame_data[nms_net.DT_SCORES])
+    # labels without background class make no sense for one class
+    del frame_data[nms_net.GT_LABELS_NO_BG]
+    # class probabilities (DT_SCORES_ORIGINAL) are precomputed in frames cache
     frame_data[nms_net.DT_SCORES] = frame_data[nms_net.DT_SCORES_ORIGINAL][:, class_id].reshape([-1, 1])
-    frame_data[nms_net.DT_FEATURES][:, 0:21] = frame_data[nms_net.DT_SCORES_ORIGINAL]
+    # cached features are read-only, class scores part is replaced in a copy
+    frame_data[nms_net.DT_FEATURES] = np.hstack([frame_data[nms_net.DT_SCORES_ORIGINAL],
+                                                 frame_data[nms_net.DT_FEATURES][:, 21:]])
     return frame_data
 
 
-def load_data(data_dir, n_bboxes, use_short_features=False, one_class=False, class_id=0):
+def load_data(data_dir, n_bboxes, use_short_features=False, one_class=False, class_id=0, update_cache=False,
+              max_cache_mb=2048):
     if use_short_features:
-        frames_data_cache_file = os.path.join(data_dir, 'frames_data_short_' + str(n_bboxes) + '.pkl')
-    else:
-        frames_data_cache_file = os.path.join(data_dir, 'frames_data_full_' + str(n_bboxes) + '.pkl')
-    if os.path.exists(frames_data_cache_file):
-        logging.info('loading frame bbox data info from cash..')
-        frames_data = joblib.load(frames_data_cache_file)
+        frames_data_cache_dir = os.path.join(data_dir, 'frames_data_short_' + str(n_bboxes))
     else:
+        frames_data_cache_dir = os.path.join(data_dir, 'frames_data_full_' + str(n_bboxes))
+    if update_cache or not frames_cache.cache_exists(frames_data_cache_dir):
         logging.info(
             'computing frame bbox data (IoU, labels, etc) - this could take some time..')
-        frames_data = preprocess_data(data_dir, n_bboxes, use_short_features=use_short_features)
-        joblib.dump(frames_data, frames_data_cache_file)
+        frames_cache.build_frames_cache(data_dir, frames_data_cache_dir, n_bboxes,
+                                        use_short_features=use_short_features)
+    logging.info('loading frame bbox data info from cash..')
+    # frames are read on access, one class selection is applied to every frame read
     if one_class:
-        for fid in frames_data.keys():
-            frames_data[fid] = select_one_class(frames_data[fid], class_id)
+        transform = partial(select_one_class, class_id=class_id)
+    else:
+        transform = None
+    frames_data = frames_cache.LazyFramesData(frames_data_cache_dir,
+                                              transform=transform,
+                                              max_cache_bytes=max_cache_mb * 1024 ** 2)
     return frames_data
 
 
+def count_gt_instances(frames_data, one_class=False, class_id=0):
+    """Number of gt objects (of class_id if one_class), counted without reading whole frames
+    """
+    n_instances = 0
+    for fid in frames_data.keys():
+        gt_labels = frames_data.read_field(fid, nms_net.GT_LABELS)
+        if one_class:
+            n_instances += np.sum(gt_labels == class_id)
+        else:
+            n_instances += len(gt_labels)
+    return n_instances
+
+
 def shuffle_samples(n_frames):
     return np.random.choice(n_frames, n_frames, replace=False)
 
@@ -163,31 +121,42 @@ def write_scalar_summary(value, name, summary_writer, step_id):
 
 
 def input_ops(n_classes,
-              n_dt_features):
+              n_dt_features,
+              batched=False):
 
     input_dict = {}
     n_dt_coords = 4
+
+    # mini-batches of frames get additional leading dimension
+    batch_shape = [None] if batched else []
+
     input_dict['dt_coords'] = tf.placeholder(
-        tf.float32, shape=[
+        tf.float32, shape=batch_shape + [
                 None, n_dt_coords])
 
     input_dict['dt_features'] = tf.placeholder(tf.float32,
-                                 shape=[
+                                 shape=batch_shape + [
                                      None,
                                      n_dt_features],
                                                name='dt_features')
 
     input_dict['dt_probs'] = tf.placeholder(tf.float32,
-                                 shape=[
+                                 shape=batch_shape + [
                                      None,
                                      n_classes],
                                             name='dt_probs')
 
-    input_dict['gt_coords'] = tf.placeholder(tf.float32, shape=[None, 4],
+    input_dict['gt_coords'] = tf.placeholder(tf.float32, shape=batch_shape + [None, 4],
                                              name='gt_coords')
 
-    input_dict['gt_labels'] = tf.placeholder(tf.float32, shape=None,
-                                             name='gt_labels')
+    if batched:
+        input_dict['gt_labels'] = tf.placeholder(tf.float32, shape=[None, None],
+                                                 name='gt_labels')
+        input_dict['dt_mask'] = tf.placeholder(tf.float32, shape=[None, None],
+                                               name='dt_mask')
+    else:
+        input_dict['gt_labels'] = tf.placeholder(tf.float32, shape=None,
+                                                 name='gt_labels')
 
     input_dict['keep_prob'] = tf.placeholder(tf.float32,
                                              name='keep_prob')
@@ -196,21 +165,16 @@ def input_ops(n_classes,
 
 
 def shuffle_train_test(frames_data_train, frames_data_test):
-    all_frames = frames_data_train.copy()
-    n_frames_train = len(frames_data_train)
-    for fid, data in frames_data_test.iteritems():
-        all_frames[n_frames_train+fid] = data
+    all_frames = [(frames_data_train, fid) for fid in frames_data_train.keys()] + \
+                 [(frames_data_test, fid) for fid in frames_data_test.keys()]
     n_frames_all = len(all_frames)
     shuffled_fids = shuffle_samples(n_frames_all)
     # half = n_frames_all / 2
     train_fids = shuffled_fids[0:9000]
     test_fids = shuffled_fids[9000:]
-    train = {}
-    test = {}
-    for i, fid in enumerate(train_fids):
-        train[i] = all_frames[fid]
-    for i, fid in enumerate(test_fids):
-        test[i] = all_frames[fid]
+    # frames are selected without reading them
+    train = frames_cache.FramesSelection([all_frames[fid] for fid in train_fids])
+    test = frames_cache.FramesSelection([all_frames[fid] for fid in test_fids])
     return train, test
 
 
@@ -244,11 +208,11 @@ def main(_):
                                   n_bboxes=config.n_bboxes,
                                   use_short_features=config.use_reduced_fc_features,
                                   one_class=is_one_class,
-                                  class_id=class_ix)
+                                  class_id=class_ix,
+                                  update_cache=FLAGS.update_frames_cache,
+                                  max_cache_mb=config.frames_cache_mb)
 
-    train_class_instances = 0
-    for fid in frames_data_train.keys():
-        train_class_instances += len(frames_data_train[fid]['gt_labels'])
+    train_class_instances = count_gt_instances(frames_data_train, one_class=is_one_class, class_id=class_ix)
     logging.info("number of gt objects of class %s in train : %d" % (class_of_interest, train_class_instances))
 
     logging.info('test..')
@@ -256,10 +220,10 @@ def main(_):
                                  n_bboxes=config.n_bboxes,
                                  use_short_features=config.use_reduced_fc_features,
                                  one_class=is_one_class,
-                                 class_id=class_ix)
-    test_class_instances = 0
-    for fid in frames_data_test.keys():
-        test_class_instances += len(frames_data_test[fid]['gt_labels'])
+                                 class_id=class_ix,
+                                 update_cache=FLAGS.update_frames_cache,
+                                 max_cache_mb=config.frames_cache_mb)
+    test_class_instances = count_gt_instances(frames_data_test, one_class=is_one_class, class_id=class_ix)
     logging.info("number of gt objects of class %s in test : %d" % (class_of_interest, test_class_instances))
 
     if config.shuffle_train_test:
@@ -274,7 +238,8 @@ def main(_):
 
     n_dt_features = frames_data_train[0][nms_net.DT_FEATURES].shape[1]
 
-    in_ops = input_ops(n_classes=n_classes, n_dt_features=n_dt_features)
+    in_ops = input_ops(n_classes=n_classes, n_dt_features=n_dt_features,
+                       batched=config.batch_size > 1)
 
     nnms_model = nms_net.NMSNetwork(n_classes=n_classes,
                                     input_ops=in_ops,
@@ -308,14 +273,14 @@ def main(_):
         # nnms_model.switch_loss('nms')
         # logging.info("current loss mode : %s" % loss_mode)
 
-        # train_frame_probs = np.squeeze(generate_frame_probs(frames_data_train), axis=0)
-
         logging.info('training started..')
         for epoch_id in range(0, config.n_epochs):
 
             step_times = []
 
-            for fid in shuffle_samples(n_frames_train):
+            epoch_fids = shuffle_samples(n_frames_train)
+
+            for batch_start in range(0, n_frames_train, config.batch_size):
 
                 # if step_id == config.loss_change_step:
                 #     learning_rate = config.learning_rate_det
@@ -323,21 +288,12 @@ def main(_):
                 #     nnms_model.switch_loss('detection')
                 #     logging.info('switching loss to actual detection loss..')
 
-                frame_data = frames_data_train[fid]
+                batch_frames_data = [frames_data_train[fid] for fid in
+                                     epoch_fids[batch_start:batch_start+config.batch_size]]
 
-                if n_classes == 1:
-                    dt_probs_ini = frame_data[nms_net.DT_SCORES]
-                    gt_labels = frame_data[nms_net.GT_LABELS]
-                else:
-                    dt_probs_ini = softmax(frame_data[nms_net.DT_SCORES])[:, 1:]
-                    gt_labels = frame_data[nms_net.GT_LABELS] - 1
-
-                feed_dict = {nnms_model.dt_coords: frame_data[nms_net.DT_COORDS],
-                             nnms_model.dt_features: frame_data[nms_net.DT_FEATURES],
-                             nnms_model.dt_probs_ini: dt_probs_ini,
-                             nnms_model.gt_coords: frame_data[nms_net.GT_COORDS],
-                             nnms_model.gt_labels: gt_labels,
-                             nnms_model.keep_prob: config.keep_prob_train}
+                feed_dict = data.get_feed_dict(nnms_model, batch_frames_data,
+                                               one_class=(n_classes == 1),
+                                               keep_prob=config.keep_prob_train)
 
                 start_step = timer()
 
@@ -0,0 +1,49 @@
+"""Build frame store (see frame_store.py) for train and val frames of KITTI MS-CNN experiment
+
+"""
+
+import logging
+import os
+
+import gflags
+import numpy as np
+import yaml
+from google.apputils import app
+
+from frame_store import build_frame_store
+
+gflags.DEFINE_string('data_dir', None, 'KITTI directory containing label_2, detection_2, train.txt and val.txt')
+gflags.DEFINE_string('store_dir', None, 'directory to save frame store to')
+gflags.DEFINE_string('config_path', None, 'experiment config (data_provider section defines store contents)')
+
+FLAGS = gflags.FLAGS
+
+
+def main(_):
+
+    logging.basicConfig(format='%(asctime)s : %(message)s', level=logging.INFO)
+
+    with open(FLAGS.config_path, 'r') as f:
+        config = yaml.load(f)
+
+    dp_config = config.get('data_provider', {})
+    class_name = config.get('general', {}).get('class_of_interest', 'Car')
+
+    frame_ids = np.hstack([np.loadtxt(os.path.join(FLAGS.data_dir, 'train.txt'), dtype=int),
+                           np.loadtxt(os.path.join(FLAGS.data_dir, 'val.txt'), dtype=int)])
+
+    build_frame_store(frame_ids,
+                      labels_dir=os.path.join(FLAGS.data_dir, 'label_2'),
+                      detections_dir=os.path.join(FLAGS.data_dir, 'detection_2'),
+                      store_dir=FLAGS.store_dir,
+                      n_detections=dp_config.get('n_bboxes', 20),
+                      n_features=dp_config.get('n_features', 100),
+                      class_name=class_name)
+    return
+
+
+if __name__ == '__main__':
+    gflags.mark_flag_as_required('data_dir')
+    gflags.mark_flag_as_required('store_dir')
+    gflags.mark_flag_as_required('config_path')
+    app.run()
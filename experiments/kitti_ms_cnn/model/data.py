@@ -3,6 +3,7 @@ import scipy.io as sio
 import numpy as np
 import os
 from tools import bbox_utils
+from tools import batch_utils
 from tools import nms
 
 
@@ -143,6 +144,9 @@ def get_frame_data_fixed(frame_id,
     frame_data['dt_coords'][:, 3] = 1
     frame_data['dt_coords'][0:n_detections_actual] = dt_info['detection_result'][0, 0][0:n_detections_actual, 0:4]
 
+    frame_data['dt_mask'] = np.zeros(n_detections)
+    frame_data['dt_mask'][0:n_detections_actual] = 1
+
     # convert x,y,w,h -> x_min, y_min, x_max, y_max
     frame_data['dt_coords'][:, 2] = frame_data['dt_coords'][:, 0] + frame_data['dt_coords'][:, 2]
     frame_data['dt_coords'][:, 3] = frame_data['dt_coords'][:, 1] + frame_data['dt_coords'][:, 3]
@@ -159,3 +163,45 @@ def get_frame_data_fixed(frame_id,
     #                                                       iou_thr=0.5)).astype('int')
 
     return frame_data
+
+
+def stack_frames(frames_data):
+    """
+    Packs list of fixed size frames into a mini-batch for batched NMSNetwork
+
+    Detections are already padded to the same size by get_frame_data_fixed,
+    ground truth is padded with label -1 (matches no class).
+    """
+    batch_data = {}
+    for key in ['dt_coords', 'dt_features', 'dt_probs', 'dt_mask']:
+        batch_data[key] = np.stack([frame_data[key] for frame_data in frames_data])
+    batch_data['gt_coords'], _ = batch_utils.pad_and_stack([frame_data['gt_coords'] for frame_data in frames_data])
+    batch_data['gt_labels'], _ = batch_utils.pad_and_stack([frame_data['gt_labels'] for frame_data in frames_data],
+                                                           pad_value=-1)
+    return batch_data
+
+
+def get_feed_dict(nms_model, frames_data, keep_prob=1.0):
+    """
+    Constructs feed dict for a list of frames (stacked into mini-batch for batched model,
+    single frame is expected otherwise)
+    """
+    if nms_model.is_batched:
+        frame_data = stack_frames(frames_data)
+    else:
+        frame_data = frames_data[0]
+
+    feed_dict = {nms_model.dt_coords: frame_data['dt_coords'],
+                 nms_model.dt_features: frame_data['dt_features'],
+                 nms_model.dt_probs_ini: frame_data['dt_probs'],
+                 nms_model.keep_prob: keep_prob}
+
+    # inference mode model may have no ground truth inputs
+    if nms_model.gt_coords is not None:
+        feed_dict[nms_model.gt_coords] = frame_data['gt_coords']
+        feed_dict[nms_model.gt_labels] = frame_data['gt_labels']
+
+    if nms_model.is_batched:
+        feed_dict[nms_model.dt_mask] = frame_data['dt_mask']
+
+    return feed_dict
@@ -1,4 +1,5 @@
 import logging
+from timeit import default_timer as timer
 
 import joblib
 import numpy as np
@@ -6,7 +7,7 @@ import pandas as pd
 import os
 from nms_network import model as nms_net
 from tools import nms, metrics
-from data import get_frame_data_fixed
+from data import get_frame_data_fixed, get_feed_dict
 
 def softmax(logits):
     n_classes = logits.shape[1]
@@ -40,6 +41,12 @@ def eval_model(sess,
     eval_data_filter_only = []
     eval_data_oracle = []
     info_data_all = []
+    eval_data_baselines = {'softnms_linear': [], 'softnms_gaussian': [], 'wbf': []}
+    # per-frame processing time of knet and classical baselines, seconds
+    frame_times = {'fnet': [], 'nms': [], 'softnms_linear': [], 'softnms_gaussian': [], 'wbf': []}
+
+    # losses and oracle labels are available only in train mode graph
+    has_gt_ops = nnms_model.mode == 'train'
 
     for fid in eval_frames:
 
@@ -50,25 +57,54 @@ def eval_model(sess,
                                     class_name=class_name,
                                     n_features=n_features)
 
-        feed_dict = {nnms_model.dt_coords: frame_data['dt_coords'],
-                     nnms_model.dt_features: frame_data['dt_features'],
-                     nnms_model.dt_probs_ini: frame_data['dt_probs'],
-                     nnms_model.gt_coords: frame_data['gt_coords'],
-                     nnms_model.gt_labels: frame_data['gt_labels'],
-                     nnms_model.keep_prob: 1.0}
+        feed_dict = get_feed_dict(nnms_model, [frame_data], keep_prob=1.0)
 
         inference_orig = frame_data['dt_probs']
         inference_orig_all.append(inference_orig)
 
-        inference_filtered, inference_filter, inference_oracle,  dt_dt_iou, opt_loss, fin_loss = sess.run(
-            [nnms_model.class_scores, nnms_model.sigmoid, nnms_model.det_labels,
-             nnms_model.iou_feature, nnms_model.loss, nnms_model.final_loss], feed_dict=feed_dict)
+        fetches = [nnms_model.class_scores, nnms_model.sigmoid, nnms_model.iou_feature]
+        if has_gt_ops:
+            fetches += [nnms_model.det_labels, nnms_model.loss, nnms_model.final_loss]
+
+        start_time = timer()
+        outputs = sess.run(fetches, feed_dict=feed_dict)
+        frame_times['fnet'].append(timer() - start_time)
+        inference_filtered, inference_filter, dt_dt_iou = outputs[0:3]
+
+        if has_gt_ops:
+            inference_oracle, opt_loss, fin_loss = outputs[3:6]
+            opt_losses.append(opt_loss)
+            final_losses.append(fin_loss)
+        else:
+            # no oracle labels in inference graph
+            inference_oracle = np.full(inference_filter.shape, np.nan)
 
-        opt_losses.append(opt_loss)
-        final_losses.append(fin_loss)
+        if nnms_model.is_batched:
+            # frame was fed as a mini-batch of size one
+            inference_filtered, inference_filter, inference_oracle, dt_dt_iou = \
+                inference_filtered[0], inference_filter[0], inference_oracle[0], dt_dt_iou[0]
 
+        # iou_feature has trailing channel dimension
+        dt_dt_iou = dt_dt_iou[:, :, 0]
+
+        start_time = timer()
         is_suppressed_orig = nms.nms_all_classes(
             dt_dt_iou, inference_orig, iou_thr=nms_thres)
+        frame_times['nms'].append(timer() - start_time)
+
+        start_time = timer()
+        inference_softnms_linear = nms.soft_nms_all_classes(dt_dt_iou, inference_orig,
+                                                            method='linear', iou_thr=nms_thres)
+        frame_times['softnms_linear'].append(timer() - start_time)
+
+        start_time = timer()
+        inference_softnms_gaussian = nms.soft_nms_all_classes(dt_dt_iou, inference_orig, method='gaussian')
+        frame_times['softnms_gaussian'].append(timer() - start_time)
+
+        start_time = timer()
+        inference_wbf, dt_coords_wbf = nms.weighted_box_fusion_all_classes(frame_data['dt_coords'], inference_orig,
+                                                                           iou_thr=nms_thres)
+        frame_times['wbf'].append(timer() - start_time)
 
         dt_coords_xywh = frame_data['dt_coords']
         dt_coords_xywh[:, 2] = dt_coords_xywh[:, 2] - dt_coords_xywh[:, 0]
@@ -89,16 +125,29 @@ def eval_model(sess,
         data_oracle = np.hstack([frame_col, dt_coords_xywh, inference_oracle])
         eval_data_oracle.append(data_oracle)
 
+        eval_data_baselines['softnms_linear'].append(
+            np.hstack([frame_col, dt_coords_xywh, inference_softnms_linear]))
+        eval_data_baselines['softnms_gaussian'].append(
+            np.hstack([frame_col, dt_coords_xywh, inference_softnms_gaussian]))
+
+        # single class, fused boxes are converted to x,y,w,h as well
+        dt_coords_wbf = dt_coords_wbf[:, 0]
+        dt_coords_wbf[:, 2] = dt_coords_wbf[:, 2] - dt_coords_wbf[:, 0]
+        dt_coords_wbf[:, 3] = dt_coords_wbf[:, 3] - dt_coords_wbf[:, 1]
+        eval_data_baselines['wbf'].append(np.hstack([frame_col, dt_coords_wbf, inference_wbf]))
+
         info_data = np.hstack([frame_col, dt_coords_xywh, inference_orig,
                                is_suppressed_orig, inference_oracle,
                                inference_filter, inference_filtered])
         info_data_all.append(info_data)
 
-    mean_opt_loss = np.mean(opt_losses)
-    mean_fin_loss = np.mean(final_losses)
-
-    logging.info('optimization loss : %f' % mean_opt_loss)
-    logging.info('final loss : %f' % mean_fin_loss)
+    if has_gt_ops:
+        mean_opt_loss = np.mean(opt_losses)
+        mean_fin_loss = np.mean(final_losses)
+        logging.info('optimization loss : %f' % mean_opt_loss)
+        logging.info('final loss : %f' % mean_fin_loss)
+    else:
+        mean_opt_loss, mean_fin_loss = None, None
 
     eval_data_orig = np.vstack(eval_data_orig)
     out_file_orig = os.path.join(out_dir, 'kitti_'+class_name+'_mscnn_nonms_' + str(global_step) + '.txt')
@@ -120,6 +169,13 @@ def eval_model(sess,
     out_file_oracle = os.path.join(out_dir, 'kitti_'+class_name+'_mscnn_fnet_oracle_' + str(global_step) + '.txt')
     np.savetxt(out_file_oracle, eval_data_oracle, fmt='%.6f', delimiter=',')
 
+    for baseline_name, baseline_data in eval_data_baselines.iteritems():
+        out_file_baseline = os.path.join(out_dir, 'kitti_'+class_name+'_mscnn_'+baseline_name+'_' + str(global_step) + '.txt')
+        np.savetxt(out_file_baseline, np.vstack(baseline_data), fmt='%.6f', delimiter=',')
+
+    for method_name, method_times in frame_times.iteritems():
+        logging.info('%s time per frame : %f ms' % (method_name, 1000 * np.mean(method_times)))
+
     info_data_all = np.vstack(info_data_all)
     info_data_all = pd.DataFrame(info_data_all,
                                  columns=['frame_id', 'x', 'y', 'w', 'h',
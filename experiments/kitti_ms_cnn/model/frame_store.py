@@ -0,0 +1,186 @@
+"""Preprocessed binary store of KITTI MS-CNN frames
+
+get_frame_data_fixed parses label .txt and detection .mat files and computes
+dt-gt IoU on every call. The store does it once for all train and val frames:
+
+    build_frame_store(frame_ids, labels_dir, detections_dir, store_dir, n_detections=300, n_features=121)
+
+(build_frame_store.py script does it for train and val frames of the experiment).
+
+Every field is saved as a flat float32 .npy array with frames concatenated
+along the first axis, plus per-frame offsets. FrameStore memory-maps the arrays
+and returns frame data as read-only views, nothing is parsed or copied per step:
+
+    frame_store = FrameStore(store_dir)
+    frame_data = frame_store.get_frame_data(frame_id)
+
+Frame data has the same keys and shapes as produced by get_frame_data_fixed.
+"""
+
+import logging
+import os
+
+import numpy as np
+import yaml
+
+from data import get_frame_data_fixed
+
+STORE_INFO_FILE = 'store_info.yml'
+
+# fields stored per detection (dt_gt_iou is stored per dt-gt pair, gt fields per gt)
+DT_FIELDS = ['dt_coords', 'dt_features', 'dt_probs', 'dt_mask']
+GT_FIELDS = ['gt_coords', 'gt_labels']
+IOU_FIELD = 'dt_gt_iou'
+
+
+def _field_path(store_dir, name):
+    return os.path.join(store_dir, name + '.npy')
+
+
+def build_frame_store(frame_ids,
+                      labels_dir,
+                      detections_dir,
+                      store_dir,
+                      n_detections,
+                      n_features,
+                      class_name='Car'):
+    """Convert frames into memory-mappable frame store
+
+    Parameters
+    ----------
+    frame_ids - ids of frames to convert
+    labels_dir - directory with KITTI label files
+    detections_dir - directory with MS-CNN detection .mat files
+    store_dir - directory to save store to
+    n_detections - number of detections per frame (frames are padded to it, as in get_frame_data_fixed)
+    n_features - number of MS-CNN features per detection
+    class_name - class of interest
+
+    Returns
+    -------
+    store info dict (also saved to store_dir)
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    frame_ids = np.unique(frame_ids)
+    n_frames = len(frame_ids)
+
+    # every frame has exactly n_detections rows, so detection fields are written
+    # straight into preallocated memory-mapped files
+    dt_shapes = {'dt_coords': [4], 'dt_features': [n_features + 1], 'dt_probs': [1], 'dt_mask': []}
+    dt_arrays = {}
+    for name in DT_FIELDS:
+        dt_arrays[name] = np.lib.format.open_memmap(_field_path(store_dir, name), mode='w+', dtype=np.float32,
+                                                    shape=tuple([n_frames * n_detections] + dt_shapes[name]))
+
+    # empty leading arrays keep concatenation valid for empty frame lists
+    gt_arrays = {'gt_coords': [np.zeros([0, 4], dtype=np.float32)],
+                 'gt_labels': [np.zeros(0, dtype=np.float32)]}
+    iou_arrays = [np.zeros(0, dtype=np.float32)]
+    gt_counts = np.zeros(n_frames, dtype=np.int64)
+
+    for frame_ix, frame_id in enumerate(frame_ids):
+
+        frame_data = get_frame_data_fixed(frame_id=frame_id,
+                                          labels_dir=labels_dir,
+                                          detections_dir=detections_dir,
+                                          class_name=class_name,
+                                          n_detections=n_detections,
+                                          n_features=n_features)
+
+        dt_start = frame_ix * n_detections
+        for name in DT_FIELDS:
+            dt_arrays[name][dt_start:dt_start + n_detections] = frame_data[name]
+
+        for name in GT_FIELDS:
+            gt_arrays[name].append(np.asarray(frame_data[name], dtype=np.float32))
+        iou_arrays.append(np.asarray(frame_data[IOU_FIELD], dtype=np.float32).reshape(-1))
+        gt_counts[frame_ix] = len(frame_data['gt_coords'])
+
+        if (frame_ix + 1) % 1000 == 0:
+            logging.info('%d / %d frames converted' % (frame_ix + 1, n_frames))
+
+    for name in DT_FIELDS:
+        dt_arrays[name].flush()
+    del dt_arrays
+
+    np.save(_field_path(store_dir, 'gt_coords'), np.vstack(gt_arrays['gt_coords']))
+    np.save(_field_path(store_dir, 'gt_labels'), np.hstack(gt_arrays['gt_labels']))
+    np.save(_field_path(store_dir, IOU_FIELD), np.hstack(iou_arrays))
+
+    np.save(_field_path(store_dir, 'frame_ids'), frame_ids)
+    np.save(_field_path(store_dir, 'gt_offsets'), np.hstack([0, np.cumsum(gt_counts)]))
+
+    store_info = {'n_frames': int(n_frames),
+                  'n_detections': int(n_detections),
+                  'n_features': int(n_features),
+                  'class_name': class_name}
+
+    with open(os.path.join(store_dir, STORE_INFO_FILE), 'w') as f:
+        yaml.dump(store_info, f, default_flow_style=False)
+
+    logging.info('frame store with %d frames saved to %s' % (n_frames, store_dir))
+
+    return store_info
+
+
+class FrameStore:
+
+    def __init__(self, store_dir):
+        """
+        Parameters
+        ----------
+        store_dir - directory produced by build_frame_store
+        """
+        with open(os.path.join(store_dir, STORE_INFO_FILE), 'r') as f:
+            self.store_info = yaml.load(f)
+
+        self.n_detections = self.store_info['n_detections']
+        self.n_features = self.store_info['n_features']
+        self.class_name = self.store_info['class_name']
+
+        self.arrays = {}
+        for name in DT_FIELDS + GT_FIELDS + [IOU_FIELD]:
+            self.arrays[name] = np.load(_field_path(store_dir, name), mmap_mode='r')
+
+        self.frame_ids = np.load(_field_path(store_dir, 'frame_ids'))
+        self.gt_offsets = np.load(_field_path(store_dir, 'gt_offsets'))
+        self.frame_ix = {frame_id: frame_ix for frame_ix, frame_id in enumerate(self.frame_ids)}
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+    def __contains__(self, frame_id):
+        return frame_id in self.frame_ix
+
+    def check_compatible(self, n_detections, n_features, class_name):
+        """Raise ValueError if the store was built with other data parameters than the experiment uses
+        """
+        store_params = (self.n_detections, self.n_features, self.class_name)
+        if store_params != (n_detections, n_features, class_name):
+            raise ValueError('frame store was built for (n_detections, n_features, class_name) = %s, '
+                             'experiment uses %s' % (str(store_params), str((n_detections, n_features, class_name))))
+
+    def get_frame_data(self, frame_id):
+        """Frame data as returned by get_frame_data_fixed, arrays are read-only views into the store
+        """
+        frame_ix = self.frame_ix[frame_id]
+
+        dt_start = frame_ix * self.n_detections
+        dt_end = dt_start + self.n_detections
+        gt_start, gt_end = self.gt_offsets[frame_ix], self.gt_offsets[frame_ix + 1]
+
+        frame_data = {}
+        for name in DT_FIELDS:
+            frame_data[name] = self.arrays[name][dt_start:dt_end]
+        for name in GT_FIELDS:
+            frame_data[name] = self.arrays[name][gt_start:gt_end]
+
+        # dt-gt pairs of preceding frames: every frame has n_detections rows
+        n_gt = gt_end - gt_start
+        iou_start = gt_start * self.n_detections
+        frame_data[IOU_FIELD] = self.arrays[IOU_FIELD][iou_start:iou_start + self.n_detections * n_gt].reshape(
+            self.n_detections, n_gt)
+
+        return frame_data
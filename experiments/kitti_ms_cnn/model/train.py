@@ -15,13 +15,17 @@ import tensorflow as tf
 from google.apputils import app
 from nms_network import model as nms_net
 import eval
-from data import get_frame_data, get_frame_data_fixed
+from data import get_frame_data, get_frame_data_fixed, get_feed_dict
+from frame_store import FrameStore
 from tools import experiment_config as expconf
+from tools import batch_utils
 
 
 gflags.DEFINE_string('data_dir', None, 'directory containing train data')
 gflags.DEFINE_string('root_log_dir', None, 'root directory to save logs')
 gflags.DEFINE_string('config_path', None, 'path to experiment config')
+gflags.DEFINE_string('frame_store_dir', None, 'preprocessed frame store (see build_frame_store.py), '
+                                              'frames are parsed from data_dir on every step if not set')
 
 FLAGS = gflags.FLAGS
 
@@ -32,27 +36,35 @@ def shuffle_samples(n_frames):
     return np.random.choice(n_frames, n_frames, replace=False)
 
 
-def input_ops(n_dt_features, n_classes):
+def input_ops(n_dt_features, n_classes, batched=False):
 
     input_dict = {}
     n_dt_coords = 4
+
+    # mini-batches of frames get additional leading dimension
+    batch_shape = [None] if batched else []
+
     input_dict['dt_coords'] = tf.placeholder(
-        tf.float32, shape=[
+        tf.float32, shape=batch_shape + [
                 None, n_dt_coords])
 
     input_dict['dt_features'] = tf.placeholder(tf.float32,
-                                 shape=[
+                                 shape=batch_shape + [
                                      None,
                                      n_classes+n_dt_features])
 
     input_dict['dt_probs'] = tf.placeholder(tf.float32,
-                                 shape=[
+                                 shape=batch_shape + [
                                      None,
                                      n_classes])
 
-    input_dict['gt_coords'] = tf.placeholder(tf.float32, shape=[None, 4])
+    input_dict['gt_coords'] = tf.placeholder(tf.float32, shape=batch_shape + [None, 4])
 
-    input_dict['gt_labels'] = tf.placeholder(tf.float32, shape=None)
+    if batched:
+        input_dict['gt_labels'] = tf.placeholder(tf.float32, shape=[None, None])
+        input_dict['dt_mask'] = tf.placeholder(tf.float32, shape=[None, None])
+    else:
+        input_dict['gt_labels'] = tf.placeholder(tf.float32, shape=None)
 
     input_dict['nms_labels'] = tf.placeholder(tf.float32, shape=None)
 
@@ -76,13 +88,7 @@ def mean_loss(sess, nms_model, frames,
                                     n_detections=n_bboxes_test,
                                     n_features=n_dt_features)
 
-        feed_dict = {nms_model.dt_coords: frame_data['dt_coords'],
-                     nms_model.dt_features: frame_data['dt_features'],
-                     nms_model.dt_probs_ini: frame_data['dt_probs'],
-                     nms_model.gt_coords: frame_data['gt_coords'],
-                     nms_model.gt_labels: frame_data['gt_labels'],
-                     # nnms_model.nms_labels: frame_data['nms_labels'],
-                     nms_model.keep_prob: 1.0}
+        feed_dict = get_feed_dict(nms_model, [frame_data], keep_prob=1.0)
 
         det_loss = sess.run([nms_model.det_loss], feed_dict=feed_dict)
 
@@ -142,15 +148,33 @@ def main(_):
     n_train_samples = len(train_frames)
     n_test_samples = len(test_frames)
 
+    if FLAGS.frame_store_dir is not None:
+        frame_store = FrameStore(FLAGS.frame_store_dir)
+        frame_store.check_compatible(config.n_bboxes, config.n_dt_features, class_name)
+        logging.info('training frames are read from frame store %s' % FLAGS.frame_store_dir)
+        load_train_frame = frame_store.get_frame_data
+    else:
+        def load_train_frame(fid):
+            return get_frame_data_fixed(frame_id=fid,
+                                        labels_dir=labels_dir,
+                                        detections_dir=detections_dir,
+                                        n_detections=config.n_bboxes,
+                                        class_name=class_name,
+                                        n_features=config.n_dt_features)
+
     logging.info('building model graph..')
 
-    in_ops = input_ops(config.n_dt_features, n_classes)
+    in_ops = input_ops(config.n_dt_features, n_classes, batched=config.batch_size > 1)
 
     nnms_model = nms_net.NMSNetwork(n_classes=1,
                                     input_ops=in_ops,
                                     class_ix=0,
                                     **config.nms_network_config)
 
+    def load_train_batch(batch_frames):
+        batch_frames_data = [load_train_frame(fid) for fid in batch_frames]
+        return get_feed_dict(nnms_model, batch_frames_data, keep_prob=config.keep_prob_train)
+
     saver = tf.train.Saver(max_to_keep=5, keep_checkpoint_every_n_hours=1.0)
 
     config.save_results()
@@ -174,8 +198,17 @@ def main(_):
         for epoch_id in range(0, config.n_epochs):
 
             epoch_frames = train_frames[shuffle_samples(n_train_samples)]
+            epoch_batches = [epoch_frames[batch_start:batch_start+config.batch_size]
+                             for batch_start in range(0, n_train_samples, config.batch_size)]
+
+            # mini-batches are loaded in background threads while the previous step runs,
+            # data time is the time spent waiting for the next mini-batch
+            start_step = timer()
 
-            for fid in epoch_frames:
+            for feed_dict in batch_utils.prefetch(epoch_batches,
+                                                  load_train_batch,
+                                                  n_threads=config.n_loader_threads,
+                                                  buffer_size=config.prefetch_batches):
 
                 # if step_id == config.loss_change_step:
                 #     learning_rate = config.learning_rate_det
@@ -184,23 +217,8 @@ def main(_):
                 #     logging.info('switching loss to actual detection loss..')
                 #     logging.info('learning rate to %f' % learning_rate)
 
-                start_step = timer()
-
-                frame_data = get_frame_data_fixed(frame_id=fid,
-                                            labels_dir=labels_dir,
-                                            detections_dir=detections_dir,
-                                            n_detections=config.n_bboxes,
-                                            class_name=class_name,
-                                            n_features=config.n_dt_features)
                 data_step = timer()
 
-                feed_dict = {nnms_model.dt_coords: frame_data['dt_coords'],
-                             nnms_model.dt_features: frame_data['dt_features'],
-                             nnms_model.dt_probs_ini: frame_data['dt_probs'],
-                             nnms_model.gt_coords: frame_data['gt_coords'],
-                             nnms_model.gt_labels: frame_data['gt_labels'],
-                             nnms_model.keep_prob: config.keep_prob_train}
-
                 if nnms_model.loss_type == 'nms':
                     summary,  _ = sess.run([nnms_model.merged_summaries,
                                            nnms_model.nms_train_step],
@@ -265,6 +283,8 @@ def main(_):
 
                     saver.save(sess, config.model_file, global_step=step_id)
 
+                start_step = timer()
+
         train_loss_opt, train_loss_fin = eval.eval_model(sess,
                                      nnms_model,
                                      detections_dir=detections_dir,
@@ -0,0 +1,19 @@
+#!/bin/bash
+
+SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd)"
+
+EXPERIMENT_DIR="${SCRIPT_DIR}/.."
+
+PROJECT_DIR="${SCRIPT_DIR}/../../.."
+
+source "${PROJECT_DIR}/scripts/dbash.sh" || exit 1
+
+cd ${PROJECT_DIR}
+
+set -x
+
+# pass --frame_store_dir with the same path to train.py afterwards
+${PYENV_BIN} experiments/kitti_ms_cnn/model/build_frame_store.py  \
+            --data_dir="/Users/sergey/KITTI/training/" \
+            --store_dir="/Users/sergey/KITTI/training/frame_store/" \
+            --config_path="${SCRIPT_DIR}/config.yml"
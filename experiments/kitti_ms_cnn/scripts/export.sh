@@ -0,0 +1,20 @@
+#!/bin/bash
+
+SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd)"
+
+EXPERIMENT_DIR="${SCRIPT_DIR}/.."
+
+PROJECT_DIR="${SCRIPT_DIR}/../../.."
+
+source "${PROJECT_DIR}/scripts/dbash.sh" || exit 1
+
+cd ${PROJECT_DIR}
+
+set -x
+
+# n_dt_features = n_features from config + 1 (detection score is prepended to features)
+${PYENV_BIN} nms_network/export.py  \
+            --config_path="${SCRIPT_DIR}/config.yml" \
+            --checkpoint_path="$1" \
+            --output_path="${EXPERIMENT_DIR}/logs/knet_frozen.pb" \
+            --n_dt_features=122
@@ -0,0 +1,121 @@
+"""Export of trained NMSNetwork into self-contained frozen inference graph
+
+Exported graph contains only the forward path (see NMSNetwork mode='inference')
+with variables converted to constants. It is loaded with frozen.FrozenNMSNetwork,
+which doesn't need the model code.
+
+"""
+
+import logging
+
+import gflags
+import yaml
+import tensorflow as tf
+from google.apputils import app
+
+import model as nms_net
+from frozen import DT_COORDS_NODE, DT_FEATURES_NODE, DT_PROBS_NODE, CLASS_SCORES_NODE, FILTER_SCORES_NODE
+
+gflags.DEFINE_string('config_path', None, 'config the model was trained with')
+gflags.DEFINE_string('checkpoint_path', None, 'checkpoint to export')
+gflags.DEFINE_string('output_path', None, 'path to save frozen graph')
+gflags.DEFINE_integer('n_dt_features', None, 'number of features per detection (as fed to the model)')
+gflags.DEFINE_integer('n_classes', 1, 'number of classes')
+
+FLAGS = gflags.FLAGS
+
+
+def _fold_constants(graph_def, input_nodes, output_nodes):
+    """Fold constant subgraphs and strip unused nodes, if graph transform tool is available
+    """
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        logging.info('graph_transforms are not available, constants are not folded')
+        return graph_def
+    return TransformGraph(graph_def, input_nodes, output_nodes,
+                          ['strip_unused_nodes', 'fold_constants(ignore_errors=true)', 'sort_by_execution_order'])
+
+
+def export_frozen_graph(nms_network_config,
+                        checkpoint_path,
+                        output_path,
+                        n_dt_features,
+                        n_classes=1):
+    """Build inference graph, restore its weights from the checkpoint and save it frozen
+
+    Parameters
+    ----------
+    nms_network_config - 'nms_network' section of the experiment config
+    checkpoint_path - checkpoint saved during training (train mode graph)
+    output_path - path to save serialized GraphDef
+    n_dt_features - width of dt_features input
+    n_classes - number of classes
+
+    Returns
+    -------
+    frozen GraphDef
+    """
+
+    graph = tf.Graph()
+
+    with graph.as_default():
+
+        input_dict = {}
+        input_dict['dt_coords'] = tf.placeholder(tf.float32, shape=[None, 4], name=DT_COORDS_NODE)
+        input_dict['dt_features'] = tf.placeholder(tf.float32, shape=[None, n_dt_features],
+                                                   name=DT_FEATURES_NODE)
+        input_dict['dt_probs'] = tf.placeholder(tf.float32, shape=[None, n_classes], name=DT_PROBS_NODE)
+        # constant keep probability turns dropout into no-op
+        input_dict['keep_prob'] = tf.constant(1.0)
+
+        nnms_model = nms_net.NMSNetwork(n_classes=n_classes,
+                                        input_ops=input_dict,
+                                        mode='inference',
+                                        **nms_network_config)
+
+        tf.identity(nnms_model.class_scores, name=CLASS_SCORES_NODE)
+        tf.identity(nnms_model.sigmoid, name=FILTER_SCORES_NODE)
+
+        output_nodes = [CLASS_SCORES_NODE, FILTER_SCORES_NODE]
+        input_nodes = [DT_COORDS_NODE, DT_FEATURES_NODE, DT_PROBS_NODE]
+
+        saver = tf.train.Saver(tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=nnms_model.VAR_SCOPE))
+
+        with tf.Session() as sess:
+            saver.restore(sess, checkpoint_path)
+            graph_def = tf.graph_util.convert_variables_to_constants(sess,
+                                                                     graph.as_graph_def(),
+                                                                     output_nodes)
+
+    graph_def = _fold_constants(graph_def, input_nodes, output_nodes)
+
+    with tf.gfile.GFile(output_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+    logging.info('frozen graph with %d nodes saved to %s' % (len(graph_def.node), output_path))
+
+    return graph_def
+
+
+def main(_):
+
+    logging.basicConfig(format='%(asctime)s : %(message)s', level=logging.INFO)
+
+    with open(FLAGS.config_path, 'r') as f:
+        config = yaml.load(f)
+
+    export_frozen_graph(config.get('nms_network', {}),
+                        checkpoint_path=FLAGS.checkpoint_path,
+                        output_path=FLAGS.output_path,
+                        n_dt_features=FLAGS.n_dt_features,
+                        n_classes=FLAGS.n_classes)
+    return
+
+
+if __name__ == '__main__':
+    gflags.mark_flag_as_required('config_path')
+    gflags.mark_flag_as_required('checkpoint_path')
+    gflags.mark_flag_as_required('output_path')
+    gflags.mark_flag_as_required('n_dt_features')
+    app.run()
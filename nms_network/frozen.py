@@ -0,0 +1,61 @@
+"""Loader for frozen NMSNetwork inference graph (see export.py)
+
+Depends on tensorflow only, so serving doesn't need the training code:
+
+    frozen_model = FrozenNMSNetwork('knet_frozen.pb')
+    class_scores, filter_scores = frozen_model.rescore(dt_coords, dt_features, dt_probs)
+
+"""
+
+import tensorflow as tf
+
+DT_COORDS_NODE = 'dt_coords'
+DT_FEATURES_NODE = 'dt_features'
+DT_PROBS_NODE = 'dt_probs'
+CLASS_SCORES_NODE = 'class_scores'
+FILTER_SCORES_NODE = 'filter_scores'
+
+
+class FrozenNMSNetwork:
+    """Runs rescoring with frozen graph produced by export_frozen_graph
+    """
+
+    def __init__(self, graph_path):
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(graph_path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        self.dt_coords = self.graph.get_tensor_by_name(DT_COORDS_NODE + ':0')
+        self.dt_features = self.graph.get_tensor_by_name(DT_FEATURES_NODE + ':0')
+        self.dt_probs = self.graph.get_tensor_by_name(DT_PROBS_NODE + ':0')
+        self.class_scores = self.graph.get_tensor_by_name(CLASS_SCORES_NODE + ':0')
+        self.filter_scores = self.graph.get_tensor_by_name(FILTER_SCORES_NODE + ':0')
+
+        self.sess = tf.Session(graph=self.graph)
+
+    def rescore(self, dt_coords, dt_features, dt_probs):
+        """Compute new detection scores for a single frame
+
+        Parameters
+        ----------
+        dt_coords - array of shape [n_bboxes, 4]
+        dt_features - array of shape [n_bboxes, n_dt_features]
+        dt_probs - array of shape [n_bboxes, n_classes]
+
+        Returns
+        -------
+        class_scores - initial scores with suppressed detections zeroed, [n_bboxes, n_classes]
+        filter_scores - network output probabilities, [n_bboxes, n_classes]
+        """
+        return self.sess.run([self.class_scores, self.filter_scores],
+                             feed_dict={self.dt_coords: dt_coords,
+                                        self.dt_features: dt_features,
+                                        self.dt_probs: dt_probs})
+
+    def close(self):
+        self.sess.close()
@@ -11,6 +11,7 @@ from tf_layers import misc
 DT_COORDS = 'dt_coords'
 GT_COORDS = 'gt_coords'
 GT_LABELS = 'gt_labels'
+GT_LABELS_NO_BG = 'gt_labels_no_bg'
 DT_LABELS = 'dt_labels'
 DT_LABELS_BASIC = 'dt_labels_basic'
 DT_FEATURES = 'dt_features'
@@ -29,6 +30,7 @@ class NMSNetwork:
                  n_classes,
                  input_ops=None,
                  class_ix=15,
+                 mode='train',
                  **kwargs):
 
         # model main parameters
@@ -38,6 +40,11 @@ class NMSNetwork:
         self.class_ix = class_ix
         #self.n_bboxes = n_bboxes
 
+        # 'train' builds losses and optimizers, 'inference' - only forward path to class_scores
+        if mode not in ['train', 'inference']:
+            raise ValueError("unknown model mode : %s" % mode)
+        self.mode = mode
+
         # architecture params
         arch_args = kwargs.get('architecture', {})
         self.fc_ini_layer_size = arch_args.get('fc_ini_layer_size', 1024)
@@ -51,6 +58,10 @@ class NMSNetwork:
         self.use_iou_features = arch_args.get('use_iou_features', True)
         self.use_coords_features = arch_args.get('use_coords_features', True)
         self.use_object_features = arch_args.get('use_object_features', True)
+        self.factorized_pairwise = arch_args.get('factorized_pairwise', False)
+        self.kernel_neighbourhood = arch_args.get('kernel_neighbourhood', 'dense')
+        self.neighbourhood_iou_thr = arch_args.get('neighbourhood_iou_thr', 0.0)
+        self.neighbourhood_k = arch_args.get('neighbourhood_k', 10)
 
         # training procedure params
         train_args = kwargs.get('training', {})
@@ -76,21 +87,30 @@ class NMSNetwork:
             self.dt_coords = input_ops['dt_coords']
             self.dt_features = input_ops['dt_features']
             self.dt_probs_ini = input_ops['dt_probs']
-            self.gt_labels = input_ops['gt_labels']
-            self.gt_coords = input_ops['gt_coords']
+            # ground truth is not needed (and may be not provided) in inference mode
+            self.gt_labels = input_ops.get('gt_labels')
+            self.gt_coords = input_ops.get('gt_coords')
             self.keep_prob = input_ops['keep_prob']
 
+        # inputs with leading batch dimension are treated as mini-batch of padded frames,
+        # dt_mask marks valid (not padded) boxes of every frame
+        self.is_batched = self.dt_coords.get_shape().ndims == 3
+        if self.is_batched:
+            self.dt_mask = input_ops['dt_mask']
+        else:
+            self.dt_mask = None
+
         # self.dt_features_merged = tf.concat([self.dt_probs_ini, self.dt_features], axis=1)
 
         if self.loss_type == 'nms':
             # use only scores
             self.dt_features_merged = self.dt_probs_ini
         else:
-            self.dt_features_merged = tf.concat([self.dt_probs_ini, self.dt_features], axis=1)
+            self.dt_features_merged = tf.concat([self.dt_probs_ini, self.dt_features], axis=-1)
 
-        self.n_dt_features = self.dt_features_merged.get_shape().as_list()[1]
+        self.n_dt_features = self.dt_features_merged.get_shape().as_list()[-1]
 
-        self.n_bboxes = tf.shape(self.dt_features_merged)[0]
+        self.n_bboxes = tf.shape(self.dt_features_merged)[-2]
 
         with tf.variable_scope(self.VAR_SCOPE):
 
@@ -100,38 +120,40 @@ class NMSNetwork:
             self.binary_filter = tf.to_float(tf.greater(self.sigmoid, self.filter_threshold), name='binary_filter')
 
             self.class_scores = tf.multiply(self.binary_filter, self.dt_probs_ini)
-            # NMS labels
-            self.nms_labels, self.nms_loss = self._nms_loss_ops()
-            self.global_step_nms = tf.Variable(0, trainable=False)
-            self.learning_rate_nms = tf.train.exponential_decay(self.starter_learning_rate_nms,
-                                                                self.global_step_nms,
-                                                                self.decay_steps_nms,
-                                                                self.decay_rate_nms,
-                                                                staircase=True)
-            self.nms_train_step = tf.train.AdamOptimizer(self.learning_rate_nms).minimize(self.nms_loss,
-                                                                        global_step=self.global_step_nms)
-
-            # detection labels
-            self.det_labels, self.det_loss = self._detection_loss_ops()
-            self.global_step_det = tf.Variable(0, trainable=False)
-            self.learning_rate_det = tf.train.exponential_decay(self.starter_learning_rate_det,
-                                                                self.global_step_det,
-                                                                self.decay_steps_det,
-                                                                self.decay_rate_det,
-                                                                staircase=True)
-            self.det_train_step = self._train_step(loss=self.det_loss,
-                                                   learning_rate=self.learning_rate_det,
-                                                   global_step=self.global_step_det)
-
-            if self.loss_type == 'detection':
-                self.loss = self.det_loss
-                self.labels = self.det_labels
-            elif self.loss_type == 'nms':
-                self.loss = self.nms_loss
-                self.labels = self.nms_labels
-
-            self.final_loss = self._final_cross_entropy_loss()
-            self.merged_summaries = self._summary_ops()
+
+            if self.mode == 'train':
+                # NMS labels
+                self.nms_labels, self.nms_loss = self._nms_loss_ops()
+                self.global_step_nms = tf.Variable(0, trainable=False)
+                self.learning_rate_nms = tf.train.exponential_decay(self.starter_learning_rate_nms,
+                                                                    self.global_step_nms,
+                                                                    self.decay_steps_nms,
+                                                                    self.decay_rate_nms,
+                                                                    staircase=True)
+                self.nms_train_step = tf.train.AdamOptimizer(self.learning_rate_nms).minimize(self.nms_loss,
+                                                                            global_step=self.global_step_nms)
+
+                # detection labels
+                self.det_labels, self.det_loss = self._detection_loss_ops()
+                self.global_step_det = tf.Variable(0, trainable=False)
+                self.learning_rate_det = tf.train.exponential_decay(self.starter_learning_rate_det,
+                                                                    self.global_step_det,
+                                                                    self.decay_steps_det,
+                                                                    self.decay_rate_det,
+                                                                    staircase=True)
+                self.det_train_step = self._train_step(loss=self.det_loss,
+                                                       learning_rate=self.learning_rate_det,
+                                                       global_step=self.global_step_det)
+
+                if self.loss_type == 'detection':
+                    self.loss = self.det_loss
+                    self.labels = self.det_labels
+                elif self.loss_type == 'nms':
+                    self.loss = self.nms_loss
+                    self.labels = self.nms_labels
+
+                self.final_loss = self._final_cross_entropy_loss()
+                self.merged_summaries = self._summary_ops()
 
         self.init_op = self._init_ops()
 
@@ -173,61 +195,66 @@ class NMSNetwork:
     def _inference_ops(self):
 
         if self.n_classes == 1:
-            highest_prob = tf.reduce_max(self.dt_probs_ini, axis=1)
+            highest_prob = tf.reduce_max(self.dt_probs_ini, axis=-1)
         else:
             # we are considering all classes, skip the backgorund class
-            highest_prob = tf.reduce_max(self.dt_probs_ini[:, 1:], axis=1)
+            highest_prob = tf.reduce_max(self.dt_probs_ini[..., 1:], axis=-1)
 
         _, top_ix = tf.nn.top_k(highest_prob, k=self.top_k_hypotheses)
 
-        pairwise_coords_features = spatial.construct_pairwise_features_tf(self.dt_coords)
-
         spatial_features_list = []
         n_pairwise_features = 0
 
-        iou_feature = spatial.compute_pairwise_spatial_features_iou_tf(pairwise_coords_features)
+        iou_feature = tf.expand_dims(spatial.compute_pairwise_iou_tf(self.dt_coords), axis=-1)
 
         if self.use_iou_features:
             spatial_features_list.append(iou_feature)
             n_pairwise_features += 1
 
-        pairwise_obj_features = spatial.construct_pairwise_features_tf(self.dt_features_merged)
-
         if self.use_object_features:
-            spatial_features_list.append(pairwise_obj_features)
-            n_pairwise_features += self.dt_features_merged.get_shape().as_list()[1] * 2
-            score_diff_sign_feature = tf.sign(
-                    pairwise_obj_features[:, :, 0:self.n_dt_features]-
-                    pairwise_obj_features[:, :, self.n_dt_features:])
-            score_diff_feature = pairwise_obj_features[:, :, 0:self.n_dt_features] -\
-                                 pairwise_obj_features[:, :, self.n_dt_features:]
-            spatial_features_list.append(score_diff_sign_feature)
-            spatial_features_list.append(score_diff_feature)
-            n_pairwise_features += self.dt_features_merged.get_shape().as_list()[1] * 2
-        pairwise_features = tf.concat(axis=2, values=spatial_features_list)
-
-        diagonals = []
-        for i in range(0, n_pairwise_features):
-            d = tf.expand_dims(tf.diag(tf.diag_part(pairwise_features[:, :, i])), axis=2)
-            diagonals.append(d)
-        diag = tf.concat(axis=2, values=diagonals)
-
-        pairwise_features = pairwise_features - diag
+            n_pairwise_features += self.n_dt_features * 4
 
-        self.pairwise_obj_features = pairwise_features
-
-        kernel_features = self._kernel(pairwise_features,
-                                       n_pairwise_features,
-                                       hlayer_size=self.knet_hlayer_size,
-                                       n_kernels=self.n_kernels)
-
-        kernel_features_sigmoid = tf.nn.sigmoid(kernel_features)
-
-        kernel_max = tf.reshape(tf.reduce_max(kernel_features_sigmoid, axis=1), [self.n_bboxes, self.n_kernels])
-
-        kernel_sum = tf.reshape(tf.reduce_sum(kernel_features_sigmoid, axis=1), [self.n_bboxes, self.n_kernels])
-
-        object_and_context_features = tf.concat(axis=1, values=[self.dt_features_merged, kernel_max, kernel_sum])
+        if self.kernel_neighbourhood in ['iou', 'knn']:
+            kernel_max, kernel_sum = self._kernel_sparse(iou_feature[..., 0],
+                                                         n_pairwise_features,
+                                                         hlayer_size=self.knet_hlayer_size,
+                                                         n_kernels=self.n_kernels)
+        else:
+            score_diff_feature = None
+            score_diff_sign_feature = None
+
+            if self.use_object_features:
+                obj_features_i, obj_features_j = spatial.construct_pairwise_features_tf(self.dt_features_merged,
+                                                                                        as_pair=True)
+                score_diff_feature = obj_features_i - obj_features_j
+                score_diff_sign_feature = tf.sign(score_diff_feature)
+
+            # pair halves f_i, f_j enter the first layer per box in both modes, so the pairwise
+            # [n_bboxes, n_bboxes, n_features * 2] tensor is never materialized; dense mode
+            # keeps score difference channels per pair, factorized mode folds them per box too
+            kernel_features = self._kernel_factorized(iou_feature,
+                                                      score_diff_sign_feature,
+                                                      n_pairwise_features,
+                                                      hlayer_size=self.knet_hlayer_size,
+                                                      n_kernels=self.n_kernels,
+                                                      score_diff_feature=None if self.factorized_pairwise
+                                                      else score_diff_feature)
+
+            kernel_features_sigmoid = tf.nn.sigmoid(kernel_features)
+
+            if self.is_batched:
+                # padded boxes should not contribute to context of other boxes,
+                # tf.where (unlike multiplication by mask) also drops NaN coming from padding
+                is_valid_pair = tf.expand_dims(tf.expand_dims(self.dt_mask, 1), 3) * \
+                    tf.ones_like(kernel_features_sigmoid) > 0
+                kernel_features_sigmoid = tf.where(is_valid_pair, kernel_features_sigmoid,
+                                                   tf.zeros_like(kernel_features_sigmoid))
+
+            kernel_max = tf.reduce_max(kernel_features_sigmoid, axis=-2)
+
+            kernel_sum = tf.reduce_sum(kernel_features_sigmoid, axis=-2)
+
+        object_and_context_features = tf.concat(axis=-1, values=[self.dt_features_merged, kernel_max, kernel_sum])
 
         self.object_and_context_features = object_and_context_features
 
@@ -239,7 +266,11 @@ class NMSNetwork:
                                           self.fc_apres_layer_size,
                                           activation_fn=tf.nn.relu)
 
-        fc2_drop = tf.nn.dropout(fc2, self.keep_prob)
+        if self.mode == 'train':
+            fc2_drop = tf.nn.dropout(fc2, self.keep_prob)
+        else:
+            # dropout is always off at inference
+            fc2_drop = fc2
 
         logits = slim.fully_connected(fc2_drop, self.n_classes, activation_fn=None)
 
@@ -257,22 +288,19 @@ class NMSNetwork:
 
         _, top_ix = tf.nn.top_k(highest_prob, k=self.top_k_hypotheses)
 
-        pairwise_coords_features = spatial.construct_pairwise_features_tf(self.dt_coords)
-
-        pairwise_coords_features_top_k = spatial.construct_pairwise_features_tf(
-            self.dt_coords, tf.gather(self.dt_coords, top_ix))
-
         spatial_features_list = []
         n_pairwise_features = 0
 
-        iou_feature = spatial.compute_pairwise_spatial_features_iou_tf(pairwise_coords_features)
-        iou_feature_top_k = spatial.compute_pairwise_spatial_features_iou_tf(pairwise_coords_features_top_k)
+        iou_feature = tf.expand_dims(spatial.compute_pairwise_iou_tf(self.dt_coords), axis=2)
+        iou_feature_top_k = tf.expand_dims(spatial.compute_pairwise_iou_tf(
+            self.dt_coords, tf.gather(self.dt_coords, top_ix)), axis=2)
 
         if self.use_iou_features:
             spatial_features_list.append(iou_feature_top_k)
             n_pairwise_features += 1
 
         if self.loss_type == 'detection':
+            pairwise_coords_features = spatial.construct_pairwise_features_tf(self.dt_coords)
             misc_spatial_features = spatial.compute_misc_pairwise_spatial_features_tf(pairwise_coords_features)
             spatial_features_list.append(misc_spatial_features)
             n_pairwise_features += 5
@@ -283,11 +311,10 @@ class NMSNetwork:
         if self.use_object_features:
             spatial_features_list.append(pairwise_obj_features_top_k)
             n_pairwise_features += self.dt_features_merged.get_shape().as_list()[1] * 2
-            score_diff_sign_feature = tf.sign(
-                    pairwise_obj_features_top_k[:, :, 0:self.n_dt_features] -
-                    pairwise_obj_features_top_k[:, :, self.n_dt_features:])
-            score_diff_feature = pairwise_obj_features_top_k[:, :, 0:self.n_dt_features] - \
-                                 pairwise_obj_features_top_k[:, :, self.n_dt_features:]
+            obj_features_i, obj_features_top_k = spatial.construct_pairwise_features_tf(
+                self.dt_features_merged, tf.gather(self.dt_features_merged, top_ix), as_pair=True)
+            score_diff_feature = obj_features_i - obj_features_top_k
+            score_diff_sign_feature = tf.sign(score_diff_feature)
             spatial_features_list.append(score_diff_sign_feature)
             spatial_features_list.append(score_diff_feature)
             n_pairwise_features += self.dt_features_merged.get_shape().as_list()[1] * 2
@@ -303,11 +330,11 @@ class NMSNetwork:
 
         kernel_features_sigmoid = tf.nn.sigmoid(kernel_features)
 
-        kernel_max = tf.reshape(tf.reduce_max(kernel_features_sigmoid, axis=1), [self.n_bboxes, self.n_kernels])
+        kernel_max = tf.reduce_max(kernel_features_sigmoid, axis=-2)
 
-        kernel_sum = tf.reshape(tf.reduce_sum(kernel_features_sigmoid, axis=1), [self.n_bboxes, self.n_kernels])
+        kernel_sum = tf.reduce_sum(kernel_features_sigmoid, axis=-2)
 
-        object_and_context_features = tf.concat(axis=1, values=[self.dt_features_merged, kernel_max, kernel_sum])
+        object_and_context_features = tf.concat(axis=-1, values=[self.dt_features_merged, kernel_max, kernel_sum])
 
         self.object_and_context_features = object_and_context_features
 
@@ -338,12 +365,13 @@ class NMSNetwork:
                 hlayer_size,
                 n_kernels=1):
 
-        n_objects_1 = tf.shape(pairwise_features)[0]
-        n_objects_2 = tf.shape(pairwise_features)[1]
+        pairwise_shape = tf.shape(pairwise_features)
+        n_objects_1 = pairwise_shape[-3]
+        n_objects_2 = pairwise_shape[-2]
 
         pairwise_features_reshaped = tf.reshape(
             pairwise_features, [
-                1, n_objects_1, n_objects_2, n_pair_features])
+                -1, n_objects_1, n_objects_2, n_pair_features])
 
         conv1 = slim.layers.conv2d(
             pairwise_features_reshaped,
@@ -351,6 +379,201 @@ class NMSNetwork:
             [1, 1],
             activation_fn=tf.nn.relu)
 
+        conv3 = self._kernel_output_layers(conv1, hlayer_size, n_kernels)
+
+        # restore rank of the input (with or without batch dimension)
+        return tf.reshape(conv3, tf.concat([pairwise_shape[:-1], [n_kernels]], axis=0))
+
+    def _kernel_factorized(self,
+                           iou_feature,
+                           score_diff_sign_feature,
+                           n_pair_features,
+                           hlayer_size,
+                           n_kernels=1,
+                           score_diff_feature=None):
+        """Same kernel as _kernel, but with the first layer evaluated per box where possible
+
+        The first 1x1 convolution is linear in [iou, f_i, f_j, sign(f_i - f_j), f_i - f_j],
+        so the object features part is computed as (W_i + W_d) f_i + (W_j - W_d) f_j
+        on [n_bboxes, n_features] and broadcast-added into the pairwise grid.
+        Only iou and sign channels are evaluated per pair. If score_diff_feature is given,
+        f_i - f_j channels are evaluated per pair as well (dense mode) and only W_i f_i, W_j f_j
+        are computed per box. Weights are stored exactly like the first convolution of _kernel,
+        so checkpoints are interchangeable between modes.
+        """
+
+        with tf.variable_scope(None, default_name='Conv'):
+            weights = slim.model_variable('weights',
+                                          shape=[1, 1, n_pair_features, hlayer_size],
+                                          initializer=slim.xavier_initializer())
+            biases = slim.model_variable('biases',
+                                         shape=[hlayer_size],
+                                         initializer=tf.zeros_initializer())
+
+            weights = tf.reshape(weights, [n_pair_features, hlayer_size])
+
+            pairwise_terms = []
+            offset = 0
+
+            if self.use_iou_features:
+                pairwise_terms.append(tf.multiply(iou_feature, weights[0]))
+                offset += 1
+
+            if self.use_object_features:
+                n_obj_features = self.n_dt_features
+                w_i = weights[offset:offset+n_obj_features]
+                w_j = weights[offset+n_obj_features:offset+2*n_obj_features]
+                w_sign = weights[offset+2*n_obj_features:offset+3*n_obj_features]
+                w_diff = weights[offset+3*n_obj_features:offset+4*n_obj_features]
+
+                if score_diff_feature is None:
+                    w_i += w_diff
+                    w_j -= w_diff
+                    pairwise_features = score_diff_sign_feature
+                    w_pairwise = w_sign
+                else:
+                    pairwise_features = tf.concat(axis=-1, values=[score_diff_sign_feature, score_diff_feature])
+                    w_pairwise = tf.concat(axis=0, values=[w_sign, w_diff])
+
+                features_flat = tf.reshape(self.dt_features_merged, [-1, n_obj_features])
+                unary_shape = tf.concat([tf.shape(self.dt_features_merged)[:-1], [hlayer_size]], axis=0)
+                unary_i = tf.reshape(tf.matmul(features_flat, w_i), unary_shape)
+                unary_j = tf.reshape(tf.matmul(features_flat, w_j), unary_shape)
+                pairwise_terms.append(tf.expand_dims(unary_i, axis=-2) + tf.expand_dims(unary_j, axis=-3))
+
+                pairwise_flat = tf.reshape(pairwise_features, [-1, w_pairwise.get_shape().as_list()[0]])
+                pairwise_shape = tf.concat([tf.shape(pairwise_features)[:-1], [hlayer_size]], axis=0)
+                pairwise_terms.append(tf.reshape(tf.matmul(pairwise_flat, w_pairwise), pairwise_shape))
+
+            # self-pairs have all input channels zeroed in _kernel, so only bias remains for them
+            pre_activation = spatial.remove_self_pairs_tf(tf.add_n(pairwise_terms)) + biases
+
+            pre_activation_shape = tf.shape(pre_activation)
+            conv1 = tf.reshape(tf.nn.relu(pre_activation),
+                               [-1, self.n_bboxes, self.n_bboxes, hlayer_size])
+
+        conv3 = self._kernel_output_layers(conv1, hlayer_size, n_kernels)
+
+        return tf.reshape(conv3, tf.concat([pre_activation_shape[:-1], [n_kernels]], axis=0))
+
+    def _neighbourhood_edges(self, iou, dt_mask):
+        """Construct list of (frame, i, j) box pairs the kernel is evaluated on in sparse mode
+
+        'iou' mode keeps all pairs with IoU above neighbourhood_iou_thr,
+        'knn' mode keeps neighbourhood_k most overlapping other boxes for every box.
+        Self-pairs are always kept (as in dense mode, their features are zeroed in _kernel_sparse),
+        so with all pairs kept the result equals dense mode. Pairs with padded boxes get zero weight.
+
+        Parameters
+        ----------
+        iou - Tensor of shape [batch_size, n_bboxes, n_bboxes]
+        dt_mask - Tensor of shape [batch_size, n_bboxes] marking valid boxes
+
+        Returns
+        -------
+        edges_b, edges_i, edges_j - frame and box indices of every edge
+        edges_weight - 1.0 for valid edges, 0.0 otherwise
+        """
+
+        is_valid_pair = tf.expand_dims(dt_mask, 2) * tf.expand_dims(dt_mask, 1)
+        is_self_pair = tf.eye(self.n_bboxes)
+
+        if self.kernel_neighbourhood == 'knn':
+            # self-pairs get IoU above and invalid pairs below any real pair,
+            # so every box picks itself first and padded boxes last
+            iou_valid = (iou * (1 - is_self_pair) + 2 * is_self_pair) * is_valid_pair - (1 - is_valid_pair)
+            n_neighbours = tf.minimum(self.neighbourhood_k + 1, self.n_bboxes)
+            _, edges_j = tf.nn.top_k(iou_valid, k=n_neighbours)
+            edges_shape = tf.shape(edges_j)
+            edges_b = tf.reshape(tf.range(edges_shape[0]), [-1, 1, 1]) + tf.zeros_like(edges_j)
+            edges_i = tf.reshape(tf.range(edges_shape[1]), [1, -1, 1]) + tf.zeros_like(edges_j)
+            edges = tf.stack([tf.reshape(edges_b, [-1]),
+                              tf.reshape(edges_i, [-1]),
+                              tf.reshape(edges_j, [-1])], axis=1)
+        else:
+            is_neighbour = tf.logical_and(tf.logical_or(tf.greater(iou, self.neighbourhood_iou_thr),
+                                                        tf.greater(is_self_pair, 0)),
+                                          tf.greater(is_valid_pair, 0))
+            edges = tf.to_int32(tf.where(is_neighbour))
+
+        edges_weight = tf.gather_nd(is_valid_pair, edges)
+
+        return edges[:, 0], edges[:, 1], edges[:, 2], edges_weight
+
+    def _kernel_sparse(self,
+                       iou,
+                       n_pair_features,
+                       hlayer_size,
+                       n_kernels=1):
+        """Evaluate kernel only on neighbouring box pairs and aggregate it per box
+
+        Edge features follow the channel layout of the dense pairwise tensor,
+        so kernel weights are shared with dense mode.
+
+        Returns
+        -------
+        kernel_max, kernel_sum - Tensors of shape [n_bboxes, n_kernels] (batched if the model is)
+        """
+
+        if self.is_batched:
+            dt_features = self.dt_features_merged
+            dt_mask = self.dt_mask
+        else:
+            iou = tf.expand_dims(iou, 0)
+            dt_features = tf.expand_dims(self.dt_features_merged, 0)
+            dt_mask = tf.ones([1, self.n_bboxes])
+
+        batch_size = tf.shape(iou)[0]
+
+        edges_b, edges_i, edges_j, edges_weight = self._neighbourhood_edges(iou, dt_mask)
+
+        edge_features_list = []
+
+        if self.use_iou_features:
+            edge_iou = tf.gather_nd(iou, tf.stack([edges_b, edges_i, edges_j], axis=1))
+            edge_features_list.append(tf.expand_dims(edge_iou, axis=1))
+
+        if self.use_object_features:
+            obj_features_i = tf.gather_nd(dt_features, tf.stack([edges_b, edges_i], axis=1))
+            obj_features_j = tf.gather_nd(dt_features, tf.stack([edges_b, edges_j], axis=1))
+            score_diff_feature = obj_features_i - obj_features_j
+            edge_features_list.append(obj_features_i)
+            edge_features_list.append(obj_features_j)
+            edge_features_list.append(tf.sign(score_diff_feature))
+            edge_features_list.append(score_diff_feature)
+
+        # self-pairs have all input features zeroed, as in dense mode
+        is_not_self_edge = tf.to_float(tf.not_equal(edges_i, edges_j))
+        edge_features = tf.concat(axis=1, values=edge_features_list) * tf.expand_dims(is_not_self_edge, 1)
+        edge_features = tf.expand_dims(edge_features, axis=0)
+
+        kernel_features = self._kernel(edge_features,
+                                       n_pair_features,
+                                       hlayer_size=hlayer_size,
+                                       n_kernels=n_kernels)
+
+        kernel_features_sigmoid = tf.nn.sigmoid(tf.squeeze(kernel_features, axis=0))
+        kernel_features_sigmoid *= tf.expand_dims(edges_weight, 1)
+
+        segment_ids = edges_b * self.n_bboxes + edges_i
+        n_segments = batch_size * self.n_bboxes
+        output_shape = [batch_size, self.n_bboxes, n_kernels]
+
+        # boxes without neighbours get the lowest float value as segment max, kernel outputs are non-negative
+        kernel_max = tf.maximum(tf.unsorted_segment_max(kernel_features_sigmoid, segment_ids, n_segments), 0.0)
+        kernel_max = tf.reshape(kernel_max, output_shape)
+
+        kernel_sum = tf.unsorted_segment_sum(kernel_features_sigmoid, segment_ids, n_segments)
+        kernel_sum = tf.reshape(kernel_sum, output_shape)
+
+        if not self.is_batched:
+            kernel_max = kernel_max[0]
+            kernel_sum = kernel_sum[0]
+
+        return kernel_max, kernel_sum
+
+    def _kernel_output_layers(self, conv1, hlayer_size, n_kernels):
+
         conv2 = slim.layers.conv2d(
             conv1,
             hlayer_size,
@@ -363,39 +586,36 @@ class NMSNetwork:
             [1, 1],
             activation_fn=None)
 
-        pairwise_potentials = tf.squeeze(conv3, axis=0)
+        return conv3
 
-        return pairwise_potentials
+    def _detection_labels(self, dt_gt_iou, gt_labels, dt_probs):
 
-    def _detection_loss_ops(self):
-
-        classes_labels_independent = []
         classes_labels_final = []
 
-        pairwise_dt_gt_coords = spatial.construct_pairwise_features_tf(
-            self.dt_coords, self.gt_coords)
-
-        dt_gt_iou = tf.squeeze(spatial.compute_pairwise_spatial_features_iou_tf(pairwise_dt_gt_coords), 2)
-
         for class_id in range(0, self.n_classes):
 
-            class_labels_independent = losses.construct_independent_labels(dt_gt_iou,
-                                                                           self.gt_labels,
-                                                                           class_id,
-                                                                           iou_threshold=self.gt_match_iou_thr)
+            gt_per_label = losses.construct_ground_truth_per_label_tf(dt_gt_iou, gt_labels, class_id,
+                                                                      iou_threshold=self.gt_match_iou_thr)
 
-            classes_labels_independent.append(class_labels_independent)
+            classes_labels_final.append(losses.compute_match_gt_net_per_label_tf(dt_probs,
+                                                                                 gt_per_label,
+                                                                                 class_id))
 
-            gt_per_label = losses.construct_ground_truth_per_label_tf(dt_gt_iou, self.gt_labels, class_id,
-                                                                      iou_threshold=self.gt_match_iou_thr)
+        return tf.stack(classes_labels_final, axis=1)
+
+    def _detection_loss_ops(self):
 
-            classes_labels_final.append(losses.compute_match_gt_net_per_label_tf(self.dt_probs_ini,
-                                                                         gt_per_label,
-                                                                         class_id))
+        dt_gt_iou = spatial.compute_pairwise_iou_tf(self.dt_coords, self.gt_coords)
 
-        # self.classes_labels_independent = tf.stack(classes_labels_independent, axis=1)
-        self.classes_labels_final = tf.stack(classes_labels_final, axis=1)
-        # self.filter_labels = tf.to_float(tf.equal(self.classes_labels_independent, self.classes_labels_final))
+        if self.is_batched:
+            # padded detections can't match anything, padded gt boxes are labelled -1 and match no class
+            is_valid_dt = tf.expand_dims(self.dt_mask, 2) * tf.ones_like(dt_gt_iou) > 0
+            dt_gt_iou = tf.where(is_valid_dt, dt_gt_iou, tf.zeros_like(dt_gt_iou))
+            self.classes_labels_final = tf.map_fn(lambda frame: self._detection_labels(*frame),
+                                                  (dt_gt_iou, self.gt_labels, self.dt_probs_ini),
+                                                  dtype=tf.float32)
+        else:
+            self.classes_labels_final = self._detection_labels(dt_gt_iou, self.gt_labels, self.dt_probs_ini)
 
         labels = self.classes_labels_final
 
@@ -412,10 +632,24 @@ class NMSNetwork:
 
         # det_loss_final_weighted = tf.reduce_mean(weighted_loss, name='detection_loss_weighted')
 
-        det_loss_final = tf.reduce_mean(loss, name='detection_loss')
+        det_loss_final = self._masked_mean(loss, name='detection_loss')
 
         return labels, det_loss_final
 
+    def _masked_mean(self, elementwise_loss, name=None):
+        """Mean of per-box loss over valid boxes only
+
+        elementwise_loss has shape [..., n_bboxes] or [..., n_bboxes, n_classes]
+        """
+        if not self.is_batched:
+            return tf.reduce_mean(elementwise_loss, name=name)
+        mask = self.dt_mask
+        if elementwise_loss.get_shape().ndims == 3:
+            mask = tf.expand_dims(mask, 2) * tf.ones_like(elementwise_loss)
+        # loss of padded boxes is selected out rather than multiplied by 0, so it can't turn the sum into NaN
+        masked_loss = tf.where(mask > 0, elementwise_loss, tf.zeros_like(elementwise_loss))
+        return tf.div(tf.reduce_sum(masked_loss), tf.maximum(tf.reduce_sum(mask), 1.0), name=name)
+
     def _pairwise_nms_loss(self):
 
         suppression_map = self.pairwise_features[:, :, self.n_dt_features+1] > self.pairwise_features[:, :, 1]
@@ -442,43 +676,31 @@ class NMSNetwork:
 
     def _nms_loss_ops(self):
 
-        if self.n_classes == 1:
+        probs_i, probs_j = spatial.construct_pairwise_features_tf(self.dt_probs_ini, as_pair=True)
 
-            self.pairwise_probs_features = spatial.construct_pairwise_features_tf(self.dt_probs_ini)
+        iou_map = self.iou_feature[..., 0] > self.nms_label_iou
 
-            suppression_map = self.pairwise_probs_features[:, :, 1] > \
-                              self.pairwise_probs_features[:, :, 0]
+        if self.is_batched:
+            # padded boxes can't suppress anything
+            iou_map = tf.logical_and(iou_map, tf.expand_dims(self.dt_mask, 1) > 0)
 
-            iou_map = self.iou_feature[:, :, 0] > self.nms_label_iou
+        nms_labels = []
 
-            nms_pairwise_labels = tf.to_float(tf.logical_and(suppression_map, iou_map))
+        # background_class_labels = tf.ones([self.n_bboxes, 1])
 
-            nms_labels = 1 - tf.reshape(tf.reduce_max(nms_pairwise_labels, axis=1), [self.n_bboxes, 1])
+        # nms_labels.append(background_class_labels)
 
-        else:
-
-            self.pairwise_probs_features = spatial.construct_pairwise_features_tf(self.dt_probs_ini)
-
-            nms_labels = []
-
-            # background_class_labels = tf.ones([self.n_bboxes, 1])
-
-            # nms_labels.append(background_class_labels)
-
-            for class_id in range(0, self.n_classes):
-
-                suppression_map = self.pairwise_probs_features[:, :, class_id + self.n_classes] >\
-                                  self.pairwise_probs_features[:, :, class_id]
+        for class_id in range(0, self.n_classes):
 
-                iou_map = self.iou_feature[:, :, 0] > self.nms_label_iou
+            suppression_map = probs_j[..., class_id] > probs_i[..., class_id]
 
-                nms_pairwise_labels = tf.to_float(tf.logical_and(suppression_map, iou_map))
+            nms_pairwise_labels = tf.to_float(tf.logical_and(suppression_map, iou_map))
 
-                class_nms_labels = 1 - tf.reshape(tf.reduce_max(nms_pairwise_labels, axis=1), [self.n_bboxes, 1])
+            class_nms_labels = 1 - tf.reduce_max(nms_pairwise_labels, axis=-1)
 
-                nms_labels.append(class_nms_labels)
+            nms_labels.append(class_nms_labels)
 
-            nms_labels = tf.squeeze(tf.stack(nms_labels, axis=1), axis=2)
+        nms_labels = tf.stack(nms_labels, axis=-1)
 
         # suppression_map = self.pairwise_obj_features[:, :,
         #                   self.n_dt_features+1] > self.pairwise_obj_features[:, :, 1]
@@ -488,7 +710,7 @@ class NMSNetwork:
         nms_elementwise_loss = tf.nn.sigmoid_cross_entropy_with_logits(labels=nms_labels,
                                                                        logits=self.logits)
 
-        nms_loss_final = tf.reduce_mean(nms_elementwise_loss, name='nms_loss')
+        nms_loss_final = self._masked_mean(nms_elementwise_loss, name='nms_loss')
 
         # weighted_loss = tf.multiply(nms_elementwise_loss, 10*self.dt_probs_ini)
         #
@@ -497,13 +719,13 @@ class NMSNetwork:
         return nms_labels, nms_loss_final
 
     def _final_cross_entropy_loss(self):
-        labels_ohe = tf.stack([1-self.det_labels, self.det_labels], axis=2)
-        probs_ohe = tf.stack([1-self.class_scores, self.class_scores], axis=2)
+        labels_ohe = tf.stack([1-self.det_labels, self.det_labels], axis=-1)
+        probs_ohe = tf.stack([1-self.class_scores, self.class_scores], axis=-1)
         clipped_probs = tf.clip_by_value(probs_ohe, 0.0001, 0.9999)
         loss = -tf.reduce_sum(labels_ohe * tf.log(clipped_probs),
-                                                      reduction_indices=[2])
+                                                      reduction_indices=[-1])
         # weighted_loss = tf.multiply(loss, 10*self.dt_probs_ini)
-        cross_entropy = tf.reduce_mean(loss)
+        cross_entropy = self._masked_mean(loss)
         return cross_entropy
 
     def _fc_layer_chain(self,
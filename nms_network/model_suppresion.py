@@ -123,13 +123,10 @@ class NMSNetwork:
                                                     n_layers=self.fc_pre_layers_cnt,
                                                     scope='fc_pre_layer_knet')
 
-        pairwise_coords_features = spatial.construct_pairwise_features_tf(
-            self.dt_coords)
-
         spatial_features_list = []
         n_spatial_features = 0
 
-        iou_feature = spatial.compute_pairwise_spatial_features_iou_tf(pairwise_coords_features)
+        iou_feature = tf.expand_dims(spatial.compute_pairwise_iou_tf(self.dt_coords), axis=2)
 
         if self.use_iou_features:
             spatial_features_list.append(iou_feature)
@@ -141,20 +138,14 @@ class NMSNetwork:
             n_spatial_features += dt_features_pre_knet.get_shape().as_list()[1] * 2
 
         if self.use_coords_features:
+            pairwise_coords_features = spatial.construct_pairwise_features_tf(
+                self.dt_coords)
             spatial_features_list.append(pairwise_coords_features)
             n_spatial_features += self.n_dt_coords * 2
 
         spatial_features = tf.concat(axis=2, values=spatial_features_list)
 
-        diagonals = []
-
-        for i in range(0, n_spatial_features):
-            d = tf.expand_dims(tf.diag(tf.diag_part(spatial_features[:, :, i])), axis=2)
-            diagonals.append(d)
-
-        diag = tf.concat(axis=2, values=diagonals)
-
-        spatial_features = spatial_features - diag
+        spatial_features = spatial.remove_self_pairs_tf(spatial_features)
 
         spatial_features = tf.reshape(spatial_features, [self.n_bboxes, n_spatial_features*self.n_bboxes])
 
@@ -177,10 +168,7 @@ class NMSNetwork:
 
         class_labels = []
 
-        pairwise_dt_gt_coords = spatial.construct_pairwise_features_tf(
-            self.dt_coords, self.gt_coords)
-
-        dt_gt_iou = tf.squeeze(spatial.compute_pairwise_spatial_features_iou_tf(pairwise_dt_gt_coords), 2)
+        dt_gt_iou = spatial.compute_pairwise_iou_tf(self.dt_coords, self.gt_coords)
 
         for class_id in range(0, self.n_classes):
             gt_per_label = losses.construct_ground_truth_per_label_tf(dt_gt_iou, self.gt_labels, class_id)
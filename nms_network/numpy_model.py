@@ -0,0 +1,202 @@
+"""NumPy reimplementation of NMSNetwork forward pass
+
+Runs inference with trained weights without TensorFlow, e.g. for CPU-only
+batch rescoring in a multiprocessing pool. Weights are converted once:
+
+    convert_checkpoint(checkpoint_path, 'knet_weights.npz')
+
+and then used with NumpyNMSNetwork:
+
+    nnms_model = NumpyNMSNetwork('knet_weights.npz', **config['nms_network'])
+    class_scores, filter_scores = nnms_model.rescore(dt_coords, dt_features, dt_probs)
+
+Outputs match NMSNetwork._inference_ops up to float32 rounding.
+"""
+
+import numpy as np
+
+VAR_SCOPE = 'nms_network'
+
+KERNEL_LAYERS = ['Conv', 'Conv_1', 'Conv_2']
+FC_LAYERS = ['fully_connected', 'fully_connected_1', 'fully_connected_2']
+
+
+def convert_checkpoint(checkpoint_path, output_path):
+    """Save weights of nms_network scope from TF checkpoint into .npz file
+
+    This is the only function of the module that needs TensorFlow.
+    """
+    import tensorflow as tf
+
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+
+    weights = {}
+    for layer_name in KERNEL_LAYERS + FC_LAYERS:
+        for var_name in ['weights', 'biases']:
+            full_name = VAR_SCOPE + '/' + layer_name + '/' + var_name
+            weights[layer_name + '/' + var_name] = reader.get_tensor(full_name)
+
+    np.savez(output_path, **weights)
+
+    return weights
+
+
+def _relu(x):
+    return np.maximum(x, 0)
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def _pairwise_iou(boxes):
+    """IoU between all pairs of boxes of format [x1, y1, x2, y2], same as spatial.compute_pairwise_iou_tf
+    """
+    x1, y1, x2, y2 = [boxes[:, i] for i in range(4)]
+    x_overlap = np.maximum(0.0, np.minimum(x2[:, None], x2[None, :]) - np.maximum(x1[:, None], x1[None, :]))
+    y_overlap = np.maximum(0.0, np.minimum(y2[:, None], y2[None, :]) - np.maximum(y1[:, None], y1[None, :]))
+    intersection = x_overlap * y_overlap
+    area = (x2 - x1) * (y2 - y1)
+    union = area[:, None] + area[None, :] - intersection
+    # pairs of degenerate boxes have zero union and get IoU 0, as in the TF version
+    has_union = union > 0
+    return np.where(has_union, intersection / np.where(has_union, union, 1), 0)
+
+
+class NumpyNMSNetwork:
+
+    def __init__(self,
+                 weights,
+                 n_classes=1,
+                 **kwargs):
+        """
+        Parameters
+        ----------
+        weights - path to .npz produced by convert_checkpoint or dict with the same keys
+        n_classes - number of classes
+        kwargs - nms_network section of experiment config (same as for NMSNetwork)
+        """
+
+        if isinstance(weights, str):
+            weights = dict(np.load(weights))
+
+        self.n_classes = n_classes
+
+        arch_args = kwargs.get('architecture', {})
+        self.use_iou_features = arch_args.get('use_iou_features', True)
+        self.use_object_features = arch_args.get('use_object_features', True)
+        self.kernel_neighbourhood = arch_args.get('kernel_neighbourhood', 'dense')
+        self.neighbourhood_iou_thr = arch_args.get('neighbourhood_iou_thr', 0.0)
+        self.neighbourhood_k = arch_args.get('neighbourhood_k', 10)
+
+        train_args = kwargs.get('training', {})
+        self.loss_type = train_args.get('loss_type', 'detection')
+
+        self.filter_threshold = 0.5
+
+        self.kernel_weights = [(weights[name + '/weights'].reshape(weights[name + '/weights'].shape[-2:]),
+                                weights[name + '/biases']) for name in KERNEL_LAYERS]
+        self.fc_weights = [(weights[name + '/weights'], weights[name + '/biases']) for name in FC_LAYERS]
+
+    def _kernel(self, iou, dt_features):
+        """Kernel outputs (after sigmoid) for every box pair, array of shape [n_bboxes, n_bboxes, n_kernels]
+
+        First layer is evaluated in factorized form (see NMSNetwork._kernel_factorized),
+        remaining 1x1 convolutions are matmuls over flattened pairwise grid.
+        """
+        n_bboxes = iou.shape[0]
+        weights, biases = self.kernel_weights[0]
+
+        pre_activation = np.zeros([n_bboxes, n_bboxes, weights.shape[1]], dtype=np.float32)
+        offset = 0
+
+        if self.use_iou_features:
+            pre_activation += iou[:, :, None] * weights[0]
+            offset += 1
+
+        if self.use_object_features:
+            n_obj_features = dt_features.shape[1]
+            w_i, w_j, w_sign, w_diff = [weights[offset+k*n_obj_features:offset+(k+1)*n_obj_features]
+                                        for k in range(4)]
+            pre_activation += np.dot(dt_features, w_i + w_diff)[:, None, :]
+            pre_activation += np.dot(dt_features, w_j - w_diff)[None, :, :]
+            score_diff_sign = np.sign(dt_features[:, None, :] - dt_features[None, :, :])
+            pre_activation += np.dot(score_diff_sign.reshape(n_bboxes * n_bboxes, n_obj_features),
+                                     w_sign).reshape(n_bboxes, n_bboxes, -1)
+
+        # self-pairs have all input features zeroed
+        pre_activation[np.arange(n_bboxes), np.arange(n_bboxes)] = 0
+        hidden = _relu(pre_activation + biases).reshape(n_bboxes * n_bboxes, -1)
+
+        weights, biases = self.kernel_weights[1]
+        hidden = _relu(np.dot(hidden, weights) + biases)
+
+        weights, biases = self.kernel_weights[2]
+        kernel_features = _sigmoid(np.dot(hidden, weights) + biases)
+
+        return kernel_features.reshape(n_bboxes, n_bboxes, -1)
+
+    def _neighbourhood_mask(self, iou):
+        """Pairs the kernel is aggregated over in sparse modes (see NMSNetwork._neighbourhood_edges)
+        """
+        n_bboxes = iou.shape[0]
+        is_self = np.eye(n_bboxes, dtype=np.float32)
+
+        if self.kernel_neighbourhood == 'knn':
+            n_neighbours = min(self.neighbourhood_k, n_bboxes - 1)
+            iou_valid = iou * (1 - is_self) - is_self
+            # stable sort picks lower indices first among equal values, same as tf.nn.top_k
+            neighbours = np.argsort(-iou_valid, axis=1, kind='mergesort')[:, 0:n_neighbours]
+            mask = np.copy(is_self)
+            mask[np.arange(n_bboxes)[:, None], neighbours] = 1
+            return mask
+        else:
+            # self-pairs are always kept, as in dense mode
+            return np.maximum(iou > self.neighbourhood_iou_thr, is_self)
+
+    def rescore(self, dt_coords, dt_features, dt_probs):
+        """Compute new detection scores for a single frame
+
+        Parameters
+        ----------
+        dt_coords - array of shape [n_bboxes, 4]
+        dt_features - array of shape [n_bboxes, n_dt_features]
+        dt_probs - array of shape [n_bboxes, n_classes]
+
+        Returns
+        -------
+        class_scores - initial scores with suppressed detections zeroed, [n_bboxes, n_classes]
+        filter_scores - network output probabilities, [n_bboxes, n_classes]
+        """
+        dt_coords = np.asarray(dt_coords, dtype=np.float32)
+        dt_probs = np.asarray(dt_probs, dtype=np.float32)
+
+        if self.loss_type == 'nms':
+            dt_features_merged = dt_probs
+        else:
+            dt_features_merged = np.hstack([dt_probs, np.asarray(dt_features, dtype=np.float32)])
+
+        iou = _pairwise_iou(dt_coords)
+
+        kernel_features = self._kernel(iou, dt_features_merged)
+
+        if self.kernel_neighbourhood in ['iou', 'knn']:
+            kernel_features = kernel_features * self._neighbourhood_mask(iou)[:, :, None]
+
+        kernel_max = np.max(kernel_features, axis=1)
+        kernel_sum = np.sum(kernel_features, axis=1)
+
+        fc_input = np.hstack([dt_features_merged, kernel_max, kernel_sum])
+
+        weights, biases = self.fc_weights[0]
+        fc1 = _relu(np.dot(fc_input, weights) + biases)
+
+        weights, biases = self.fc_weights[1]
+        fc2 = _relu(np.dot(fc1, weights) + biases)
+
+        weights, biases = self.fc_weights[2]
+        filter_scores = _sigmoid(np.dot(fc2, weights) + biases)
+
+        class_scores = (filter_scores > self.filter_threshold) * dt_probs
+
+        return class_scores, filter_scores
@@ -6,40 +6,69 @@ import tensorflow as tf
 
 def construct_pairwise_features_tf(features_1,
                                    features_2=None,
+                                   as_pair=False,
                                    name_or_scope=None):
     """Construct pairwise features matrix
 
+    Pairs are built by broadcasting rather than tiling, so no intermediate
+    [n1_objects * n2_objects, n_features] copies are allocated.
+
     Parameters
     -------
-    features_1 - Tensor of shape [n1_objects, n_features]
-    features_2 - second Tensor of shape [n2_objects, n_features].
+    features_1 - Tensor of shape [n1_objects, n_features] or [batch_size, n1_objects, n_features]
+    features_2 - second Tensor of shape [n2_objects, n_features] (or batched).
                 If None, construct pairwise terms from first matrix only
+    as_pair - if True, return the two halves lazily as a tuple of broadcastable
+                Tensors of shapes [n1_objects, 1, n_features] and [1, n2_objects, n_features]
+                instead of materializing the full pairwise matrix
     Returns
     --------
-    Tensor of shape [1, n1_objects, n2_objects, n_features*2] (ready for knet convolution)
+    Tensor of shape [n1_objects, n2_objects, n_features*2] (ready for knet convolution)
+    or a tuple of two broadcastable Tensors if as_pair is set. Batched inputs get
+    leading batch dimension in all outputs.
     """
     with tf.variable_scope(name_or_scope,
                            default_name='pairwise_features',
                            values=[features_1]):
         if features_2 is None:
             features_2 = features_1
-        # We only support flat features.
-        features_1.get_shape().assert_has_rank(2)
-        t1_shape = tf.shape(features_1)
-        t2_shape = tf.shape(features_2)
-        n1_hypotheses = t1_shape[0]
-        n2_hypotheses = t2_shape[0]
-        n_features = features_1.get_shape().as_list()[1]
+        # We only support flat features (optionally batched).
+        features_1.get_shape().with_rank_at_least(2).with_rank_at_most(3)
+
+        pair_1 = tf.expand_dims(features_1, axis=-2)
+        pair_2 = tf.expand_dims(features_2, axis=-3)
+
+        if as_pair:
+            return pair_1, pair_2
+
+        # adding zeros of the other half's shape broadcasts each half to
+        # [n1_objects, n2_objects, n_features] in a single pass
+        pair_1_full = pair_1 + tf.zeros_like(pair_2)
+        pair_2_full = tf.zeros_like(pair_1) + pair_2
 
-        pair_1 = tf.tile(features_1, [1, n2_hypotheses])
-        pair_1 = tf.reshape(pair_1, [-1, n_features])
+        return tf.concat(axis=-1, values=[pair_1_full, pair_2_full])
 
-        pair_2 = tf.tile(features_2, [n1_hypotheses, 1])
-        pairwise_features = tf.concat(axis=1, values=[pair_1, pair_2])
 
-        return tf.reshape(
-            pairwise_features,
-            [n1_hypotheses, n2_hypotheses, n_features * 2])
+def remove_self_pairs_tf(pairwise_features, name_or_scope=None):
+    """Zero out features of self-pairs (diagonal of pairwise matrix)
+
+    Parameters
+    ----------
+    pairwise_features - Tensor of format [n_hypotheses, n_hypotheses, n_features]
+                        or [batch_size, n_hypotheses, n_hypotheses, n_features]
+    name_or_scope
+
+    Returns
+    -------
+    Tensor of the same format with all channels of (i, i) pairs set to zero
+    """
+    with tf.variable_scope(name_or_scope,
+                           default_name='remove_self_pairs',
+                           values=[pairwise_features]):
+        pairwise_features.get_shape().with_rank_at_least(3).with_rank_at_most(4)
+        n_hypotheses = tf.shape(pairwise_features)[-2]
+        off_diagonal_mask = tf.expand_dims(1 - tf.eye(n_hypotheses, dtype=pairwise_features.dtype), axis=2)
+        return tf.multiply(pairwise_features, off_diagonal_mask)
 
 
 def compute_overlap(zeros, pos_1, dim_1, pos_2, dim_2, name_or_scope=None):
@@ -82,6 +111,54 @@ def compute_union(width_1, height_1, width_2, height_2,
         return tf.subtract(total, intersection, name='union')
 
 
+def compute_pairwise_iou_tf(boxes_1, boxes_2=None, name_or_scope=None):
+    """Compute intersection over union between two sets of boxes
+
+    Unlike compute_pairwise_spatial_features_iou_tf this works on raw box lists,
+    so no pairwise coordinates tensor has to be constructed beforehand.
+
+    Parameters
+    ----------
+    boxes_1 - Tensor of shape [n1_hypotheses, 4] with boxes in format [x1, y1, x2, y2]
+                or [batch_size, n1_hypotheses, 4]
+    boxes_2 - Tensor of shape [n2_hypotheses, 4] with boxes in format [x1, y1, x2, y2]
+                (batched if boxes_1 is). If None, compute IoU between boxes of the first set
+    name_or_scope
+
+    Returns
+    -------
+    Tensor of format [n1_hypotheses, n2_hypotheses] (or [batch_size, n1_hypotheses, n2_hypotheses])
+    containing intersection over union for each bbox pair (0 for pairs with zero union)
+    """
+    with tf.variable_scope(
+            name_or_scope,
+            default_name='compute_pairwise_iou',
+            values=[boxes_1]):
+        if boxes_2 is None:
+            boxes_2 = boxes_1
+        boxes_1.get_shape().with_rank_at_least(2).with_rank_at_most(3)
+        boxes_2.get_shape().with_rank_at_least(2).with_rank_at_most(3)
+
+        # [n1_hypotheses, 1] and [1, n2_hypotheses] columns broadcast against each other
+        x11, y11, x12, y12 = tf.unstack(tf.expand_dims(boxes_1, -2), num=4, axis=-1)
+        x21, y21, x22, y22 = tf.unstack(tf.expand_dims(boxes_2, -3), num=4, axis=-1)
+
+        x_overlap = tf.maximum(0.0, tf.minimum(x12, x22) - tf.maximum(x11, x21), name='x_overlap')
+        y_overlap = tf.maximum(0.0, tf.minimum(y12, y22) - tf.maximum(y11, y21), name='y_overlap')
+
+        intersection = tf.multiply(x_overlap, y_overlap, name='intersection')
+
+        area_1 = tf.multiply(x12 - x11, y12 - y11, name='rectangle_1')
+        area_2 = tf.multiply(x22 - x21, y22 - y21, name='rectangle_2')
+        union = tf.subtract(area_1 + area_2, intersection, name='union')
+
+        # pairs of degenerate boxes (e.g. zero padding) have zero union and get IoU 0,
+        # division is done by a safe denominator so that gradients stay finite as well
+        has_union = union > 0
+        safe_union = tf.where(has_union, union, tf.ones_like(union))
+        return tf.where(has_union, tf.div(intersection, safe_union), tf.zeros_like(union), name='iou')
+
+
 def compute_pairwise_spatial_features_iou_tf(
         pairwise_spatial_features, name_or_scope=None):
     """
@@ -28,6 +28,11 @@ if [[ "y" == "${USER_CONFIRM_RESULT}" ]];then
              numpy scipy matplotlib joblib ipdb python-gflags google-apputils autopep8 yaml pandas
 fi
 
+dbash::user_confirm ">> Install numba (optional compiled NMS and matching kernels)?" "n"
+if [[ "y" == "${USER_CONFIRM_RESULT}" ]];then
+    ${PYENV}/bin/pip install --upgrade numba
+fi
+
 dbash::user_confirm ">> Install tensorflow gpu MAC?" "n"
 if [[ "y" == "${USER_CONFIRM_RESULT}" ]];then
     dbash::pp "Please install cuda 8.0 from nvidia!"
@@ -0,0 +1,76 @@
+"""Compiled kernels (tools.jit_kernels) and NumPy implementations give identical results
+
+Without numba the kernels run as plain Python, so the comparison is meaningful either way.
+"""
+
+import numpy as np
+import pytest
+
+from tools import metrics
+from tools import nms
+
+
+def _random_iou(rng, n_rows, n_cols, symmetric=False):
+    # IoU quantized to few levels gives many ties, including values equal to the threshold
+    iou = rng.randint(0, 5, size=[n_rows, n_cols]) / 4.0
+    if symmetric:
+        iou = np.triu(iou, k=1)
+        iou = iou + iou.T
+        np.fill_diagonal(iou, 1.0)
+    return iou
+
+
+def _random_scores(rng, n_dt):
+    # scores rounded to one decimal give tied scores
+    return np.round(rng.rand(n_dt), 1)
+
+
+def _cases():
+    rng = np.random.RandomState(0)
+    cases = []
+    for n_dt, n_gt in [(0, 0), (0, 3), (1, 0), (1, 1), (5, 0), (20, 1), (30, 5), (50, 12)]:
+        for _ in range(0, 5):
+            cases.append((_random_iou(rng, n_dt, n_dt, symmetric=True),
+                          _random_iou(rng, n_dt, n_gt),
+                          _random_scores(rng, n_dt)))
+    return cases
+
+
+def _run_both(monkeypatch, module, func, *args, **kwargs):
+    monkeypatch.setattr(module, 'USE_COMPILED', True)
+    compiled = func(*[np.copy(arg) for arg in args], **kwargs)
+    monkeypatch.setattr(module, 'USE_COMPILED', False)
+    reference = func(*[np.copy(arg) for arg in args], **kwargs)
+    return compiled, reference
+
+
+def _assert_identical(compiled, reference):
+    assert compiled.dtype == reference.dtype
+    assert compiled.shape == reference.shape
+    np.testing.assert_array_equal(compiled, reference)
+
+
+@pytest.mark.parametrize('iou_thr', [0.25, 0.5])
+def test_nms_per_class(monkeypatch, iou_thr):
+    for dt_dt_iou, _, dt_scores in _cases():
+        compiled, reference = _run_both(monkeypatch, nms, nms.nms_per_class,
+                                        dt_dt_iou, dt_scores, iou_thr=iou_thr)
+        _assert_identical(compiled, reference)
+
+
+@pytest.mark.parametrize('iou_thr', [0.25, 0.5])
+def test_nms_per_class_with_oracle(monkeypatch, iou_thr):
+    for dt_dt_iou, dt_gt_iou, dt_scores in _cases():
+        compiled, reference = _run_both(monkeypatch, nms, nms.nms_per_class_with_oracle,
+                                        dt_dt_iou, dt_scores, dt_gt_iou, iou_thr=iou_thr)
+        _assert_identical(compiled, reference)
+
+
+@pytest.mark.parametrize('iou_thr', [0.25, 0.5])
+def test_match_dt_gt(monkeypatch, iou_thr):
+    for _, dt_gt_iou, dt_scores in _cases():
+        if len(dt_scores) == 0:
+            continue
+        compiled, reference = _run_both(monkeypatch, metrics, metrics.match_dt_gt,
+                                        dt_gt_iou, dt_scores, iou_thr=iou_thr)
+        _assert_identical(compiled, reference)
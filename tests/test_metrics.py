@@ -0,0 +1,121 @@
+"""Vectorized matching in tools.metrics agrees with sequential match_dt_gt on tie-heavy inputs"""
+
+import numpy as np
+import pytest
+
+from tools import metrics
+
+
+def _tied_frame(rng, n_dt, n_gt, n_classes):
+    # IoU and scores quantized to few levels, so ties in both are common
+    dt_gt_iou = rng.randint(0, 5, size=[n_dt, n_gt]) / 4.0
+    dt_predictions = np.round(rng.rand(n_dt, n_classes), 1)
+    # -1 labels are padding gt, which never match
+    gt_labels = rng.randint(-1, n_classes, size=n_gt)
+    return dt_gt_iou, gt_labels, dt_predictions
+
+
+@pytest.mark.parametrize('with_suppression', [False, True])
+@pytest.mark.parametrize('iou_thr', [0.25, 0.5])
+def test_match_dt_gt_all_classes_batched(with_suppression, iou_thr):
+    rng = np.random.RandomState(0)
+    for n_dt, n_gt, n_classes in [(10, 0, 3), (10, 1, 1), (20, 5, 3), (40, 12, 4), (60, 30, 2)]:
+        for _ in range(0, 20):
+            dt_gt_iou, gt_labels, dt_predictions = _tied_frame(rng, n_dt, n_gt, n_classes)
+            dt_is_suppressed_info = None
+            if with_suppression:
+                dt_is_suppressed_info = rng.rand(n_dt, n_classes) < 0.3
+            expected = metrics.match_dt_gt_all_classes(dt_gt_iou, gt_labels, dt_predictions, iou_thr=iou_thr,
+                                                       dt_is_suppressed_info=dt_is_suppressed_info)
+            actual = metrics.match_dt_gt_all_classes_batched(dt_gt_iou, gt_labels, dt_predictions, iou_thr=iou_thr,
+                                                             dt_is_suppressed_info=dt_is_suppressed_info)
+            np.testing.assert_array_equal(actual, expected)
+
+
+def test_match_dt_gt_multi_thr():
+    rng = np.random.RandomState(0)
+    iou_thrs = [0.25, 0.5, 0.75]
+    for n_dt, n_gt in [(1, 1), (10, 3), (40, 12)]:
+        for _ in range(0, 20):
+            dt_gt_iou, _, dt_predictions = _tied_frame(rng, n_dt, n_gt, 1)
+            predictions = dt_predictions[:, 0]
+            actual = metrics.match_dt_gt_multi_thr(dt_gt_iou, predictions, iou_thrs)
+            for thr_ix, iou_thr in enumerate(iou_thrs):
+                np.testing.assert_array_equal(actual[:, thr_ix],
+                                              metrics.match_dt_gt(dt_gt_iou, predictions, iou_thr=iou_thr))
+
+
+def _frames_matching(rng, n_frames, n_classes):
+    frames = []
+    for _ in range(0, n_frames):
+        n_dt = rng.randint(0, 30)
+        is_matched = rng.randint(-1, 2, size=[n_dt, n_classes]).astype(float)
+        dt_predictions = rng.rand(n_dt, n_classes)
+        gt_labels = rng.randint(0, n_classes, size=rng.randint(0, 10))
+        frames.append((is_matched, dt_predictions, gt_labels))
+    return frames
+
+
+def test_average_precision_accumulator_exact():
+    rng = np.random.RandomState(0)
+    n_classes = 3
+    frames = _frames_matching(rng, 50, n_classes)
+    expected_ap, _ = metrics.average_precision_all_classes(np.vstack([frame[0] for frame in frames]),
+                                                           np.vstack([frame[1] for frame in frames]),
+                                                           np.hstack([frame[2] for frame in frames]))
+
+    accumulator = metrics.AveragePrecisionAccumulator(n_classes)
+    for frame in frames:
+        accumulator.update(*frame)
+    classes_ap, _ = accumulator.average_precision_all_classes()
+    np.testing.assert_allclose(classes_ap, expected_ap)
+
+    # results of several workers are merged
+    accumulators = [metrics.AveragePrecisionAccumulator(n_classes) for _ in range(0, 3)]
+    for frame_ix, frame in enumerate(frames):
+        accumulators[frame_ix % 3].update(*frame)
+    merged = accumulators[0].merge(accumulators[1]).merge(accumulators[2])
+    classes_ap, _ = merged.average_precision_all_classes()
+    np.testing.assert_allclose(classes_ap, expected_ap)
+
+
+def test_average_precision_accumulator_bins():
+    rng = np.random.RandomState(0)
+    frames = _frames_matching(rng, 20, 2)
+    accumulator = metrics.AveragePrecisionAccumulator(2, n_bins=1000)
+    for frame in frames:
+        accumulator.update(*frame)
+    exact_accumulator = metrics.AveragePrecisionAccumulator(2)
+    for frame in frames:
+        exact_accumulator.update(*frame)
+    np.testing.assert_allclose(accumulator.average_precision_all_classes()[0],
+                               exact_accumulator.average_precision_all_classes()[0], atol=0.01)
+
+    is_matched, dt_predictions, gt_labels = frames[1]
+    with pytest.raises(ValueError):
+        accumulator.update(is_matched, dt_predictions + 1.5, gt_labels)
+
+    # logits-like scores need explicit range
+    logits_accumulator = metrics.AveragePrecisionAccumulator(2, n_bins=10, score_range=(-5, 5))
+    logits_accumulator.update(is_matched, dt_predictions * 10 - 5, gt_labels)
+    with pytest.raises(ValueError):
+        accumulator.merge(logits_accumulator)
+
+
+@pytest.mark.parametrize('with_suppression', [False, True])
+def test_match_dt_gt_all_classes_multi_thr(with_suppression):
+    rng = np.random.RandomState(0)
+    iou_thrs = [0.25, 0.5, 0.75, 1.0]
+    for n_dt, n_gt, n_classes in [(1, 1, 1), (10, 0, 3), (20, 5, 3), (40, 12, 4), (60, 30, 2)]:
+        for _ in range(0, 20):
+            dt_gt_iou, gt_labels, dt_predictions = _tied_frame(rng, n_dt, n_gt, n_classes)
+            dt_is_suppressed_info = None
+            if with_suppression:
+                dt_is_suppressed_info = rng.rand(n_dt, n_classes) < 0.3
+            actual = metrics.match_dt_gt_all_classes_multi_thr(dt_gt_iou, gt_labels, dt_predictions, iou_thrs,
+                                                               dt_is_suppressed_info=dt_is_suppressed_info)
+            assert actual.shape == (n_dt, n_classes, len(iou_thrs))
+            for thr_ix, iou_thr in enumerate(iou_thrs):
+                expected = metrics.match_dt_gt_all_classes(dt_gt_iou, gt_labels, dt_predictions, iou_thr=iou_thr,
+                                                           dt_is_suppressed_info=dt_is_suppressed_info)
+                np.testing.assert_array_equal(actual[:, :, thr_ix], expected)
@@ -0,0 +1,167 @@
+"""NMSNetwork graph variants give the same outputs with the same weights"""
+
+import os
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('tensorflow.contrib.slim')
+
+from nms_network import model as nms_net
+from tools import batch_utils
+
+N_FEATURES = 5
+ARCHITECTURE = {'knet_hlayer_size': 8, 'n_kernels': 4, 'fc_apres_layer_size': 8}
+
+
+def _random_boxes(rng, n_boxes):
+    xy = rng.rand(n_boxes, 2) * 50
+    wh = rng.rand(n_boxes, 2) * 30 + 1
+    return np.hstack([xy, xy + wh]).astype(np.float32)
+
+
+def _random_frame(rng, n_dt, n_gt, n_classes):
+    return {'dt_coords': _random_boxes(rng, n_dt),
+            'dt_features': rng.rand(n_dt, N_FEATURES).astype(np.float32),
+            'dt_probs': rng.rand(n_dt, n_classes).astype(np.float32),
+            'gt_coords': _random_boxes(rng, n_gt),
+            'gt_labels': rng.randint(0, n_classes, n_gt).astype(np.float32)}
+
+
+def _build_model(n_classes, mode='inference', batched=False, **architecture):
+    tf.reset_default_graph()
+    batch_shape = [None] if batched else []
+    input_ops = {'dt_coords': tf.placeholder(tf.float32, batch_shape + [None, 4]),
+                 'dt_features': tf.placeholder(tf.float32, batch_shape + [None, N_FEATURES]),
+                 'dt_probs': tf.placeholder(tf.float32, batch_shape + [None, n_classes]),
+                 'gt_coords': tf.placeholder(tf.float32, batch_shape + [None, 4]),
+                 'gt_labels': tf.placeholder(tf.float32, batch_shape + [None]),
+                 'keep_prob': tf.placeholder(tf.float32)}
+    if batched:
+        input_ops['dt_mask'] = tf.placeholder(tf.float32, [None, None])
+    arch_args = dict(ARCHITECTURE)
+    arch_args.update(architecture)
+    nnms_model = nms_net.NMSNetwork(n_classes=n_classes,
+                                    input_ops=input_ops,
+                                    class_ix=0,
+                                    mode=mode,
+                                    architecture=arch_args,
+                                    training={'top_k_hypotheses': 3})
+    return input_ops, nnms_model
+
+
+def _feed_dict(input_ops, frame_data):
+    feed_dict = {input_ops['keep_prob']: 1.0}
+    for name, value in frame_data.items():
+        feed_dict[input_ops[name]] = value
+    return feed_dict
+
+
+def _run_with_checkpoint(checkpoint_path, n_classes, frames, **architecture):
+    """Restore weights from checkpoint (or save freshly initialized ones) and run class scores on frames"""
+    input_ops, nnms_model = _build_model(n_classes, **architecture)
+    saver = tf.train.Saver()
+    with tf.Session() as sess:
+        if os.path.exists(checkpoint_path + '.index'):
+            saver.restore(sess, checkpoint_path)
+        else:
+            sess.run(nnms_model.init_op)
+            saver.save(sess, checkpoint_path)
+        return [sess.run(nnms_model.sigmoid, feed_dict=_feed_dict(input_ops, frame)) for frame in frames]
+
+
+@pytest.mark.parametrize('saved_factorized', [False, True])
+def test_factorized_first_layer(tmpdir, saved_factorized):
+    rng = np.random.RandomState(0)
+    n_classes = 2
+    frames = [_random_frame(rng, n_dt, 0, n_classes) for n_dt in [1, 7, 20]]
+    checkpoint_path = str(tmpdir.join('model.ckpt'))
+
+    # checkpoint saved in one mode is restored in the other one
+    saved_scores = _run_with_checkpoint(checkpoint_path, n_classes, frames, factorized_pairwise=saved_factorized)
+    loaded_scores = _run_with_checkpoint(checkpoint_path, n_classes, frames,
+                                         factorized_pairwise=not saved_factorized)
+
+    for saved, loaded in zip(saved_scores, loaded_scores):
+        np.testing.assert_allclose(loaded, saved, rtol=1e-5, atol=1e-6)
+
+
+def _overlapping_frame(rng, n_dt, n_classes):
+    # all boxes contain point (25, 25), so every pair has IoU > 0
+    frame_data = _random_frame(rng, n_dt, 0, n_classes)
+    frame_data['dt_coords'] = np.hstack([rng.rand(n_dt, 2) * 20, 30 + rng.rand(n_dt, 2) * 20]).astype(np.float32)
+    return frame_data
+
+
+@pytest.mark.parametrize('architecture', [{'kernel_neighbourhood': 'knn', 'neighbourhood_k': 100},
+                                          {'kernel_neighbourhood': 'iou', 'neighbourhood_iou_thr': 0.0},
+                                          {'kernel_neighbourhood': 'knn', 'neighbourhood_k': 100,
+                                           'factorized_pairwise': True}])
+def test_sparse_neighbourhood_covering_all_pairs(tmpdir, architecture):
+    rng = np.random.RandomState(0)
+    n_classes = 2
+    frames = [_overlapping_frame(rng, n_dt, n_classes) for n_dt in [1, 2, 7, 20]]
+    checkpoint_path = str(tmpdir.join('model.ckpt'))
+
+    # sparse mode with neighbourhood of all pairs aggregates the same kernel values as dense mode
+    dense_scores = _run_with_checkpoint(checkpoint_path, n_classes, frames)
+    sparse_scores = _run_with_checkpoint(checkpoint_path, n_classes, frames, **architecture)
+
+    for dense, sparse in zip(dense_scores, sparse_scores):
+        np.testing.assert_allclose(sparse, dense, rtol=1e-5, atol=1e-6)
+
+
+def _batch_feed_dict(input_ops, frames, dt_coords_pad_value):
+    feed_dict = {input_ops['keep_prob']: 1.0}
+    for name in ['dt_coords', 'dt_features', 'dt_probs', 'gt_coords']:
+        pad_value = dt_coords_pad_value if name == 'dt_coords' else 0
+        feed_dict[input_ops[name]], _ = batch_utils.pad_and_stack([frame[name] for frame in frames], pad_value)
+    feed_dict[input_ops['gt_labels']], _ = batch_utils.pad_and_stack([frame['gt_labels'] for frame in frames], -1)
+    _, feed_dict[input_ops['dt_mask']] = batch_utils.pad_and_stack([frame['dt_coords'] for frame in frames])
+    return feed_dict
+
+
+@pytest.mark.parametrize('architecture', [{},
+                                          {'factorized_pairwise': True},
+                                          {'kernel_neighbourhood': 'knn', 'neighbourhood_k': 3},
+                                          {'kernel_neighbourhood': 'iou'}])
+@pytest.mark.parametrize('dt_coords_pad_value', [[0, 0, 1, 1], 0])
+def test_batched_model(tmpdir, architecture, dt_coords_pad_value):
+    rng = np.random.RandomState(0)
+    n_classes = 2
+    frames = [_random_frame(rng, n_dt, n_gt, n_classes) for n_dt, n_gt in [(7, 2), (10, 3), (4, 0), (1, 1)]]
+    checkpoint_path = str(tmpdir.join('model.ckpt'))
+
+    input_ops, nnms_model = _build_model(n_classes, mode='train', **architecture)
+    frame_outputs = []
+    with tf.Session() as sess:
+        sess.run(nnms_model.init_op)
+        tf.train.Saver().save(sess, checkpoint_path)
+        for frame in frames:
+            frame_outputs.append(sess.run([nnms_model.logits, nnms_model.det_loss, nnms_model.nms_loss],
+                                          feed_dict=_feed_dict(input_ops, frame)))
+
+    input_ops, nnms_model = _build_model(n_classes, mode='train', batched=True, **architecture)
+    variables = tf.trainable_variables()
+    losses = [nnms_model.det_loss, nnms_model.nms_loss]
+    gradients = [grad for loss in losses for grad in tf.gradients(loss, variables) if grad is not None]
+    with tf.Session() as sess:
+        tf.train.Saver().restore(sess, checkpoint_path)
+        logits, det_loss, nms_loss, gradient_values = sess.run(
+            [nnms_model.logits] + losses + [gradients],
+            feed_dict=_batch_feed_dict(input_ops, frames, dt_coords_pad_value))
+
+    for frame_ix, frame in enumerate(frames):
+        n_dt = len(frame['dt_coords'])
+        np.testing.assert_allclose(logits[frame_ix, 0:n_dt], frame_outputs[frame_ix][0], rtol=1e-5, atol=1e-5)
+
+    # batch losses are means over all valid boxes of all frames
+    n_dt_frames = [len(frame['dt_coords']) for frame in frames]
+    for loss_ix, batch_loss in [(1, det_loss), (2, nms_loss)]:
+        expected_loss = np.average([outputs[loss_ix] for outputs in frame_outputs], weights=n_dt_frames)
+        np.testing.assert_allclose(batch_loss, expected_loss, rtol=1e-5)
+
+    # padded boxes (also degenerate zero ones) must not bring NaN into gradients
+    for gradient_value in gradient_values:
+        assert np.all(np.isfinite(gradient_value))
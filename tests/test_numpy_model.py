@@ -0,0 +1,72 @@
+"""NumpyNMSNetwork reproduces NMSNetwork inference with converted weights"""
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('tensorflow.contrib.slim')
+
+from nms_network import model as nms_net
+from nms_network import numpy_model
+
+N_FEATURES = 5
+N_CLASSES = 2
+ARCHITECTURE = {'knet_hlayer_size': 8, 'n_kernels': 4, 'fc_apres_layer_size': 8}
+
+
+def _random_frame(rng, n_dt):
+    xy = rng.rand(n_dt, 2) * 50
+    wh = rng.rand(n_dt, 2) * 30 + 1
+    dt_coords = np.hstack([xy, xy + wh]).astype(np.float32)
+    if n_dt > 3:
+        # zero-area box and its duplicate
+        dt_coords[1] = [10, 10, 10, 20]
+        dt_coords[2] = dt_coords[1]
+    return (dt_coords,
+            rng.rand(n_dt, N_FEATURES).astype(np.float32),
+            rng.rand(n_dt, N_CLASSES).astype(np.float32))
+
+
+def test_pairwise_iou_degenerate_boxes():
+    boxes = np.array([[0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 2, 2], [1, 1, 1, 3]], dtype=np.float32)
+    iou = numpy_model._pairwise_iou(boxes)
+    assert np.all(np.isfinite(iou))
+    np.testing.assert_array_equal(iou, [[0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 1, 0], [0, 0, 0, 0]])
+
+
+@pytest.mark.parametrize('architecture', [{},
+                                          {'kernel_neighbourhood': 'knn', 'neighbourhood_k': 3},
+                                          {'kernel_neighbourhood': 'iou', 'neighbourhood_iou_thr': 0.1}])
+def test_numpy_model_matches_tf(tmpdir, architecture):
+    rng = np.random.RandomState(0)
+    frames = [_random_frame(rng, n_dt) for n_dt in [1, 2, 7, 30]]
+    arch_args = dict(ARCHITECTURE)
+    arch_args.update(architecture)
+    config = {'architecture': arch_args}
+
+    tf.reset_default_graph()
+    input_ops = {'dt_coords': tf.placeholder(tf.float32, [None, 4]),
+                 'dt_features': tf.placeholder(tf.float32, [None, N_FEATURES]),
+                 'dt_probs': tf.placeholder(tf.float32, [None, N_CLASSES]),
+                 'keep_prob': tf.placeholder(tf.float32)}
+    nnms_model = nms_net.NMSNetwork(n_classes=N_CLASSES, input_ops=input_ops, mode='inference', **config)
+    checkpoint_path = str(tmpdir.join('model.ckpt'))
+    tf_outputs = []
+    with tf.Session() as sess:
+        sess.run(nnms_model.init_op)
+        tf.train.Saver().save(sess, checkpoint_path)
+        for dt_coords, dt_features, dt_probs in frames:
+            feed_dict = {input_ops['dt_coords']: dt_coords,
+                         input_ops['dt_features']: dt_features,
+                         input_ops['dt_probs']: dt_probs,
+                         input_ops['keep_prob']: 1.0}
+            tf_outputs.append(sess.run([nnms_model.class_scores, nnms_model.sigmoid], feed_dict=feed_dict))
+
+    weights_path = str(tmpdir.join('knet_weights.npz'))
+    numpy_model.convert_checkpoint(checkpoint_path, weights_path)
+    numpy_nnms_model = numpy_model.NumpyNMSNetwork(weights_path, n_classes=N_CLASSES, **config)
+
+    for (dt_coords, dt_features, dt_probs), (tf_class_scores, tf_filter_scores) in zip(frames, tf_outputs):
+        class_scores, filter_scores = numpy_nnms_model.rescore(dt_coords, dt_features, dt_probs)
+        np.testing.assert_allclose(filter_scores, tf_filter_scores, rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(class_scores, tf_class_scores, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,84 @@
+"""Helpers for packing variable-size frames into mini-batches and loading them in background
+"""
+
+import collections
+import itertools
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+
+def pad_and_stack(arrays, pad_value=0, n_max=None):
+    """Stack arrays with different first dimension into one padded array
+
+    Parameters
+    ----------
+    arrays : list of arrays, shapes = [n_i, ...]
+        Per-frame arrays, all trailing dimensions have to match
+    pad_value : scalar or array, shape = [...]
+        Value used for padded entries, arrays are broadcast against trailing dimensions
+        (e.g. [0, 0, 1, 1] pads boxes with a non-degenerate box)
+    n_max : int
+        Size of the padded dimension. If None, maximum n_i is used
+
+    Returns
+    -------
+    stacked : array, shape = [n_arrays, n_max, ...]
+        Padded arrays
+    mask : array, shape = [n_arrays, n_max]
+        1 for entries coming from input arrays, 0 for padding
+    """
+    if n_max is None:
+        n_max = max([len(arr) for arr in arrays])
+    trailing_shape = np.asarray(arrays[0]).shape[1:]
+    stacked = np.empty((len(arrays), n_max) + trailing_shape, dtype=np.float32)
+    stacked[...] = pad_value
+    mask = np.zeros([len(arrays), n_max], dtype=np.float32)
+    for arr_ix, arr in enumerate(arrays):
+        n_entries = len(arr)
+        if n_entries != 0:
+            stacked[arr_ix, 0:n_entries] = arr
+        mask[arr_ix, 0:n_entries] = 1
+    return stacked, mask
+
+
+def prefetch(items, load_fn, n_threads=2, buffer_size=4):
+    """Iterate over load_fn(item) for items, loading upcoming items in background threads
+
+    Up to buffer_size items are loaded ahead while the caller processes the current one,
+    results come in the order of items. Exceptions raised by load_fn are re-raised
+    when the corresponding result is reached.
+
+    Parameters
+    ----------
+    items : iterable
+        Inputs of load_fn, e.g. frame ids of mini-batches. Consumed lazily
+    load_fn : callable
+        Function loading single item, has to be thread-safe
+    n_threads : int
+        Number of loading threads, 0 loads items synchronously in the calling thread
+    buffer_size : int
+        Maximum number of items loaded ahead
+
+    Yields
+    ------
+    load_fn(item) for every item
+    """
+    if n_threads == 0:
+        for item in items:
+            yield load_fn(item)
+        return
+
+    items = iter(items)
+    pool = ThreadPool(n_threads)
+    try:
+        pending = collections.deque([pool.apply_async(load_fn, (item,))
+                                     for item in itertools.islice(items, max(buffer_size, 1))])
+        while pending:
+            result = pending.popleft().get()
+            # keep the buffer full while the caller works with the result
+            for item in itertools.islice(items, 1):
+                pending.append(pool.apply_async(load_fn, (item,)))
+            yield result
+    finally:
+        pool.terminate()
@@ -22,14 +22,107 @@ def compute_iou(bb1, bb2):
     return ratio
 
 
-def compute_sets_iou(bb_set1, bb_set2):
+def _as_boxes_array(bb_set, dtype):
+    bb_set = np.asarray(bb_set, dtype=dtype)
+    if bb_set.size == 0:
+        # empty box list may come as 1-dimensional array
+        return bb_set.reshape(0, 4)
+    return bb_set
+
+
+def compute_sets_iou(bb_set1, bb_set2, dtype=np.float64, out=None):
     """compute intersection over union between 2 sets of bounding boxes
+
+    Parameters
+    ----------
+    bb_set1 : array, shape = [n1, >=4]
+        boxes of format [x1, y1, x2, y2, ...], extra columns are ignored
+    bb_set2 : array, shape = [n2, >=4]
+    dtype : np.float32 or np.float64
+        precision of computations and of the result
+    out : array, shape = [n1, n2], optional
+        preallocated buffer of dtype to write result into
+
+    Returns
+    -------
+    iou : array, shape = [n1, n2]
+        IoU for every pair of boxes, pairs with zero union get 0
+    """
+    bb_set1 = _as_boxes_array(bb_set1, dtype)
+    bb_set2 = _as_boxes_array(bb_set2, dtype)
+
+    if out is None:
+        out = np.empty([bb_set1.shape[0], bb_set2.shape[0]], dtype=dtype)
+
+    x11, y11, x12, y12 = [bb_set1[:, i:i+1] for i in range(4)]
+    x21, y21, x22, y22 = [bb_set2[:, i] for i in range(4)]
+
+    # intersection is accumulated in the output buffer
+    x_overlap = np.minimum(x12, x22) - np.maximum(x11, x21)
+    np.maximum(x_overlap, 0, out=x_overlap)
+    np.minimum(y12, y22, out=out)
+    out -= np.maximum(y11, y21)
+    np.maximum(out, 0, out=out)
+    out *= x_overlap
+
+    # union is computed in place of x_overlap buffer
+    union = x_overlap
+    np.add((x12 - x11) * (y12 - y11), (x22 - x21) * (y22 - y21), out=union)
+    union -= out
+
+    np.divide(out, union, out=out, where=union > 0)
+    out[union <= 0] = 0
+
+    return out
+
+
+def compute_sets_iou_chunked(bb_set1, bb_set2, chunk_size=1024, dtype=np.float64, out=None):
+    """compute_sets_iou for large sets of boxes with bounded memory
+
+    Boxes of the first set are processed in chunks of chunk_size,
+    so temporary arrays never exceed [chunk_size, n2].
+    """
+    bb_set1 = _as_boxes_array(bb_set1, dtype)
+    bb_set2 = _as_boxes_array(bb_set2, dtype)
+
+    if out is None:
+        out = np.empty([len(bb_set1), len(bb_set2)], dtype=dtype)
+
+    for chunk_start in range(0, len(bb_set1), chunk_size):
+        chunk_end = min(chunk_start + chunk_size, len(bb_set1))
+        compute_sets_iou(bb_set1[chunk_start:chunk_end], bb_set2,
+                         dtype=dtype, out=out[chunk_start:chunk_end])
+
+    return out
+
+
+def greedy_match(rows, cols, values, n_rows, n_cols):
+    """Greedily accept (row, col) candidates in order of decreasing value, each row and column used once
+
+    Candidates with equal values are taken in reversed order of appearance.
+
+    Returns
+    -------
+    matched : array of bool, shape = [n_candidates]
     """
-    iou = np.zeros(shape=(len(bb_set1), len(bb_set2)))
-    for bb1_ix, bb1 in enumerate(bb_set1):
-        for bb2_ix, bb2 in enumerate(bb_set2):
-            iou[bb1_ix, bb2_ix] = compute_iou(bb1[0:4], bb2[0:4])
-    return iou
+    order = np.argsort(values, kind='mergesort')[::-1]
+    row_used = np.zeros(n_rows, dtype=bool)
+    col_used = np.zeros(n_cols, dtype=bool)
+    matched = np.zeros(len(values), dtype=bool)
+    n_matches_max = min(n_rows, n_cols)
+    n_matches = 0
+    for candidate_ix in order:
+        i = rows[candidate_ix]
+        j = cols[candidate_ix]
+        if row_used[i] or col_used[j]:
+            continue
+        matched[candidate_ix] = True
+        row_used[i] = True
+        col_used[j] = True
+        n_matches += 1
+        if n_matches == n_matches_max:
+            break
+    return matched
 
 
 def compute_best_iou(iou, iou_threshold=0.5):
@@ -43,25 +136,52 @@ def compute_best_iou(iou, iou_threshold=0.5):
     [0.6 0.1 0.5 0.2]  ->   [0 0 1]
     [0.0 0.8 0.3 0.1]       [0 1 0]
     [0.1 0.2 0.1 0.1]       [0 0 0]
+
+    Pairs are matched greedily in order of decreasing IoU. Pairs below the threshold come
+    after all pairs above it in that order, so only above-threshold candidates are considered.
     """
-    thres_mask = np.zeros(iou.shape)
-    thres_mask[np.where(iou >= iou_threshold)] = 1
+    iou = np.asarray(iou)
     best_iou = np.zeros(iou.shape)
-    coords_sorted = np.unravel_index(
-        np.argsort(iou, axis=None)[::-1], iou.shape)
-    coords_sorted = np.asarray(coords_sorted).T
-    mask = np.ones(iou.shape)
-    for i, j in coords_sorted:
-        if (mask[i, j] != 0):
-            best_iou[i, j] = 1
-            mask[i, :] = 0
-            mask[:, j] = 0
-            if (np.count_nonzero(mask) == 0):
-                break
-    best_iou = np.multiply(best_iou, thres_mask)
+    rows, cols = np.nonzero(iou >= iou_threshold)
+    matched = greedy_match(rows, cols, iou[rows, cols], iou.shape[0], iou.shape[1])
+    best_iou[rows[matched], cols[matched]] = 1
     return best_iou
 
 
+def compute_best_iou_all_classes(dt_gt_iou, gt_labels, n_classes, iou_threshold=0.5):
+    """compute_best_iou for every class of a frame in one call
+
+    Detections are matched to gt boxes of every class independently.
+
+    Parameters
+    ----------
+    dt_gt_iou : array, shape = [n_dt, n_gt]
+    gt_labels : array, shape = [n_gt]
+        class ids of gt boxes
+    n_classes : int
+    iou_threshold : float
+
+    Returns
+    -------
+    dt_labels : array, shape = [n_dt, n_classes]
+        1 if detection is the best match for some gt box of the class, 0 otherwise
+        (same as np.max(compute_best_iou(dt_gt_iou[:, gt_labels == class_id]), axis=1))
+    """
+    n_dt, n_gt = dt_gt_iou.shape
+    gt_labels = np.asarray(gt_labels).astype(int)
+    dt_labels = np.zeros([n_dt, n_classes])
+
+    dt_ix, gt_ix = np.nonzero(dt_gt_iou >= iou_threshold)
+    class_ix = gt_labels[gt_ix]
+
+    # rows are (class, detection) pairs, so detections are reused across classes,
+    # gt columns belong to a single class already
+    matched = greedy_match(class_ix * n_dt + dt_ix, gt_ix, dt_gt_iou[dt_ix, gt_ix], n_classes * n_dt, n_gt)
+    dt_labels[dt_ix[matched], class_ix[matched]] = 1
+
+    return dt_labels
+
+
 def construct_ground_truth_per_label(dt_gt_iou,
                                      gt_labels,
                                      label,
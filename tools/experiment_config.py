@@ -39,6 +39,9 @@ class ExperimentConfig:
         self.n_dt_features = self.dp_config.get('n_features', 100)
         self.use_reduced_fc_features = self.dp_config.get('use_reduced_fc_features', True)
         self.shuffle_train_test = self.dp_config.get('shuffle_train_test', False)
+        self.n_loader_threads = self.dp_config.get('n_loader_threads', 2)
+        self.prefetch_batches = self.dp_config.get('prefetch_batches', 4)
+        self.frames_cache_mb = self.dp_config.get('frames_cache_mb', 2048)
 
         self.nms_network_config = self.config.get('nms_network', {})
         self.model_file = os.path.join(self.log_dir, 'model')
@@ -57,6 +60,7 @@ class ExperimentConfig:
         self.top_k_hypotheses = self.train_config.get('top_k_hypotheses', 20)
 
         self.n_epochs = self.train_config.get('n_epochs', 10)
+        self.batch_size = self.train_config.get('batch_size', 1)
 
         # results details
         self.mean_train_step_time = 0.0
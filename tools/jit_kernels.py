@@ -0,0 +1,93 @@
+"""Optional compiled kernels for tools.nms and tools.metrics
+
+Kernels are compiled with numba if it is installed (AVAILABLE = True),
+otherwise the module still imports and callers fall back to their NumPy code.
+Kernels work on boxes already sorted by score, sorting stays in NumPy,
+so tie order is exactly the same as in NumPy implementations.
+
+Only the per-class API uses the kernels (nms.nms_per_class, nms.nms_per_class_with_oracle,
+metrics.match_dt_gt and everything calling them per class). Vectorized all-classes paths
+(nms.nms_all_classes_batched, which nms.nms_all_classes uses by default,
+nms.nms_per_class_with_oracle_batch gt assignment, metrics.match_dt_gt_all_classes_batched)
+stay in NumPy and are not affected by USE_COMPILED.
+"""
+
+import numpy as np
+
+try:
+    import numba
+    AVAILABLE = True
+except ImportError:
+    numba = None
+    AVAILABLE = False
+
+
+def _jit(func):
+    if AVAILABLE:
+        return numba.njit(cache=True)(func)
+    return func
+
+
+@_jit
+def nms_sorted(dt_dt_iou, order_by_score, iou_thr):
+    """Box is suppressed if it overlaps (IoU >= iou_thr) with any higher ranked box
+    """
+    n_dt = order_by_score.shape[0]
+    dt_is_suppressed = np.zeros(n_dt, dtype=np.bool_)
+    for rank in range(1, n_dt):
+        dt_ix = order_by_score[rank]
+        for higher_rank in range(0, rank):
+            if dt_dt_iou[dt_ix, order_by_score[higher_rank]] >= iou_thr:
+                dt_is_suppressed[dt_ix] = True
+                break
+    return dt_is_suppressed
+
+
+@_jit
+def nms_with_oracle_sorted(dt_dt_iou, dt_gt_iou, order_by_score, iou_thr):
+    """Oracle NMS (see nms.nms_per_class_with_oracle)
+
+    Box matching not yet taken gt (IoU >= iou_thr) takes the first such gt and is kept,
+    box without gt is suppressed if it overlaps with any higher ranked box
+    """
+    n_dt = order_by_score.shape[0]
+    n_gt = dt_gt_iou.shape[1]
+    dt_is_suppressed_ini = nms_sorted(dt_dt_iou, order_by_score, iou_thr)
+    if n_gt == 0:
+        return dt_is_suppressed_ini
+    dt_is_suppressed = np.zeros(n_dt, dtype=np.bool_)
+    gt_is_taken = np.zeros(n_gt, dtype=np.bool_)
+    for rank in range(0, n_dt):
+        dt_ix = order_by_score[rank]
+        has_gt = False
+        for gt_ix in range(0, n_gt):
+            if (not gt_is_taken[gt_ix]) and dt_gt_iou[dt_ix, gt_ix] >= iou_thr:
+                gt_is_taken[gt_ix] = True
+                has_gt = True
+                break
+        if (not has_gt) and dt_is_suppressed_ini[dt_ix]:
+            dt_is_suppressed[dt_ix] = True
+    return dt_is_suppressed
+
+
+@_jit
+def match_dt_gt_sorted(dt_gt_iou, order_by_score, iou_thr):
+    """Matching of metrics.match_dt_gt
+
+    Every detection considers only gt with its maximum IoU, gt is given
+    to the highest ranked detection considering it (if IoU >= iou_thr)
+    """
+    n_dt = order_by_score.shape[0]
+    n_gt = dt_gt_iou.shape[1]
+    is_matched = np.zeros(n_dt)
+    gt_is_taken = np.zeros(n_gt, dtype=np.bool_)
+    for rank in range(0, n_dt):
+        dt_ix = order_by_score[rank]
+        best_gt_ix = 0
+        for gt_ix in range(1, n_gt):
+            if dt_gt_iou[dt_ix, gt_ix] > dt_gt_iou[dt_ix, best_gt_ix]:
+                best_gt_ix = gt_ix
+        if dt_gt_iou[dt_ix, best_gt_ix] >= iou_thr and not gt_is_taken[best_gt_ix]:
+            gt_is_taken[best_gt_ix] = True
+            is_matched[dt_ix] = 1
+    return is_matched
@@ -1,4 +1,8 @@
 import numpy as np
+from tools import jit_kernels
+
+# compiled kernels are used automatically if numba is installed (per-class functions only)
+USE_COMPILED = jit_kernels.AVAILABLE
 
 
 def match_dt_gt(dt_gt_iou,
@@ -23,10 +27,13 @@ def match_dt_gt(dt_gt_iou,
     """
     # select info connected with label of interest
     n_hyp, n_gt = dt_gt_iou.shape
-    if (n_gt == 0):
+    if (n_gt == 0) or (n_hyp == 0):
         return np.zeros(n_hyp)
-    # sort by label confidence
-    order_by_score = np.argsort(predictions)[::-1]
+    # sort by label confidence, stable sort keeps tie order deterministic
+    # (equal scores are visited in reversed index order)
+    order_by_score = np.argsort(predictions, kind='mergesort')[::-1]
+    if USE_COMPILED:
+        return jit_kernels.match_dt_gt_sorted(dt_gt_iou, order_by_score, iou_thr)
     thresholds = predictions[order_by_score]
     dt_gt_iou = dt_gt_iou[order_by_score]
     if (n_hyp != 0 and n_gt == 0):
@@ -56,6 +63,106 @@ def match_dt_gt(dt_gt_iou,
     return is_matched_ordered
 
 
+def match_dt_gt_multi_thr(dt_gt_iou,
+                          predictions,
+                          iou_thrs):
+    """Match detections to ground truth (as in match_dt_gt) for several IoU thresholds at once
+
+    Every detection considers only gt with its maximum IoU, so for every threshold gt is given
+    to the highest scored detection among the ones considering it with IoU above the threshold.
+    This is computed for all thresholds with one sort.
+
+    Parameters
+    ----------
+    dt_gt_iou : array, shape = [n_dt_boxes, n_gt_boxes]
+        Intersection over union (IoU) ratio between dt and gt boxes
+    predictions : array, shape = [n_dt_boxes]
+        Confidence scores for class
+    iou_thrs : array, shape = [n_thrs]
+        Thresholds for dt-gt IoU under which dt-gt pair will be considered match
+    ----------
+    Returns
+    ----------
+    is_matched : array, shape = [n_dt_boxes, n_thrs]
+        match_dt_gt result for every threshold
+    """
+    iou_thrs = np.asarray(iou_thrs)
+    n_hyp, n_gt = dt_gt_iou.shape
+    is_matched = np.zeros([n_hyp, len(iou_thrs)])
+    if n_gt == 0 or n_hyp == 0:
+        return is_matched
+    # same tie order as in match_dt_gt
+    order_by_score = np.argsort(predictions, kind='mergesort')[::-1]
+    rank = np.empty(n_hyp, dtype=int)
+    rank[order_by_score] = np.arange(n_hyp)
+    best_gt = np.argmax(dt_gt_iou, axis=1)
+    best_iou = dt_gt_iou[np.arange(n_hyp), best_gt]
+    # detections grouped by their best gt, in order of decreasing score within group
+    order_by_gt = np.lexsort((rank, best_gt))
+    is_valid = best_iou[order_by_gt, np.newaxis] >= iou_thrs[np.newaxis, :]
+    is_matched[order_by_gt] = _first_valid_in_groups(best_gt[order_by_gt], is_valid)
+    return is_matched
+
+
+def _first_valid_in_groups(group_ids, is_valid):
+    """For entries sorted by group, mark the first valid entry of every group in every column
+
+    Parameters
+    ----------
+    group_ids : array, shape = [n_entries]
+        Group of every entry, entries of one group are contiguous
+    is_valid : array of bool, shape = [n_entries, n_columns]
+
+    Returns
+    -------
+    is_first : array of bool, shape = [n_entries, n_columns]
+    """
+    n_entries = len(group_ids)
+    valid_cnt = np.cumsum(is_valid, axis=0)
+    # number of valid entries in previous groups
+    group_start = np.ones(n_entries, dtype=bool)
+    group_start[1:] = group_ids[1:] != group_ids[:-1]
+    group_start_ix = np.maximum.accumulate(np.where(group_start, np.arange(n_entries), 0))
+    valid_cnt_before_group = valid_cnt[group_start_ix] - is_valid[group_start_ix]
+    return is_valid & (valid_cnt - valid_cnt_before_group == 1)
+
+
+def _best_gt_per_class(dt_gt_iou, gt_labels, classes):
+    """For every detection and class, gt of that class with the maximum IoU (the first one on ties)
+
+    Gt columns are grouped by class once, maxima are taken with reduceat over the groups,
+    so only [n_dt_boxes, n_gt_boxes] temporaries are used.
+
+    Parameters
+    ----------
+    dt_gt_iou : array, shape = [n_dt_boxes, n_gt_boxes]
+    gt_labels : array, shape = [n_gt_boxes]
+    classes : array, shape = [n_present_classes]
+        Sorted classes, every one having some gt
+
+    Returns
+    -------
+    best_gt : array, shape = [n_dt_boxes, n_present_classes]
+        Column of dt_gt_iou
+    best_iou : array, shape = [n_dt_boxes, n_present_classes]
+    """
+    class_gt = np.nonzero(np.isin(gt_labels, classes))[0]
+    # stable sort keeps original column order within class
+    class_gt = class_gt[np.argsort(gt_labels[class_gt], kind='mergesort')]
+    class_start = np.searchsorted(gt_labels[class_gt], classes)
+    class_size = np.diff(np.append(class_start, len(class_gt)))
+    class_dt_gt_iou = dt_gt_iou[:, class_gt]
+    best_iou = np.maximum.reduceat(class_dt_gt_iou, class_start, axis=1)
+    is_best = class_dt_gt_iou == np.repeat(best_iou, class_size, axis=1)
+    best_ix = np.minimum.reduceat(np.where(is_best, np.arange(len(class_gt)), len(class_gt)), class_start, axis=1)
+    return class_gt[best_ix], best_iou
+
+
+def _present_classes(gt_labels, n_classes):
+    classes = np.unique(gt_labels).astype(int)
+    return classes[(classes >= 0) & (classes < n_classes)]
+
+
 def match_dt_gt_all_classes(dt_gt_iou,
                             gt_labels,
                             dt_predictions,
@@ -105,6 +212,106 @@ def match_dt_gt_all_classes(dt_gt_iou,
     return is_matched_all_classes
 
 
+def match_dt_gt_all_classes_multi_thr(dt_gt_iou,
+                                      gt_labels,
+                                      dt_predictions,
+                                      iou_thrs,
+                                      dt_is_suppressed_info=None):
+    """ Same as match_dt_gt_all_classes for several IoU thresholds, computed for all classes in one pass
+
+    For every class, detection considers only its best gt of that class, and for every threshold gt is given
+    to the highest scored not suppressed detection considering it with IoU above the threshold
+    (equal scores are ordered as in match_dt_gt). Candidates of all classes and thresholds come from
+    one sort, as in match_dt_gt_multi_thr.
+    -----
+    Parameters
+    -----
+    iou_thrs : array, shape = [n_thrs]
+    -----
+    Returns
+    -----
+    is_matched_all_classes : array, shape = [n_detections, n_classes, n_thrs]
+        Array containing info about matches (as in match_dt_gt_all_classes),
+        ready for average_precision_all_classes_multi_thr
+    ----
+    """
+    iou_thrs = np.asarray(iou_thrs)
+    n_hyp, n_classes = dt_predictions.shape
+    is_matched_all_classes = np.zeros([n_hyp, n_classes, len(iou_thrs)])
+    gt_labels = np.asarray(gt_labels)
+    classes = _present_classes(gt_labels, n_classes)
+
+    if len(classes) > 0 and n_hyp > 0:
+        best_gt, best_iou = _best_gt_per_class(dt_gt_iou, gt_labels, classes)
+
+        is_candidate = best_iou >= np.min(iou_thrs)
+        if dt_is_suppressed_info is not None:
+            is_candidate &= np.logical_not(dt_is_suppressed_info[:, classes])
+
+        dt_ix, present_class_ix = np.nonzero(is_candidate)
+        candidate_gt = best_gt[dt_ix, present_class_ix]
+        class_ix = classes[present_class_ix]
+        # candidates grouped by gt, by decreasing score within group (higher index first on ties)
+        order = np.lexsort((-dt_ix, -dt_predictions[dt_ix, class_ix], candidate_gt))
+        is_valid = best_iou[dt_ix, present_class_ix][order, np.newaxis] >= iou_thrs[np.newaxis, :]
+        is_matched_all_classes[dt_ix[order], class_ix[order]] = _first_valid_in_groups(candidate_gt[order],
+                                                                                       is_valid)
+
+    if dt_is_suppressed_info is not None:
+        is_matched_all_classes[dt_is_suppressed_info == True] = -1
+
+    return is_matched_all_classes
+
+
+def match_dt_gt_all_classes_batched(dt_gt_iou,
+                                    gt_labels,
+                                    dt_predictions,
+                                    iou_thr=0.5,
+                                    dt_is_suppressed_info=None):
+    """ Same as match_dt_gt_all_classes, but computed for all classes at once on the shared IoU matrix
+
+    For every class, detection considers only its best gt of that class (found on the 2-D IoU matrix
+    with gt columns grouped by class), every gt is given to the highest scored not suppressed detection
+    considering it with IoU >= iou_thr. Candidates of all classes are ordered by one stable lexsort
+    on (class, -score), equal scores are ordered as in match_dt_gt (reversed stable sort, higher index first).
+    Only classes present in gt_labels are processed.
+    -----
+    Returns
+    -----
+    is_matched_all_classes : array, shape = [n_detections, n_classes]
+        Array containing info about matches :
+                        0 - not matched,
+                        1 - matched,
+                       -1 - suppressed by previous detections
+    ----
+    """
+    n_hyp, n_classes = dt_predictions.shape
+    is_matched_all_classes = np.zeros([n_hyp, n_classes])
+    gt_labels = np.asarray(gt_labels)
+    classes = _present_classes(gt_labels, n_classes)
+
+    if len(classes) > 0 and n_hyp > 0:
+        best_gt, best_iou = _best_gt_per_class(dt_gt_iou, gt_labels, classes)
+
+        is_candidate = best_iou >= iou_thr
+        if dt_is_suppressed_info is not None:
+            is_candidate &= np.logical_not(dt_is_suppressed_info[:, classes])
+
+        dt_ix, present_class_ix = np.nonzero(is_candidate)
+        candidate_gt = best_gt[dt_ix, present_class_ix]
+        class_ix = classes[present_class_ix]
+        order = np.lexsort((-dt_ix, -dt_predictions[dt_ix, class_ix], class_ix))
+        # every gt belongs to one class, so its first candidate in this order is the highest ranked one
+        _, first_ix = np.unique(candidate_gt[order], return_index=True)
+        winners = order[first_ix]
+        is_matched_all_classes[dt_ix[winners], class_ix[winners]] = 1
+
+    if dt_is_suppressed_info is not None:
+        is_matched_all_classes[dt_is_suppressed_info == True] = -1
+
+    return is_matched_all_classes
+
+
 def precision_recall_curve(is_matched, predictions, gt_cnt):
     """ Compute precision recall curve per class
     Parameters
@@ -177,3 +384,194 @@ def average_precision_all_classes(is_matched, dt_predictions, gt_labels):
         classes_ap[class_label] = average_precision(recall, precision)
         classes_roc_curves[class_label] = [precision, recall, thr]
     return classes_ap, classes_roc_curves
+
+
+def average_precision_all_classes_multi_thr(is_matched, dt_predictions, gt_labels):
+    """ Compute average precision scores for all classes and several dt-gt IoU thresholds
+    (e.g. COCO-style mAP over IoU 0.5:0.95)
+    Parameters
+    ----
+    is_matched : array [n_detections, n_classes, n_thrs]
+        Information about matches with gt for all available labels and IoU thresholds
+        (e.g. match_dt_gt_all_classes_multi_thr results)
+
+    dt_predictions : array [n_detections, n_classes]
+        Confidence scores for all classes
+
+    Returns
+    ----
+    classes_ap : array [n_classes, n_thrs]
+        Average precision for all classes and thresholds
+    classes_map : array [n_classes]
+        Average precision averaged over thresholds
+    ----
+    """
+    n_classes = dt_predictions.shape[1]
+    n_thrs = is_matched.shape[2]
+    classes_ap = np.zeros([n_classes, n_thrs])
+    for thr_ix in range(0, n_thrs):
+        classes_ap[:, thr_ix], _ = average_precision_all_classes(is_matched[:, :, thr_ix], dt_predictions, gt_labels)
+    classes_map = np.mean(classes_ap, axis=1)
+    return classes_ap, classes_map
+
+
+def _merge_sorted_runs(run_1, run_2):
+    """Merge two (scores, is_matched) runs sorted by decreasing score into one sorted run
+
+    Equal scores of run_1 go before the ones of run_2. Takes O(n_1 + n_2) besides binary search.
+    """
+    scores_1, is_matched_1 = run_1
+    scores_2, is_matched_2 = run_2
+    # -scores are increasing, side='right' puts run_2 entries after equal run_1 ones
+    run_2_ix = np.searchsorted(-scores_1, -scores_2, side='right') + np.arange(len(scores_2))
+    is_from_run_2 = np.zeros(len(scores_1) + len(scores_2), dtype=bool)
+    is_from_run_2[run_2_ix] = True
+    scores = np.empty(len(is_from_run_2))
+    is_matched = np.empty(len(is_from_run_2))
+    scores[is_from_run_2] = scores_2
+    scores[~is_from_run_2] = scores_1
+    is_matched[is_from_run_2] = is_matched_2
+    is_matched[~is_from_run_2] = is_matched_1
+    return scores, is_matched
+
+
+class AveragePrecisionAccumulator:
+    """Dataset-level average precision computed from per-frame matching results
+
+    Frames are added one by one with update, accumulators filled by different
+    workers are combined with merge. Two storage modes are available :
+        n_bins=None - sorted buffer of all not suppressed (score, is_matched) pairs is kept,
+                      result is identical to running average_precision_all_classes on stacked frames
+                      (tied scores are ordered by order of updates). Memory grows with number
+                      of detections (16 bytes per detection), plus a temporary copy of the runs being merged
+        n_bins=K    - per-class histograms of matched / not matched scores on score_range are kept,
+                      memory doesn't depend on number of frames, PR curve has K points
+
+    Sorted buffer of every class is a list of runs sorted by decreasing score, a new run is merged
+    into the previous one while it is not smaller than half of it, so there are O(log n_detections) runs
+    and every detection is copied O(log n_detections) times in total. merge appends runs of other
+    accumulator the same way, without re-sorting the ones already accumulated.
+    """
+
+    def __init__(self, n_classes, n_bins=None, score_range=(0.0, 1.0)):
+        """
+        Parameters
+        ----------
+        n_classes : int
+        n_bins : int or None
+            Number of histogram bins, None for exact mode
+        score_range : (float, float)
+            Range of scores covered by histogram bins, scores outside of it raise ValueError
+        """
+        self.n_classes = n_classes
+        self.n_bins = n_bins
+        self.gt_cnt = np.zeros(n_classes)
+        if n_bins is None:
+            self.runs = [[] for _ in range(0, n_classes)]
+        else:
+            self.score_range = (float(score_range[0]), float(score_range[1]))
+            self.bin_edges = np.linspace(self.score_range[0], self.score_range[1], n_bins + 1)
+            self.tp_hist = np.zeros([n_classes, n_bins])
+            self.fp_hist = np.zeros([n_classes, n_bins])
+
+    def _add_run(self, class_label, run):
+        if len(run[0]) == 0:
+            return
+        runs = self.runs[class_label]
+        runs.append(run)
+        while len(runs) > 1 and 2 * len(runs[-1][0]) >= len(runs[-2][0]):
+            run = runs.pop()
+            runs[-1] = _merge_sorted_runs(runs[-1], run)
+
+    def _sorted_run(self, class_label):
+        """All accumulated results of the class as a single run sorted by decreasing score"""
+        runs = self.runs[class_label]
+        while len(runs) > 1:
+            run = runs.pop()
+            runs[-1] = _merge_sorted_runs(runs[-1], run)
+        if len(runs) == 0:
+            return np.zeros(0), np.zeros(0)
+        return runs[0]
+
+    def update_class(self, class_label, is_matched, predictions, gt_cnt):
+        """Add results for one class of a frame
+
+        Parameters
+        ----------
+        is_matched : array, shape = [n_detections]
+            1 - matched, 0 - false positive, -1 - suppressed (ignored)
+        predictions : array, shape = [n_detections]
+            Confidence scores
+        gt_cnt : int
+            Number of gt objects of the class in the frame
+        """
+        not_suppressed = is_matched != -1
+        is_matched = np.asarray(is_matched[not_suppressed], dtype=float)
+        predictions = np.asarray(predictions[not_suppressed], dtype=float)
+        self.gt_cnt[class_label] += gt_cnt
+        if self.n_bins is None:
+            order_by_score = np.argsort(-predictions, kind='mergesort')
+            self._add_run(class_label, (predictions[order_by_score], is_matched[order_by_score]))
+        else:
+            if np.any(predictions < self.score_range[0]) or np.any(predictions > self.score_range[1]):
+                raise ValueError("scores are outside of histogram range [%f, %f]" % self.score_range)
+            # the highest score of the range goes to the last bin
+            bin_ix = np.minimum(np.searchsorted(self.bin_edges, predictions, side='right') - 1, self.n_bins - 1)
+            self.tp_hist[class_label] += np.bincount(bin_ix, weights=is_matched, minlength=self.n_bins)
+            self.fp_hist[class_label] += np.bincount(bin_ix, weights=1 - is_matched, minlength=self.n_bins)
+
+    def update(self, is_matched, dt_predictions, gt_labels):
+        """Add results for all classes of a frame
+
+        Arguments are the same as for average_precision_all_classes
+        """
+        for class_label in range(0, self.n_classes):
+            n_gt_class = np.sum(gt_labels == class_label)
+            self.update_class(class_label, is_matched[:, class_label], dt_predictions[:, class_label], n_gt_class)
+
+    def merge(self, other):
+        """Add results accumulated by other accumulator (e.g. filled by other worker)
+        """
+        if (other.n_classes != self.n_classes) or (other.n_bins != self.n_bins):
+            raise ValueError("accumulators with different number of classes or bins can't be merged")
+        if (self.n_bins is not None) and (other.score_range != self.score_range):
+            raise ValueError("accumulators with different score ranges can't be merged")
+        self.gt_cnt += other.gt_cnt
+        if self.n_bins is None:
+            for class_label in range(0, self.n_classes):
+                for run in other.runs[class_label]:
+                    self._add_run(class_label, run)
+        else:
+            self.tp_hist += other.tp_hist
+            self.fp_hist += other.fp_hist
+        return self
+
+    def precision_recall_curve(self, class_label):
+        """Precision recall curve for accumulated results, same format as precision_recall_curve
+        """
+        gt_cnt = self.gt_cnt[class_label]
+        if self.n_bins is None:
+            scores, is_matched = self._sorted_run(class_label)
+            # buffer is already sorted, so the curve is computed as in precision_recall_curve without sorting
+            tp_cnt = is_matched.cumsum()
+            dt_cnt = np.arange(1, len(scores) + 1)
+            return tp_cnt / dt_cnt, tp_cnt / gt_cnt, scores
+        # bins are visited from the highest scores, threshold is lower edge of the bin
+        tp_cnt = np.cumsum(self.tp_hist[class_label][::-1])
+        dt_cnt = tp_cnt + np.cumsum(self.fp_hist[class_label][::-1])
+        non_empty = dt_cnt > 0
+        recall = tp_cnt[non_empty] / gt_cnt
+        precision = tp_cnt[non_empty] / dt_cnt[non_empty]
+        thresholds = self.bin_edges[0:-1][::-1][non_empty]
+        return precision, recall, thresholds
+
+    def average_precision_all_classes(self):
+        """Average precision for all classes, same output as average_precision_all_classes
+        """
+        classes_ap = np.zeros(self.n_classes)
+        classes_roc_curves = {}
+        for class_label in range(0, self.n_classes):
+            precision, recall, thr = self.precision_recall_curve(class_label)
+            classes_ap[class_label] = average_precision(recall, precision)
+            classes_roc_curves[class_label] = [precision, recall, thr]
+        return classes_ap, classes_roc_curves
@@ -1,4 +1,9 @@
 import numpy as np
+from tools import bbox_utils
+from tools import jit_kernels
+
+# compiled kernels are used automatically if numba is installed (per-class functions only)
+USE_COMPILED = jit_kernels.AVAILABLE
 
 
 def nms_per_class(dt_dt_iou, dt_scores, iou_thr=0.5):
@@ -20,6 +25,9 @@ def nms_per_class(dt_dt_iou, dt_scores, iou_thr=0.5):
     n_dt = dt_scores.shape[0]
     dt_is_suppressed = np.zeros(n_dt)
     order_by_score = np.argsort(dt_scores)[::-1]
+    if USE_COMPILED:
+        dt_is_suppressed[:] = jit_kernels.nms_sorted(dt_dt_iou, order_by_score, iou_thr)
+        return dt_is_suppressed
     dt_scores = dt_scores[order_by_score]
     dt_dt_iou = dt_dt_iou[order_by_score][:, order_by_score]
     dt_dt_iou[dt_dt_iou >= iou_thr] = 1
@@ -29,6 +37,49 @@ def nms_per_class(dt_dt_iou, dt_scores, iou_thr=0.5):
     dt_is_suppressed[order_by_score] = np.sum(dt_dt_iou, axis=1) > 0
     return dt_is_suppressed
 
+def nms_per_class_greedy(dt_scores, dt_dt_iou=None, dt_coords=None, iou_thr=0.5):
+    """Perform exact greedy Non-Maximum Suppression
+
+    Unlike nms_per_class, only boxes that are still alive can suppress other boxes.
+    Boxes are visited in order of decreasing score, every kept box removes alive boxes
+    overlapping with it, loop stops when no alive boxes are left.
+
+     Parameters
+    ----------
+    dt_scores : array, shape = [n_dt_boxes]
+        Confidence scores
+    dt_dt_iou : array, shape = [n_dt_boxes, n_dt_boxes]
+        Intersection over union (IoU) ratio between each pair of dt boxes.
+        If None, IoU is computed on the fly from dt_coords only for the pairs that are visited
+    dt_coords : array, shape = [n_dt_boxes, 4]
+        Boxes in format [x1, y1, x2, y2], used only if dt_dt_iou is None
+    iou_thr : int in range (0, 1]
+        Threshold for dt-dt IoU under which dt-dt pairs will be considered duplicate detections
+    Returns
+    -------
+    dt_is_suppressed : array, shape = [n_dt_boxes]
+        Array with indicators showing whether the box to be suppressed
+    """
+    if dt_dt_iou is None and dt_coords is None:
+        raise ValueError("either dt_dt_iou or dt_coords has to be provided")
+    n_dt = dt_scores.shape[0]
+    dt_is_suppressed = np.ones(n_dt, dtype=bool)
+    # indices of alive boxes, sorted by score
+    alive = np.argsort(dt_scores)[::-1]
+    while alive.size > 0:
+        keep_ix = alive[0]
+        dt_is_suppressed[keep_ix] = False
+        alive = alive[1:]
+        if alive.size == 0:
+            break
+        if dt_dt_iou is not None:
+            keep_iou = dt_dt_iou[keep_ix, alive]
+        else:
+            keep_iou = bbox_utils.compute_sets_iou(dt_coords[keep_ix:keep_ix+1], dt_coords[alive])[0]
+        alive = alive[keep_iou < iou_thr]
+    return dt_is_suppressed
+
+
 def nms_per_class_with_oracle(dt_dt_iou, dt_scores, dt_gt_iou, iou_thr=0.5):
     """Perform oracle Non-Maximum Suppression given intersection over union (IoU) info, detection scores and
     information about intersections with ground truth objects
@@ -49,42 +100,125 @@ def nms_per_class_with_oracle(dt_dt_iou, dt_scores, dt_gt_iou, iou_thr=0.5):
     dt_is_suppressed : array, shape = [n_dt_boxes]
         Array with indicators showing whether the box to be suppressed
     """
-    n_dt = dt_scores.shape[0]
-    dt_is_suppressed = np.zeros(n_dt, dtype=bool)
     order_by_score = np.argsort(dt_scores)[::-1]
-    dt_scores = dt_scores[order_by_score]
-    dt_dt_iou = dt_dt_iou[order_by_score][:, order_by_score]
-    dt_gt_iou = dt_gt_iou[order_by_score]
-    dt_dt_iou[dt_dt_iou >= iou_thr] = 1
-    dt_dt_iou[dt_dt_iou < iou_thr] = 0
-    dt_gt_iou[dt_gt_iou >= iou_thr] = 1
-    dt_gt_iou[dt_gt_iou < iou_thr] = 0
-    til = np.triu_indices(n_dt)
-    dt_dt_iou[til] = 0
-    dt_is_suppressed_ini = np.sum(dt_dt_iou, axis=1) > 0
-    if dt_gt_iou.shape[1] == 0:
-        dt_is_suppressed[order_by_score] = dt_is_suppressed_ini
-        return dt_is_suppressed
-    dt_gt_iou_seq = np.copy(dt_gt_iou)
-    dt_is_suppressed_oracle = np.zeros(n_dt, dtype=bool)
-    for dt_ix in range(0, n_dt):
-        to_be_suppressed_ini = bool(dt_is_suppressed_ini[dt_ix])
-        has_gt = bool(np.max(dt_gt_iou_seq[dt_ix]))
-        if (not has_gt) and to_be_suppressed_ini:
-            dt_is_suppressed_oracle[dt_ix] = True
-        if has_gt:
-            gt_ix = np.argmax(dt_gt_iou_seq[dt_ix])
-            dt_gt_iou_seq[:, gt_ix] = 0
-            dt_gt_iou_seq[dt_ix, :] = 0
-    dt_is_suppressed[order_by_score] = dt_is_suppressed_oracle
+    if USE_COMPILED:
+        return jit_kernels.nms_with_oracle_sorted(dt_dt_iou, dt_gt_iou, order_by_score, iou_thr)
+    dt_is_suppressed_ini = nms_per_class(dt_dt_iou, dt_scores, iou_thr=iou_thr) > 0
+    has_gt = _oracle_gt_matches([dt_gt_iou], [order_by_score], iou_thr)[0]
+    # boxes taking some gt are never suppressed
+    return np.logical_and(dt_is_suppressed_ini, np.logical_not(has_gt))
+
+
+def _oracle_gt_matches(frames_dt_gt_iou, frames_order_by_score, iou_thr):
+    """Find boxes taking some gt in oracle NMS, for many frames at once
+
+    Boxes are visited in order of decreasing score and take the first gt (by index)
+    that overlaps with them (IoU >= iou_thr) and is not taken yet. This is greedy assignment
+    over candidate (dt, gt) pairs sorted by (box rank, gt index) with used flags for both.
+    Frames get disjoint box and gt index ranges, so one assignment covers all of them.
+
+    Returns
+    -------
+    frames_has_gt : list of arrays of bool, shapes = [n_dt_boxes]
+    """
+    rows = []
+    cols = []
+    keys = []
+    dt_offsets = [0]
+    gt_offset = 0
+    for dt_gt_iou, order_by_score in zip(frames_dt_gt_iou, frames_order_by_score):
+        n_dt, n_gt = dt_gt_iou.shape
+        rank = np.empty(n_dt, dtype=np.int64)
+        rank[order_by_score] = np.arange(n_dt)
+        dt_ix, gt_ix = np.nonzero(dt_gt_iou >= iou_thr)
+        rows.append(dt_ix + dt_offsets[-1])
+        cols.append(gt_ix + gt_offset)
+        # greedy_match takes higher keys first
+        keys.append(-(rank[dt_ix] * n_gt + gt_ix))
+        dt_offsets.append(dt_offsets[-1] + n_dt)
+        gt_offset += n_gt
+    rows = np.hstack(rows).astype(np.int64)
+    cols = np.hstack(cols).astype(np.int64)
+    matched = bbox_utils.greedy_match(rows, cols, np.hstack(keys), dt_offsets[-1], gt_offset)
+    has_gt = np.zeros(dt_offsets[-1], dtype=bool)
+    has_gt[rows[matched]] = True
+    return [has_gt[dt_offsets[i]:dt_offsets[i+1]] for i in range(0, len(frames_dt_gt_iou))]
+
+
+def nms_per_class_with_oracle_batch(frames_dt_dt_iou, frames_dt_scores, frames_dt_gt_iou, iou_thr=0.5):
+    """Perform oracle Non-Maximum Suppression (see nms_per_class_with_oracle) for a list of frames
+
+    Gt assignment of all frames is done in one pass
+
+     Parameters
+    ----------
+    frames_dt_dt_iou : list of arrays, shapes = [n_dt_boxes, n_dt_boxes]
+    frames_dt_scores : list of arrays, shapes = [n_dt_boxes]
+    frames_dt_gt_iou : list of arrays, shapes = [n_dt_boxes, n_gt_boxes]
+    iou_thr : int in range (0, 1]
+    Returns
+    -------
+    frames_dt_is_suppressed : list of arrays, shapes = [n_dt_boxes]
+    """
+    if len(frames_dt_scores) == 0:
+        return []
+    frames_order_by_score = [np.argsort(dt_scores)[::-1] for dt_scores in frames_dt_scores]
+    frames_has_gt = _oracle_gt_matches(frames_dt_gt_iou, frames_order_by_score, iou_thr)
+    frames_dt_is_suppressed = []
+    for dt_dt_iou, dt_scores, has_gt in zip(frames_dt_dt_iou, frames_dt_scores, frames_has_gt):
+        dt_is_suppressed_ini = nms_per_class(dt_dt_iou, dt_scores, iou_thr=iou_thr) > 0
+        frames_dt_is_suppressed.append(np.logical_and(dt_is_suppressed_ini, np.logical_not(has_gt)))
+    return frames_dt_is_suppressed
+
+
+def nms_all_classes_batched(dt_dt_iou,
+                            dt_scores,
+                            iou_thr=0.5):
+    """Same as nms_per_class applied to every class, but without per-class loop
+
+    Box i is suppressed in class c iff some box j overlapping with it (IoU >= iou_thr)
+    is ranked higher by class c scores. Overlapping pairs are found once on the shared
+    IoU matrix, ranks of all classes come from one stacked argsort.
+
+     Parameters
+    ----------
+    dt_dt_iou : array, shape = [n_dt_boxes, n_dt_boxes]
+        Intersection over union (IoU) ratio between each pair of dt boxes
+    dt_scores : array, shape = [n_dt_boxes, n_classes]
+        Confidence scores
+    iou_thr : int in range (0, 1]
+        Threshold for dt-dt IoU under which dt-dt pairs will be considered duplicate detections
+    Returns
+    -------
+    dt_is_suppressed : array, shape = [n_dt_boxes, n_classes]
+        Array with indicators showing whether the box to be suppressed while considering specific class
+    """
+    n_dt, n_classes = dt_scores.shape
+    dt_is_suppressed = np.zeros([n_dt, n_classes], dtype=bool)
+
+    # rank of every box within every class, 0 for the highest score (same order as in nms_per_class)
+    order_by_score = np.argsort(dt_scores, axis=0)[::-1]
+    rank = np.empty([n_dt, n_classes], dtype=int)
+    rank[order_by_score, np.arange(n_classes)] = np.arange(n_dt)[:, np.newaxis]
+
+    # self-pairs have equal ranks and never count
+    dt_ix, other_ix = np.nonzero(dt_dt_iou >= iou_thr)
+    is_suppressing = rank[other_ix] < rank[dt_ix]
+    np.logical_or.at(dt_is_suppressed, dt_ix, is_suppressing)
+
     return dt_is_suppressed
 
 
 def nms_all_classes(dt_dt_iou,
                     dt_scores,
-                    iou_thr=0.5):
+                    iou_thr=0.5,
+                    exact=False):
     """Perform greedy Non-Maximum Suppression given intersection over union (IoU) info and detection scores for all classes
 
+    exact=True uses nms_per_class_greedy, otherwise result of matrix approximation nms_per_class
+    is computed for all classes at once with nms_all_classes_batched (NumPy only, compiled
+    kernels of USE_COMPILED are not used on this path)
+
      Parameters
     ----------
     dt_dt_iou : array, shape = [n_dt_boxes, n_gt_boxes]
@@ -98,25 +232,182 @@ def nms_all_classes(dt_dt_iou,
     dt_is_suppressed : array, shape = [n_dt_boxes, n_classes]
         Array with indicators showing whether the box to be suppressed while considering specific class
     """
+    if not exact:
+        return nms_all_classes_batched(dt_dt_iou, dt_scores, iou_thr=iou_thr)
     n_dt, n_classes = dt_scores.shape
     dt_is_suppressed = np.zeros([n_dt, n_classes], dtype=bool)
     for class_label in range(0, n_classes):
         class_predictions = dt_scores[:, class_label]
-        dt_is_suppressed[:, class_label] = nms_per_class(
-            dt_dt_iou, class_predictions, iou_thr=iou_thr)
+        dt_is_suppressed[:, class_label] = nms_per_class_greedy(
+            class_predictions, dt_dt_iou=dt_dt_iou, iou_thr=iou_thr)
     return dt_is_suppressed
 
 
+def max_iou_with_higher_scored(dt_dt_iou, dt_scores):
+    """For every box, find maximum IoU with any box having higher score
+
+    Box is suppressed by nms_per_class with threshold iou_thr iff this value is >= iou_thr
+
+     Parameters
+    ----------
+    dt_dt_iou : array, shape = [n_dt_boxes, n_dt_boxes]
+        Intersection over union (IoU) ratio between each pair of dt boxes
+    dt_scores : array, shape = [n_dt_boxes]
+        Confidence scores
+    Returns
+    -------
+    max_iou : array, shape = [n_dt_boxes]
+        0 for the box with the highest score
+    """
+    n_dt = dt_scores.shape[0]
+    max_iou = np.zeros(n_dt)
+    if n_dt == 0:
+        return max_iou
+    order_by_score = np.argsort(dt_scores)[::-1]
+    # keep only pairs where second box is ranked higher
+    dt_dt_iou_higher = np.tril(dt_dt_iou[order_by_score][:, order_by_score], k=-1)
+    max_iou[order_by_score] = np.max(dt_dt_iou_higher, axis=1)
+    return max_iou
+
+
 def nms_all_classes_all_thresholds(dt_dt_iou,
                                    dt_scores,
                                    thrs):
     """ Perform NMS for variety of IoU thresholds
+
+    Same result as running nms_all_classes for every threshold, but IoU matrix is
+    sorted and scanned only once per class
     """
     n_dt, n_classes = dt_scores.shape
 
-    n_thrs = len(thrs)
-    dt_is_suppressed = np.zeros([n_dt, n_classes, n_thrs], dtype=bool)
-    for i in range(0, n_thrs):
-        dt_is_suppressed[:, :, i] = nms_all_classes(
-            dt_dt_iou, dt_scores, iou_thr=thrs[i])
+    thrs = np.asarray(thrs)
+    dt_is_suppressed = np.zeros([n_dt, n_classes, len(thrs)], dtype=bool)
+    for class_label in range(0, n_classes):
+        max_iou = max_iou_with_higher_scored(dt_dt_iou, dt_scores[:, class_label])
+        dt_is_suppressed[:, class_label, :] = max_iou[:, np.newaxis] >= thrs[np.newaxis, :]
     return dt_is_suppressed
+
+
+def soft_nms_all_classes(dt_dt_iou,
+                         dt_scores,
+                         method='linear',
+                         iou_thr=0.3,
+                         sigma=0.5):
+    """Perform Soft-NMS (Bodla et al., 2017) for all classes at once
+
+    Instead of removing overlapping boxes, their scores are decayed. On every step each class
+    picks its highest-scored box among not yet picked ones and decays scores of the rest:
+    linear : s *= 1 - IoU for boxes with IoU >= iou_thr
+    gaussian : s *= exp(-IoU^2 / sigma)
+
+     Parameters
+    ----------
+    dt_dt_iou : array, shape = [n_dt_boxes, n_dt_boxes]
+        Intersection over union (IoU) ratio between each pair of dt boxes
+    dt_scores : array, shape = [n_dt_boxes, n_classes]
+        Confidence scores
+    method : 'linear' or 'gaussian'
+    iou_thr : float
+        IoU threshold for linear decay
+    sigma : float
+        Gaussian decay parameter
+    Returns
+    -------
+    dt_scores_new : array, shape = [n_dt_boxes, n_classes]
+        Decayed scores
+    """
+    if method not in ['linear', 'gaussian']:
+        raise ValueError("unknown soft-nms method : %s" % method)
+    n_dt, n_classes = dt_scores.shape
+    dt_scores_new = np.array(dt_scores, dtype=np.float64)
+    is_picked = np.zeros([n_dt, n_classes], dtype=bool)
+    class_ix = np.arange(n_classes)
+    for _ in range(0, n_dt):
+        candidate_scores = np.where(is_picked, -np.inf, dt_scores_new)
+        picked_ix = np.argmax(candidate_scores, axis=0)
+        is_picked[picked_ix, class_ix] = True
+        # [n_dt_boxes, n_classes] overlaps with picked box of every class
+        picked_iou = dt_dt_iou[:, picked_ix]
+        if method == 'linear':
+            decay = np.where(picked_iou >= iou_thr, 1 - picked_iou, 1.0)
+        else:
+            decay = np.exp(-picked_iou ** 2 / sigma)
+        dt_scores_new = np.where(is_picked, dt_scores_new, dt_scores_new * decay)
+    return dt_scores_new
+
+
+def weighted_box_fusion_per_class(dt_coords, dt_scores, iou_thr=0.55):
+    """Perform Weighted Box Fusion (Solovyev et al., 2019) for one class
+
+    Boxes are visited in order of decreasing score and added to the first cluster
+    whose fused box overlaps with them (IoU > iou_thr), otherwise they start a new cluster.
+    Fused box is score-weighted average of cluster boxes, fused score is mean score of the cluster.
+
+     Parameters
+    ----------
+    dt_coords : array, shape = [n_dt_boxes, 4]
+        Boxes in format [x1, y1, x2, y2]
+    dt_scores : array, shape = [n_dt_boxes]
+        Confidence scores
+    iou_thr : float
+        IoU threshold for adding box into a cluster
+    Returns
+    -------
+    fused_scores : array, shape = [n_dt_boxes]
+        Fused score for the highest-scored box of every cluster, 0 for the rest
+    fused_coords : array, shape = [n_dt_boxes, 4]
+        Fused box for the highest-scored box of every cluster, original box for the rest
+    """
+    n_dt = dt_scores.shape[0]
+    fused_scores = np.zeros(n_dt)
+    fused_coords = np.array(dt_coords[:, 0:4], dtype=np.float64)
+    if n_dt == 0:
+        return fused_scores, fused_coords
+
+    order_by_score = np.argsort(dt_scores)[::-1]
+    # clusters are identified by their highest-scored box
+    cluster_leaders = np.zeros(n_dt, dtype=int)
+    cluster_weighted_coords = np.zeros([n_dt, 4])
+    cluster_score_sums = np.zeros(n_dt)
+    cluster_sizes = np.zeros(n_dt)
+    n_clusters = 0
+
+    for dt_ix in order_by_score:
+        cluster_ix = -1
+        if n_clusters > 0:
+            leaders = cluster_leaders[0:n_clusters]
+            cluster_iou = bbox_utils.compute_sets_iou(dt_coords[dt_ix:dt_ix+1], fused_coords[leaders])[0]
+            overlapping = np.where(cluster_iou > iou_thr)[0]
+            if overlapping.size > 0:
+                cluster_ix = overlapping[0]
+        if cluster_ix < 0:
+            cluster_ix = n_clusters
+            cluster_leaders[cluster_ix] = dt_ix
+            n_clusters += 1
+        cluster_weighted_coords[cluster_ix] += dt_scores[dt_ix] * dt_coords[dt_ix, 0:4]
+        cluster_score_sums[cluster_ix] += dt_scores[dt_ix]
+        cluster_sizes[cluster_ix] += 1
+        if cluster_score_sums[cluster_ix] > 0:
+            fused_coords[cluster_leaders[cluster_ix]] = \
+                cluster_weighted_coords[cluster_ix] / cluster_score_sums[cluster_ix]
+
+    leaders = cluster_leaders[0:n_clusters]
+    fused_scores[leaders] = cluster_score_sums[0:n_clusters] / cluster_sizes[0:n_clusters]
+    return fused_scores, fused_coords
+
+
+def weighted_box_fusion_all_classes(dt_coords, dt_scores, iou_thr=0.55):
+    """Perform Weighted Box Fusion for all classes
+
+    Returns
+    -------
+    fused_scores : array, shape = [n_dt_boxes, n_classes]
+    fused_coords : array, shape = [n_dt_boxes, n_classes, 4]
+    """
+    n_dt, n_classes = dt_scores.shape
+    fused_scores = np.zeros([n_dt, n_classes])
+    fused_coords = np.zeros([n_dt, n_classes, 4])
+    for class_label in range(0, n_classes):
+        fused_scores[:, class_label], fused_coords[:, class_label] = weighted_box_fusion_per_class(
+            dt_coords, dt_scores[:, class_label], iou_thr=iou_thr)
+    return fused_scores, fused_coords